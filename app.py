@@ -2,13 +2,21 @@ import eventlet
 # Đặt monkey_patch trước tiên
 eventlet.monkey_patch()
 
-from flask import Flask, render_template, jsonify
+from flask import Flask, Response, render_template, jsonify, request, g
 from flask_socketio import SocketIO
-import random
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 import os
 import logging
+from ring_buffer import TelemetryRingBuffer
+from downsampling import DOWNSAMPLING_METHODS
+import param_schema
+import series_encoding
+import http_cache
+from param_schema import PARAM_RANGES, Series
+import metrics
+import tracing
+import hmac
 
 # Cấu hình logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -18,71 +26,105 @@ app = Flask(__name__)
 # Cấu hình SocketIO
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
 
-# Data ranges for each environmental parameter
-PARAM_RANGES = {
-    "pm10": {"min": 0, "max": 150, "unit": "μg/m³", "warning": 50, "danger": 100},
-    "pm25": {"min": 0, "max": 75, "unit": "μg/m³", "warning": 25, "danger": 50},
-    "temperature": {"min": 15, "max": 40, "unit": "°C", "warning": 35, "danger": 40},
-    "humidity": {"min": 20, "max": 90, "unit": "%", "warning": 70, "danger": 85},
-    "noise": {"min": 30, "max": 100, "unit": "dB", "warning": 70, "danger": 85},
-    "co": {"min": 0, "max": 60, "unit": "ppm", "warning": 30, "danger": 60},
-    "aqi": {"min": 0, "max": 300, "unit": "", "warning": 100, "danger": 150}
-}
+# Độ trễ xử lý request theo route (mẫu URL, không phải đường dẫn thực tế)
+_route_latency = metrics.histogram(
+    'flask_request_duration_seconds', 'Latency of Flask requests per route', ('route', 'method', 'status')
+)
+_fallbacks = metrics.counter(
+    'data_fallback_total', 'Responses served from fallback data because upstream failed', ('kind', 'source')
+)
+
+# Token cho các endpoint quản trị (/debug/profile); không đặt thì các endpoint này bị tắt
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    if request.endpoint != 'static':
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        g.trace = tracing.start_trace(f"{request.method} {route}", path=request.path)
+
+@app.after_request
+def _record_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        _route_latency.observe(time.perf_counter() - started,
+                               route=route, method=request.method, status=response.status_code)
+    trace = g.get('trace')
+    if trace is not None:
+        trace.attrs['status'] = response.status_code
+    return response
+
+@app.teardown_request
+def _finish_request_trace(exc=None):
+    # Luôn kết thúc trace, kể cả khi view phát sinh ngoại lệ
+    tracing.finish_trace(g.pop('trace', None))
 
 # Cache to store historical data (sẽ được sử dụng nếu không thể kết nối với ThingsBoard)
-historical_data = {param: [] for param in PARAM_RANGES}
+historical_data = {param: TelemetryRingBuffer() for param in PARAM_RANGES}
 
 # Kiểm tra xem có nên sử dụng ThingsBoard hay không
 USE_THINGSBOARD = True
 
-def generate_reading(param_info):
-    """Generate a realistic reading for the given parameter"""
-    return round(random.uniform(param_info["min"], param_info["max"]), 1)
-
-def get_status(value, param_info):
-    """Determine status based on thresholds"""
-    if value >= param_info["danger"]:
-        return "danger"
-    elif value >= param_info["warning"]:
-        return "warning"
-    return "normal"
-
 def get_current_readings():
     """Get current readings for all parameters, either from ThingsBoard or generated"""
     if USE_THINGSBOARD:
         try:
             # Import khi cần thiết để tránh circular imports
+            import thingsboard_mqtt_client
             import thingsboard_client
+            
+            # Ưu tiên dữ liệu nhận qua MQTT, chỉ gọi HTTP API khi không có kết nối MQTT
+            readings = thingsboard_mqtt_client.get_mqtt_readings()
+            if readings is not None:
+                return readings
             return thingsboard_client.get_current_readings()
         except Exception as e:
             logger.error(f"Error getting data from ThingsBoard: {str(e)}")
             logger.info("Falling back to generated data")
+            _fallbacks.inc(kind='current', source='generated')
     
     # Nếu không dùng ThingsBoard hoặc có lỗi, tạo dữ liệu giả
-    timestamp = datetime.now().strftime("%H:%M:%S")
+    now = datetime.now()
+    timestamp = now.strftime("%H:%M:%S")
+    now_ms = int(now.timestamp() * 1000)
     readings = {}
     
-    for param, param_info in PARAM_RANGES.items():
-        value = generate_reading(param_info)
-        status = get_status(value, param_info)
-        
-        readings[param] = {
-            "value": value,
-            "unit": param_info["unit"],
-            "status": status,
-            "timestamp": timestamp
-        }
+    for param in param_schema.NAMES:
+        value = param_schema.generate_value(param)
+        readings[param] = param_schema.reading_json(param, value, param_schema.status(param, value), timestamp)
         
-        # Store in historical data (limit to 100 data points)
-        historical_data[param].append({
-            "value": value,
-            "timestamp": timestamp
-        })
-        if len(historical_data[param]) > 100:
-            historical_data[param].pop(0)
+        # Store in historical data (fixed-capacity ring buffer)
+        historical_data[param].append(now_ms, value)
     
     return readings
 
+def get_data_freshness(kind='current', device_id=None):
+    """Age (seconds) of the data served for `kind` and whether it is older than the staleness bound"""
+    if not USE_THINGSBOARD:
+        return {"age": 0, "stale": False}
+    try:
+        import thingsboard_mqtt_client
+        import thingsboard_client
+        
+        # Dữ liệu hiện tại của thiết bị mặc định lấy từ MQTT nếu đang kết nối broker
+        if kind == 'current' and device_id is None and thingsboard_mqtt_client.get_mqtt_readings() is not None:
+            age = time.time() - thingsboard_mqtt_client.mqtt_data_store['last_received']
+            return {"age": round(age, 3), "stale": age > thingsboard_client.MAX_STALENESS}
+        return thingsboard_client.get_cache_status(kind, device_id)
+    except Exception as e:
+        logger.error(f"Error checking data freshness: {str(e)}")
+        return {"age": None, "stale": True}
+
+def _with_freshness_headers(response, kind, device_id=None):
+    """Attach data age / staleness headers to an API response"""
+    freshness = get_data_freshness(kind, device_id)
+    if freshness["age"] is not None:
+        response.headers["X-Data-Age"] = str(freshness["age"])
+    response.headers["X-Data-Stale"] = "true" if freshness["stale"] else "false"
+    return response
+
 def get_historical_data(hours=1):
     """Get historical data for charts, either from ThingsBoard or generated"""
     if USE_THINGSBOARD:
@@ -93,24 +135,10 @@ def get_historical_data(hours=1):
         except Exception as e:
             logger.error(f"Error getting historical data from ThingsBoard: {str(e)}")
             logger.info("Falling back to generated historical data")
+            _fallbacks.inc(kind='historical', source='generated')
     
-    # Nếu không dùng ThingsBoard hoặc có lỗi, tạo dữ liệu giả
-    now = datetime.now()
-    data = {}
-    
-    for param in PARAM_RANGES:
-        param_data = []
-        for i in range(60):  # 60 data points (1 per minute for the last hour)
-            time_point = now - timedelta(minutes=i)
-            value = generate_reading(PARAM_RANGES[param])
-            param_data.append({
-                "timestamp": time_point.strftime("%H:%M"),
-                "value": value
-            })
-        # Reverse to have chronological order
-        data[param] = list(reversed(param_data))
-    
-    return data
+    # Nếu không dùng ThingsBoard hoặc có lỗi, tạo dữ liệu giả (60 điểm, mỗi phút một điểm)
+    return {param: Series.generated(param) for param in param_schema.NAMES}
 
 @app.route('/')
 def index():
@@ -123,28 +151,147 @@ def parameter_detail(param_name):
     if param_name not in PARAM_RANGES:
         return "Parameter not found", 404
     
-    param_info = PARAM_RANGES[param_name]
-    param_info["name"] = param_name
+    param_info = dict(PARAM_RANGES[param_name], name=param_name)
     return render_template('parameter.html', parameter=param_info)
 
 @app.route('/api/current')
 def api_current():
     """API endpoint for current readings"""
-    return jsonify(get_current_readings())
+    with tracing.span('get_current_readings'):
+        readings = get_current_readings()
+    with tracing.span('respond'):
+        response = http_cache.respond(http_cache.request_key(), readings, lambda: _render_json(readings))
+    with tracing.span('freshness_headers'):
+        return _with_freshness_headers(response, 'current')
+
+def _render_json(data):
+    """JSON body (bytes) of a cached response, rendered once per cache generation"""
+    with tracing.span('jsonify'):
+        return jsonify(data).get_data()
+
+# Khoảng thời gian tối đa cho một truy vấn lịch sử (giờ)
+MAX_HISTORY_HOURS = 24 * 90
+
+def _historical_query_args():
+    """
+    Parse ?hours=, ?points=, ?method= and the response format (?format= or the Accept header)
+    for the historical endpoints.
+    Returns (hours, points, method, fmt, error) - error is a Flask response when invalid.
+    """
+    hours = request.args.get('hours', default=1, type=int)
+    points = request.args.get('points', type=int)
+    method = request.args.get('method', default='lttb')
+    fmt = series_encoding.negotiate(request.args.get('format'), request.accept_mimetypes)
+    if hours is None or not 1 <= hours <= MAX_HISTORY_HOURS:
+        return None, None, None, None, (jsonify({"error": f"hours must be between 1 and {MAX_HISTORY_HOURS}"}), 400)
+    if points is not None and points < 2:
+        return None, None, None, None, (jsonify({"error": "points must be at least 2"}), 400)
+    if method not in DOWNSAMPLING_METHODS:
+        return None, None, None, None, (jsonify({"error": f"method must be one of {', '.join(DOWNSAMPLING_METHODS)}"}), 400)
+    if fmt is None:
+        return None, None, None, None, (jsonify({"error": f"format must be one of {', '.join(series_encoding.FORMATS)}"}), 400)
+    if not series_encoding.available(fmt):
+        return None, None, None, None, (jsonify({"error": f"format {fmt} is not available on this server"}), 406)
+    return hours, points, method, fmt, None
+
+def _history_response(history, points, method, fmt, device_id=None, param_name=None):
+    """
+    Downsample {param: Series} and encode it in the negotiated format (whole history or one parameter).
+    Downsampling, encoding and compression run once per cache generation of `history`.
+    """
+    def render():
+        selected = history if param_name is None else {param_name: history[param_name]}
+        if points:
+            selected = {param: series.downsample(points, method) for param, series in selected.items()}
+        if param_name is None:
+            data, mimetype = series_encoding.encode(selected, fmt)
+        else:
+            data, mimetype = series_encoding.encode_series(param_name, selected[param_name], fmt)
+        return _render_json(data) if mimetype == 'application/json' else data
+    
+    key = http_cache.request_key() + (fmt,)
+    response = http_cache.respond(key, history, render, series_encoding.content_type(fmt))
+    response.vary.add('Accept')
+    return _with_freshness_headers(response, 'historical', device_id)
 
 @app.route('/api/historical')
 def api_historical():
     """API endpoint for historical data"""
-    return jsonify(get_historical_data())
+    hours, points, method, fmt, error = _historical_query_args()
+    if error:
+        return error
+    
+    return _history_response(get_historical_data(hours), points, method, fmt)
 
 @app.route('/api/historical/<param_name>')
 def api_param_historical(param_name):
     """API endpoint for historical data of a specific parameter"""
     if param_name not in PARAM_RANGES:
         return jsonify({"error": "Parameter not found"}), 404
+    hours, points, method, fmt, error = _historical_query_args()
+    if error:
+        return error
     
-    history = get_historical_data()
-    return jsonify(history[param_name])
+    history = get_historical_data(hours)
+    # Một số tham số (aqi) không có dữ liệu lịch sử
+    if param_name not in history:
+        return jsonify({"error": "No historical data for this parameter"}), 404
+    return _history_response(history, points, method, fmt, param_name=param_name)
+
+@app.route('/api/devices')
+def api_devices():
+    """API endpoint listing the registered devices (stations)"""
+    import device_registry
+    return jsonify(device_registry.get_devices())
+
+@app.route('/api/devices/current')
+def api_devices_current():
+    """API endpoint for current readings of all registered devices, fetched concurrently"""
+    import device_registry
+    if not USE_THINGSBOARD:
+        readings = {device['id']: get_current_readings() for device in device_registry.get_devices()}
+    else:
+        import thingsboard_client
+        readings = thingsboard_client.get_fleet_readings()
+    return http_cache.respond(http_cache.request_key(), readings, lambda: _render_json(readings))
+
+def _device_or_404(device_id):
+    import device_registry
+    if device_registry.get_device(device_id) is None:
+        return jsonify({"error": "Device not found"}), 404
+    return None
+
+@app.route('/api/devices/<device_id>/current')
+def api_device_current(device_id):
+    """API endpoint for current readings of one device"""
+    error = _device_or_404(device_id)
+    if error:
+        return error
+    
+    if not USE_THINGSBOARD:
+        readings = get_current_readings()
+    else:
+        import thingsboard_client
+        readings = thingsboard_client.get_current_readings(device_id)
+    response = http_cache.respond(http_cache.request_key(), readings, lambda: _render_json(readings))
+    return _with_freshness_headers(response, 'current', device_id)
+
+@app.route('/api/devices/<device_id>/historical')
+def api_device_historical(device_id):
+    """API endpoint for historical data of one device (same query arguments as /api/historical)"""
+    error = _device_or_404(device_id)
+    if error:
+        return error
+    hours, points, method, fmt, error = _historical_query_args()
+    if error:
+        return error
+    
+    if not USE_THINGSBOARD:
+        history = get_historical_data(hours)
+    else:
+        import thingsboard_client
+        history = thingsboard_client.get_historical_data(hours, device_id)
+    return _history_response(history, points, method, fmt, device_id)
 
 @app.route('/api/status')
 def api_status():
@@ -152,19 +299,21 @@ def api_status():
     try:
         import thingsboard_mqtt_client
         import thingsboard_client
+        import thingsboard_transport
+        import connection_health
         
-        # Thử kết nối bằng cả hai cách
-        mqtt_status = thingsboard_mqtt_client.test_connection()
-        jwt_status = thingsboard_client.test_connection()
-        
-        # Nếu một trong hai kết nối thành công thì coi như kết nối được
-        connection_status = mqtt_status or jwt_status
+        # Trạng thái đã lưu từ kết quả các request thực tế, không gọi mạng cho mỗi request.
+        # Nếu một trong hai kênh (HTTP, MQTT) kết nối được thì coi như kết nối được
+        connection_status = connection_health.is_connected()
         
         return jsonify({
             "thingsboard_connected": connection_status,
             "device_id": thingsboard_mqtt_client.THINGSBOARD_CONFIG['device_id'],
-            "dashboard_url": f"https://{thingsboard_mqtt_client.THINGSBOARD_CONFIG['host']}/dashboards/0c0e97d0-bd24-11ef-af67-a38a7671daf5",
-            "data_source": "ThingsBoard API" if connection_status else "Dữ liệu giả lập"
+            "dashboard_url": f"{thingsboard_mqtt_client.THINGSBOARD_CONFIG['http_url']}/dashboards/0c0e97d0-bd24-11ef-af67-a38a7671daf5",
+            "data_source": "ThingsBoard API" if connection_status else "Dữ liệu giả lập",
+            "health": connection_health.get_health(),
+            "http_pool": thingsboard_transport.get_transport_stats(),
+            "request_coalescing": thingsboard_client.get_request_stats()
         })
     except Exception as e:
         logger.error(f"Error checking ThingsBoard status: {str(e)}")
@@ -174,6 +323,62 @@ def api_status():
             "data_source": "Dữ liệu giả lập"
         })
 
+@app.route('/metrics')
+def api_metrics():
+    """Số liệu vận hành theo định dạng Prometheus (không gọi ThingsBoard)"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/debug/traces')
+def debug_traces():
+    """Các trace được lấy mẫu gần nhất: ?limit=, ?name=, ?min_ms="""
+    limit = request.args.get('limit', default=50, type=int)
+    name = request.args.get('name')
+    min_ms = request.args.get('min_ms', type=float)
+    return jsonify({
+        "sample_rate": tracing.TRACE_SAMPLE_RATE,
+        "traces": tracing.get_traces(limit=limit, name=name, min_duration_ms=min_ms)
+    })
+
+def _is_admin():
+    token = request.headers.get('X-Admin-Token', '')
+    return ADMIN_TOKEN is not None and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+@app.route('/debug/traces/sample-rate', methods=['POST'])
+def debug_trace_sample_rate():
+    """Đổi tỷ lệ lấy mẫu trace khi đang chạy (cần X-Admin-Token)"""
+    if not _is_admin():
+        return jsonify({"error": "admin token required"}), 403
+    rate = request.args.get('rate', type=float)
+    if rate is None or not 0 <= rate <= 1:
+        return jsonify({"error": "rate must be between 0 and 1"}), 400
+    tracing.set_sample_rate(rate)
+    return jsonify({"sample_rate": tracing.TRACE_SAMPLE_RATE})
+
+@app.route('/debug/profile', methods=['POST'])
+def debug_profile():
+    """
+    Chạy cProfile trên tiến trình trong ?seconds= giây (cần X-Admin-Token).
+    ?sort= và ?limit= cho kết quả dạng văn bản; ?format=pstats trả về tệp pstats.
+    """
+    if not _is_admin():
+        return jsonify({"error": "admin token required"}), 403
+    seconds = request.args.get('seconds', default=10, type=float)
+    sort = request.args.get('sort', default='cumulative')
+    limit = request.args.get('limit', default=50, type=int)
+    raw = request.args.get('format') == 'pstats'
+    if seconds is None or not 0 < seconds <= tracing.MAX_PROFILE_SECONDS:
+        return jsonify({"error": f"seconds must be between 0 and {tracing.MAX_PROFILE_SECONDS}"}), 400
+    if sort not in tracing.PROFILE_SORT_KEYS:
+        return jsonify({"error": f"sort must be one of {', '.join(tracing.PROFILE_SORT_KEYS)}"}), 400
+
+    result = tracing.profile(seconds, sort=sort, limit=limit, raw=raw)
+    if result is None:
+        return jsonify({"error": "a profile is already running"}), 409
+    if raw:
+        return Response(result, mimetype='application/octet-stream',
+                        headers={"Content-Disposition": "attachment; filename=profile.pstats"})
+    return Response(result, mimetype='text/plain')
+
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
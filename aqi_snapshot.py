@@ -0,0 +1,195 @@
+"""
+Kênh chia sẻ chỉ số AQI mới nhất giữa các process qua bộ nhớ dùng chung (mmap).
+
+Chương trình tính VN_AQI ghi một bản ghi cố định kích thước vào vùng nhớ dùng chung,
+các process web đọc trực tiếp từ vùng nhớ đã ánh xạ mà không cần mở file hay phân tích
+chuỗi. Tính nhất quán được đảm bảo theo kiểu seqlock: bộ đếm tuần tự là số lẻ trong
+khi đang ghi, người đọc thử lại nếu bộ đếm thay đổi trong lúc đọc.
+"""
+
+import os
+import mmap
+import math
+import struct
+import time
+import tempfile
+import logging
+
+# Cấu hình logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('aqi_snapshot')
+
+# Đặt vùng nhớ trong /dev/shm nếu có (Linux), nếu không thì dùng thư mục tạm
+_SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+SNAPSHOT_PATH = os.environ.get('AQI_SNAPSHOT_PATH', os.path.join(_SHM_DIR, 'env_monitor_aqi'))
+
+# Bản ghi cũ hơn thời gian này (giây) coi như chương trình tính AQI không còn chạy
+SNAPSHOT_MAX_AGE = 30
+
+# Số lần thử đọc lại khi gặp bản ghi đang được ghi dở
+_READ_RETRIES = 100
+
+_MAGIC = b'AQI1'
+# Phần đầu: magic, 4 byte đệm, bộ đếm tuần tự
+_HEADER = struct.Struct('<4s4xQ')
+_SEQ = struct.Struct('<Q')
+_SEQ_OFFSET = 8
+# Dữ liệu: timestamp, AQI, IAQI PM2.5/PM10/CO, AQI chính thức, trạng thái, trạng thái chính thức
+_PAYLOAD = struct.Struct('<dddddd16s16s')
+_PAYLOAD_OFFSET = _HEADER.size
+SNAPSHOT_SIZE = _HEADER.size + _PAYLOAD.size
+
+
+def _to_float(value):
+    return math.nan if value is None else float(value)
+
+
+def _from_float(value):
+    return None if math.isnan(value) else value
+
+
+def _encode_status(status):
+    return (status or 'unknown').encode('utf-8')[:16]
+
+
+def _decode_status(raw):
+    return raw.rstrip(b'\x00').decode('utf-8', errors='ignore') or 'unknown'
+
+
+class SnapshotWriter:
+    """
+    Phía ghi (chỉ một process). Không xóa hay cắt ngắn file khi khởi động lại
+    để các process đang đọc vẫn giữ được vùng nhớ đã ánh xạ.
+    """
+
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < SNAPSHOT_SIZE:
+                os.ftruncate(fd, SNAPSHOT_SIZE)
+            self._mm = mmap.mmap(fd, SNAPSHOT_SIZE)
+        finally:
+            os.close(fd)
+
+        magic, seq = _HEADER.unpack_from(self._mm, 0)
+        # Nếu lần chạy trước bị dừng khi đang ghi thì đưa bộ đếm về số chẵn
+        self._seq = seq + (seq & 1) if magic == _MAGIC else 0
+        _HEADER.pack_into(self._mm, 0, _MAGIC, self._seq)
+
+    def publish(self, aqi, status, iaqi_values=None, official_aqi=None,
+                official_status='unknown', timestamp=None):
+        """Ghi một bản ghi AQI mới"""
+        iaqi_values = iaqi_values or {}
+        payload = _PAYLOAD.pack(
+            time.time() if timestamp is None else timestamp,
+            _to_float(aqi),
+            _to_float(iaqi_values.get('PM2.5')),
+            _to_float(iaqi_values.get('PM10')),
+            _to_float(iaqi_values.get('CO')),
+            _to_float(official_aqi),
+            _encode_status(status),
+            _encode_status(official_status)
+        )
+
+        # Bộ đếm lẻ: đang ghi
+        self._seq += 1
+        _SEQ.pack_into(self._mm, _SEQ_OFFSET, self._seq)
+        self._mm[_PAYLOAD_OFFSET:SNAPSHOT_SIZE] = payload
+        # Bộ đếm chẵn: ghi xong
+        self._seq += 1
+        _SEQ.pack_into(self._mm, _SEQ_OFFSET, self._seq)
+
+    def close(self):
+        self._mm.close()
+
+
+class SnapshotReader:
+    """
+    Phía đọc (nhiều process). Ánh xạ vùng nhớ một lần, sau đó mỗi lần đọc
+    chỉ sao chép vài chục byte từ bộ nhớ.
+    """
+
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+        self._mm = None
+        self._last = None  # Bản ghi nhất quán gần nhất
+
+    def _open(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            if os.fstat(fd).st_size < SNAPSHOT_SIZE:
+                return False
+            self._mm = mmap.mmap(fd, SNAPSHOT_SIZE, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        return True
+
+    def read(self, max_age=SNAPSHOT_MAX_AGE):
+        """
+        Đọc bản ghi AQI mới nhất. Trả về None nếu chưa có chương trình tính AQI
+        nào ghi dữ liệu, hoặc bản ghi đã cũ hơn max_age giây.
+        """
+        if self._mm is None and not self._open():
+            return None
+
+        for _ in range(_READ_RETRIES):
+            magic, seq_before = _HEADER.unpack_from(self._mm, 0)
+            if magic != _MAGIC or seq_before == 0:
+                return None
+            if seq_before & 1:
+                continue
+            payload = _PAYLOAD.unpack_from(self._mm, _PAYLOAD_OFFSET)
+            (seq_after,) = _SEQ.unpack_from(self._mm, _SEQ_OFFSET)
+            if seq_before == seq_after:
+                break
+        else:
+            # Người ghi liên tục ghi đè, dùng bản ghi nhất quán gần nhất
+            logger.debug("Could not read a consistent AQI snapshot, using the previous one")
+            payload, seq_before = self._last if self._last else (None, None)
+            if payload is None:
+                return None
+
+        self._last = (payload, seq_before)
+        timestamp, aqi, iaqi_pm25, iaqi_pm10, iaqi_co, official_aqi, status, official_status = payload
+        if max_age is not None and time.time() - timestamp > max_age:
+            return None
+
+        return {
+            "aqi": _from_float(aqi),
+            "status": _decode_status(status),
+            "iaqi": {
+                "PM2.5": _from_float(iaqi_pm25),
+                "PM10": _from_float(iaqi_pm10),
+                "CO": _from_float(iaqi_co)
+            },
+            "official_aqi": _from_float(official_aqi),
+            "official_status": _decode_status(official_status),
+            "timestamp": timestamp,
+            "sequence": seq_before // 2
+        }
+
+
+# Đối tượng dùng chung trong mỗi process
+_writer = None
+_reader = None
+
+
+def publish_snapshot(aqi, status, iaqi_values=None, official_aqi=None,
+                     official_status='unknown', timestamp=None):
+    """Ghi bản ghi AQI vào vùng nhớ dùng chung (dùng bởi chương trình tính AQI)"""
+    global _writer
+    if _writer is None:
+        _writer = SnapshotWriter()
+    _writer.publish(aqi, status, iaqi_values, official_aqi, official_status, timestamp)
+
+
+def read_snapshot(max_age=SNAPSHOT_MAX_AGE):
+    """Đọc bản ghi AQI mới nhất, None nếu chương trình tính AQI không chạy"""
+    global _reader
+    if _reader is None:
+        _reader = SnapshotReader()
+    return _reader.read(max_age)
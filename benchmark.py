@@ -0,0 +1,272 @@
+"""
+Benchmark các đường xử lý dữ liệu chính: tính AQI, chuyển đổi dữ liệu ThingsBoard
+(client JWT và client MQTT), downsampling và các API endpoint của Flask.
+
+Dữ liệu ThingsBoard giả lập được tạo với seed cố định cho các cửa sổ 1 giờ, 24 giờ
+và 30 ngày (mỗi điểm cách nhau 5 giây) với 1 đến 100 key. Kết quả (ops/giây,
+độ trễ theo phân vị, bộ nhớ tối đa) được ghi ra tệp JSON làm mốc so sánh.
+
+Cách dùng:
+    python benchmark.py                                # chạy và ghi benchmark_results.json
+    python benchmark.py --output baseline.json         # lưu làm mốc
+    python benchmark.py --compare baseline.json        # so sánh với mốc, exit 1 nếu chậm đi
+    python benchmark.py --filter format_historical     # chỉ chạy các benchmark có tên chứa chuỗi này
+    python benchmark.py --full                         # thêm các trường hợp rất lớn (30 ngày x nhiều key)
+"""
+
+import os
+
+# Không kết nối MQTT khi import client, benchmark chỉ đo phần xử lý dữ liệu
+os.environ.setdefault('THINGSBOARD_MQTT_AUTOCONNECT', '0')
+os.environ.setdefault('TELEMETRY_DB_PATH', ':memory:')
+# Luồng probe kết nối và luồng làm mới nền chạy ngay khi import client; trỏ tới một cổng
+# cục bộ không có dịch vụ để các request đó thất bại ngay, không gây I/O mạng khi đang đo
+os.environ.setdefault('THINGSBOARD_URL', 'http://127.0.0.1:9')
+
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+# Tạo dữ liệu giả lập theo các kích thước cửa sổ
+SAMPLE_INTERVAL_MS = 5000
+WINDOWS = {'1h': 3600, '24h': 24 * 3600, '30d': 30 * 24 * 3600}
+KEY_COUNTS = (1, 7, 100)
+# Bỏ qua các trường hợp lớn hơn số điểm này trừ khi chạy với --full
+MAX_POINTS = 2_000_000
+
+# Thời gian đo tối thiểu và số lần lặp tối đa cho mỗi benchmark
+MIN_TIME = 1.0
+MAX_ITERATIONS = 10_000
+
+TB_KEYS = ['Temperature', 'Humidity', 'PM10', 'PM2.5', 'CO', 'CO2', 'Sound']
+
+
+def _keys(count):
+    """count key: các key thật của thiết bị trước, sau đó là các key phụ"""
+    return (TB_KEYS + [f'extra_{i}' for i in range(count)])[:count]
+
+
+def make_latest_payload(key_count, rng):
+    now = int(time.time() * 1000)
+    return {key: [{'ts': now, 'value': str(round(rng.uniform(0, 100), 2))}] for key in _keys(key_count)}
+
+
+def make_history_payload(window_seconds, key_count, rng):
+    """Dữ liệu lịch sử theo định dạng ThingsBoard: mới nhất trước, giá trị dạng chuỗi"""
+    end = int(time.time() * 1000)
+    count = window_seconds * 1000 // SAMPLE_INTERVAL_MS
+    timestamps = end - np.arange(count, dtype=np.int64) * SAMPLE_INTERVAL_MS
+    payload = {}
+    for key in _keys(key_count):
+        values = np.round(rng.uniform(0, 100, count), 2)
+        payload[key] = [{'ts': int(ts), 'value': str(value)} for ts, value in zip(timestamps, values)]
+    return payload
+
+
+def measure(fn, min_time=MIN_TIME, max_iterations=MAX_ITERATIONS):
+    """Chạy fn nhiều lần, trả về thống kê độ trễ (ms) và bộ nhớ tối đa (KB) của một lần chạy"""
+    fn()  # khởi động (cache, import, ...)
+
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < max_iterations and (time.perf_counter() - started < min_time or len(samples) < 3):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+
+    # Đo bộ nhớ trong một lần chạy riêng vì tracemalloc làm chậm đáng kể
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    samples_ms = np.array(samples) * 1000
+    return {
+        'iterations': len(samples),
+        'ops_per_sec': round(len(samples) / sum(samples), 2),
+        'mean_ms': round(float(samples_ms.mean()), 4),
+        'min_ms': round(float(samples_ms.min()), 4),
+        'p50_ms': round(float(np.percentile(samples_ms, 50)), 4),
+        'p95_ms': round(float(np.percentile(samples_ms, 95)), 4),
+        'p99_ms': round(float(np.percentile(samples_ms, 99)), 4),
+        'max_ms': round(float(samples_ms.max()), 4),
+        'peak_memory_kb': round(peak / 1024, 1)
+    }
+
+
+def build_benchmarks(full=False):
+    """
+    Danh sách (tên, setup) cần đo: setup() tạo dữ liệu và trả về hàm không tham số được đo.
+    Dữ liệu chỉ được tạo cho các benchmark được chọn, mỗi benchmark với seed cố định riêng.
+    """
+    # app phải được import trước (eventlet.monkey_patch) giống như khi chạy run.py
+    import app as web
+    import vn_aqi_calculator as aqi_calc
+    import thingsboard_client as tb_jwt
+    import thingsboard_mqtt_client as tb_mqtt
+
+    benchmarks = []
+
+    # Tính AQI
+    def iaqi():
+        rng = random.Random(42)
+        concentrations = [rng.uniform(0, 600) for _ in range(1000)]
+        return lambda: [aqi_calc.calculate_iaqi(c, aqi_calc.PM25_BREAKPOINTS) for c in concentrations]
+    benchmarks.append(('calculate_iaqi[1000]', iaqi))
+
+    def vn_aqi():
+        rng = random.Random(42)
+        sensor_data = [
+            {'pm25': rng.uniform(0, 300), 'pm10': rng.uniform(0, 500), 'co_mgm3': rng.uniform(0, 40)}
+            for _ in range(1000)
+        ]
+        return lambda: [aqi_calc.calculate_vn_aqi(d) for d in sensor_data]
+    benchmarks.append(('calculate_vn_aqi[1000]', vn_aqi))
+
+    def vn_aqi_batch():
+        np_rng = np.random.default_rng(42)
+        pm25, pm10, co = (np_rng.uniform(0, high, 100_000) for high in (300, 500, 40))
+        return lambda: aqi_calc.calculate_vn_aqi_batch(pm25, pm10, co)
+    benchmarks.append(('calculate_vn_aqi_batch[100000]', vn_aqi_batch))
+
+    # Chuyển đổi dữ liệu hiện tại
+    for key_count in KEY_COUNTS:
+        def current(module, key_count=key_count):
+            latest = make_latest_payload(key_count, random.Random(42))
+            return lambda: module.format_current_data(latest)
+        benchmarks.append((f'jwt.format_current_data[{key_count}k]', lambda f=current: f(tb_jwt)))
+        benchmarks.append((f'mqtt.format_current_data[{key_count}k]', lambda f=current: f(tb_mqtt)))
+
+    # Chuyển đổi dữ liệu lịch sử và downsampling
+    for window, seconds in WINDOWS.items():
+        for key_count in KEY_COUNTS:
+            points = seconds * 1000 // SAMPLE_INTERVAL_MS * key_count
+            if points > MAX_POINTS and not full:
+                continue
+
+            def historical(module, seconds=seconds, key_count=key_count):
+                history = make_history_payload(seconds, key_count, np.random.default_rng(42))
+                return lambda: module.format_historical_data(history)
+            benchmarks.append((f'jwt.format_historical_data[{window},{key_count}k]',
+                               lambda f=historical: f(tb_jwt)))
+            benchmarks.append((f'mqtt.format_historical_data[{window},{key_count}k]',
+                               lambda f=historical: f(tb_mqtt)))
+
+        for method in ('lttb', 'minmax', 'avg'):
+            def downsample(seconds=seconds, method=method):
+                payload = make_history_payload(seconds, 1, np.random.default_rng(42))
+                series = tb_jwt.format_historical_data(payload)['temperature']
+                return lambda: series.downsample(500, method)
+            benchmarks.append((f'downsample_{method}[{window}->500]', downsample))
+
+    benchmarks.extend(_endpoint_benchmarks(web, tb_jwt))
+    return benchmarks
+
+
+def _endpoint_benchmarks(web, tb_jwt):
+    """
+    Các endpoint Flask, dữ liệu ThingsBoard được nạp sẵn vào cache (còn hạn 1 giờ) nên
+    không gọi ThingsBoard
+    """
+    def prefill():
+        now = time.time()
+        tb_jwt._data_cache['current'].update(
+            data=tb_jwt.format_current_data(make_latest_payload(len(TB_KEYS), random.Random(7))),
+            timestamp=now + 3600, last_access=now
+        )
+        tb_jwt._data_cache['historical'].update(
+            data=tb_jwt.format_historical_data(
+                make_history_payload(WINDOWS['24h'], len(TB_KEYS), np.random.default_rng(42))),
+            timestamp=now + 3600, last_access=now, hours=24
+        )
+
+    client = web.app.test_client()
+    prefilled = []
+
+    def get(url):
+        def setup():
+            if not prefilled:
+                prefill()
+                prefilled.append(True)
+            return lambda: client.get(url).data
+        return setup
+
+    return [
+        ('GET /api/current', get('/api/current')),
+        ('GET /api/historical?hours=24', get('/api/historical?hours=24')),
+        ('GET /api/historical?hours=24&points=500', get('/api/historical?hours=24&points=500')),
+        ('GET /api/historical/pm25?hours=24&points=500', get('/api/historical/pm25?hours=24&points=500')),
+    ]
+
+
+def _metadata():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine()
+    }
+
+
+def compare(results, baseline, threshold):
+    """Các benchmark có p50 chậm hơn mốc quá threshold (tỷ lệ), dạng (tên, mốc, hiện tại)"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base and result['p50_ms'] > base['p50_ms'] * (1 + threshold):
+            regressions.append((name, base['p50_ms'], result['p50_ms']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the data-processing hot paths')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file to write results to')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed p50 slowdown (0.2 = 20%%)')
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this string')
+    parser.add_argument('--full', action='store_true', help='include very large cases (30d x many keys)')
+    parser.add_argument('--min-time', type=float, default=MIN_TIME, help='minimum seconds per benchmark')
+    args = parser.parse_args()
+
+    results = {}
+    for name, setup in build_benchmarks(full=args.full):
+        if args.filter and args.filter not in name:
+            continue
+        result = measure(setup(), min_time=args.min_time)
+        results[name] = result
+        print(f"{name:55s} {result['ops_per_sec']:>12.2f} ops/s  p50 {result['p50_ms']:>10.3f} ms  "
+              f"p95 {result['p95_ms']:>10.3f} ms  peak {result['peak_memory_kb']:>10.1f} KB")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'meta': _metadata(), 'results': results}, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name, base, current in regressions:
+            print(f"REGRESSION {name}: p50 {base:.3f} ms -> {current:.3f} ms")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against baseline")
+
+
+if __name__ == '__main__':
+    main()
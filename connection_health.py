@@ -0,0 +1,201 @@
+"""
+Theo dõi tình trạng kết nối tới ThingsBoard một cách thụ động.
+
+Kết quả và độ trễ của các request thực tế (polling, tải lịch sử, MQTT) được ghi
+nhận vào HealthMonitor; trạng thái được tính từ các kết quả đó và lưu sẵn, nên
+/api/status và sự kiện thingsboard_status đọc được mà không cần gọi mạng.
+Chỉ khi không có request nào trong một khoảng thời gian mới chủ động kiểm tra (probe).
+"""
+
+import time
+import threading
+import logging
+from collections import deque
+
+# Cấu hình logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('connection_health')
+
+# Số lần thất bại liên tiếp để coi là mất kết nối
+FAILURE_THRESHOLD = 3
+# Chủ động kiểm tra nếu không có request thực tế nào trong khoảng thời gian này (giây)
+IDLE_PROBE_INTERVAL = 30
+# Chu kỳ kiểm tra của luồng probe
+PROBE_CHECK_INTERVAL = 5
+# Số mẫu độ trễ gần nhất dùng để tính thống kê
+LATENCY_WINDOW = 50
+
+STATE_UNKNOWN = 'unknown'
+STATE_UP = 'up'
+STATE_DEGRADED = 'degraded'
+STATE_DOWN = 'down'
+
+
+class HealthMonitor:
+    """
+    Trạng thái kết nối của một kênh (HTTP, MQTT):
+    up (lần gần nhất thành công), degraded (vừa thất bại, chưa đủ FAILURE_THRESHOLD lần),
+    down (thất bại liên tiếp), unknown (chưa có kết quả nào)
+    """
+
+    def __init__(self, name, probe=None, failure_threshold=FAILURE_THRESHOLD,
+                 idle_probe_interval=IDLE_PROBE_INTERVAL):
+        self.name = name
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.idle_probe_interval = idle_probe_interval
+        self._lock = threading.Lock()
+        self._state = STATE_UNKNOWN
+        self._consecutive_failures = 0
+        self._last_success = None
+        self._last_failure = None
+        self._last_error = None
+        self._last_change = time.time()
+        self._last_observation = 0
+        self._transitions = 0
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._probing = False
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """callback(name, old_state, new_state) được gọi khi trạng thái thay đổi"""
+        self._listeners.append(callback)
+
+    def record_success(self, latency=None):
+        with self._lock:
+            now = time.time()
+            self._last_observation = now
+            self._last_success = now
+            self._consecutive_failures = 0
+            if latency is not None:
+                self._latencies.append(latency)
+            change = self._set_state(STATE_UP, now)
+        self._notify(change)
+
+    def record_failure(self, error=None, latency=None):
+        with self._lock:
+            now = time.time()
+            self._last_observation = now
+            self._last_failure = now
+            self._last_error = str(error) if error is not None else None
+            self._consecutive_failures += 1
+            if latency is not None:
+                self._latencies.append(latency)
+            state = STATE_DOWN if self._consecutive_failures >= self.failure_threshold else STATE_DEGRADED
+            change = self._set_state(state, now)
+        self._notify(change)
+
+    def _set_state(self, state, now):
+        if state == self._state:
+            return None
+        old_state = self._state
+        self._state = state
+        self._last_change = now
+        self._transitions += 1
+        return old_state, state
+
+    def _notify(self, change):
+        if change is None:
+            return
+        old_state, new_state = change
+        log = logger.warning if new_state == STATE_DOWN else logger.info
+        log(f"{self.name} connection state changed: {old_state} -> {new_state}")
+        for callback in list(self._listeners):
+            try:
+                callback(self.name, old_state, new_state)
+            except Exception as e:
+                logger.error(f"Error in health listener: {e}")
+
+    @property
+    def state(self):
+        return self._state
+
+    def is_connected(self):
+        return self._state in (STATE_UP, STATE_DEGRADED)
+
+    def maybe_probe(self):
+        """Chủ động kiểm tra kết nối nếu kênh không có request thực tế nào gần đây"""
+        if self.probe is None:
+            return
+        with self._lock:
+            if self._probing or time.time() - self._last_observation < self.idle_probe_interval:
+                return
+            self._probing = True
+        try:
+            # Hàm probe thực hiện request thật, kết quả được ghi nhận qua record_success/record_failure
+            logger.info(f"{self.name} idle, probing connection")
+            self.probe()
+        except Exception as e:
+            self.record_failure(e)
+        finally:
+            with self._lock:
+                self._probing = False
+
+    def status(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                'state': self._state,
+                'connected': self._state in (STATE_UP, STATE_DEGRADED),
+                'consecutive_failures': self._consecutive_failures,
+                'last_success': self._last_success,
+                'last_failure': self._last_failure,
+                'last_error': self._last_error,
+                'last_change': self._last_change,
+                'transitions': self._transitions,
+                'latency_ms': {
+                    'avg': round(sum(latencies) / len(latencies) * 1000, 1),
+                    'p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1),
+                    'samples': len(latencies)
+                } if latencies else None
+            }
+
+
+_monitors = {}
+_monitors_lock = threading.Lock()
+_probe_thread = None
+
+
+def get_monitor(name, **kwargs):
+    """HealthMonitor theo tên kênh (tạo khi cần lần đầu, kwargs chỉ dùng khi tạo)"""
+    monitor = _monitors.get(name)
+    if monitor is None:
+        with _monitors_lock:
+            monitor = _monitors.get(name)
+            if monitor is None:
+                monitor = _monitors[name] = HealthMonitor(name, **kwargs)
+    return monitor
+
+
+def set_probe(name, probe):
+    """Đặt hàm kiểm tra chủ động cho kênh và khởi động luồng probe"""
+    get_monitor(name).probe = probe
+    _ensure_probe_thread()
+
+
+def is_connected():
+    """Kết nối được nếu ít nhất một kênh đang hoạt động"""
+    return any(monitor.is_connected() for monitor in list(_monitors.values()))
+
+
+def get_health():
+    """Trạng thái đã lưu của tất cả các kênh (không gọi mạng)"""
+    return {name: monitor.status() for name, monitor in list(_monitors.items())}
+
+
+def _probe_loop():
+    while True:
+        for monitor in list(_monitors.values()):
+            try:
+                monitor.maybe_probe()
+            except Exception as e:
+                logger.error(f"Error probing {monitor.name}: {e}")
+        time.sleep(PROBE_CHECK_INTERVAL)
+
+
+def _ensure_probe_thread():
+    global _probe_thread
+    with _monitors_lock:
+        if _probe_thread is None:
+            _probe_thread = threading.Thread(target=_probe_loop, daemon=True)
+            _probe_thread.start()
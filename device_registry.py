@@ -0,0 +1,69 @@
+"""
+Danh sách các trạm (thiết bị ThingsBoard) được theo dõi.
+
+Thiết bị được khai báo qua biến môi trường THINGSBOARD_DEVICES dạng
+"id1:Tên trạm 1,id2:Tên trạm 2" hoặc tệp JSON (THINGSBOARD_DEVICES_FILE)
+chứa danh sách [{"id": ..., "name": ...}]. Thiết bị mặc định trong cấu hình
+của client ThingsBoard luôn được đăng ký.
+"""
+
+import os
+import json
+import threading
+import logging
+
+# Cấu hình logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('device_registry')
+
+DEVICES_FILE = os.environ.get(
+    'THINGSBOARD_DEVICES_FILE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'devices.json')
+)
+
+# Thiết bị theo thứ tự đăng ký: {device_id: {'id': ..., 'name': ...}}
+_devices = {}
+_lock = threading.Lock()
+
+
+def register_device(device_id, name=None):
+    """Thêm thiết bị vào danh sách (bỏ qua nếu đã có)"""
+    with _lock:
+        if device_id not in _devices:
+            _devices[device_id] = {'id': device_id, 'name': name or device_id}
+        return _devices[device_id]
+
+
+def get_devices():
+    """Danh sách các thiết bị đã đăng ký"""
+    with _lock:
+        return [dict(device) for device in _devices.values()]
+
+
+def get_device(device_id):
+    """Thông tin thiết bị, None nếu chưa đăng ký"""
+    with _lock:
+        device = _devices.get(device_id)
+        return dict(device) if device else None
+
+
+def load_devices():
+    """Đọc danh sách thiết bị từ biến môi trường và tệp cấu hình"""
+    for entry in os.environ.get('THINGSBOARD_DEVICES', '').split(','):
+        entry = entry.strip()
+        if entry:
+            device_id, _, name = entry.partition(':')
+            register_device(device_id.strip(), name.strip() or None)
+
+    if os.path.exists(DEVICES_FILE):
+        try:
+            with open(DEVICES_FILE, encoding='utf-8') as f:
+                for device in json.load(f):
+                    register_device(device['id'], device.get('name'))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Error loading devices from {DEVICES_FILE}: {e}")
+
+    logger.info(f"Registered {len(_devices)} devices")
+
+
+load_devices()
@@ -0,0 +1,124 @@
+"""
+Giảm số điểm dữ liệu lịch sử trước khi gửi cho client (downsampling).
+
+Các hàm làm việc trên mảng NumPy và trả về chỉ số các điểm được giữ lại
+(lttb, minmax) hoặc giá trị trung bình theo nhóm (avg), nên một khoảng 30 ngày
+có thể được vẽ từ vài trăm điểm mà vẫn giữ được các đỉnh.
+"""
+
+import numpy as np
+
+DOWNSAMPLING_METHODS = ('lttb', 'minmax', 'avg')
+
+
+def bucket_edges(length, buckets):
+    """Biên của các nhóm gần bằng nhau trên [0, length)"""
+    return np.linspace(0, length, buckets + 1).astype(np.int64)
+
+
+def lttb_indices(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets: chọn threshold điểm giữ hình dạng đường cong.
+    Điểm đầu và cuối luôn được giữ; mỗi nhóm ở giữa giữ điểm tạo tam giác lớn nhất
+    với điểm đã chọn ở nhóm trước và trung bình của nhóm sau.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    length = len(x)
+    if threshold >= length:
+        return np.arange(length)
+    if threshold < 3:
+        return np.array([0, length - 1][:max(threshold, 0)], dtype=np.int64)
+
+    # Chia các điểm giữa (bỏ điểm đầu, cuối) thành threshold - 2 nhóm
+    edges = bucket_edges(length - 2, threshold - 2) + 1
+    # Trung bình x, y của từng nhóm (tính một lần cho tất cả các nhóm)
+    counts = np.diff(edges)
+    mean_x = np.add.reduceat(x[1:length - 1], edges[:-1] - 1) / counts
+    mean_y = np.add.reduceat(y[1:length - 1], edges[:-1] - 1) / counts
+    # Nhóm cuối dùng điểm cuối cùng làm điểm "nhóm sau"
+    next_x = np.append(mean_x[1:], x[-1])
+    next_y = np.append(mean_y[1:], y[-1])
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = length - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        bx = x[start:end]
+        by = y[start:end]
+        # Diện tích (nhân 2) tam giác giữa điểm đã chọn, từng điểm trong nhóm và trung bình nhóm sau
+        area = np.abs((x[a] - next_x[i]) * (by - y[a]) - (x[a] - bx) * (next_y[i] - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def minmax_indices(y, threshold):
+    """Giữ điểm nhỏ nhất và lớn nhất của mỗi nhóm (threshold / 2 nhóm), bảo toàn các đỉnh"""
+    y = np.asarray(y, dtype=np.float64)
+    length = len(y)
+    if threshold >= length:
+        return np.arange(length)
+
+    buckets = max(1, threshold // 2)
+    size = -(-length // buckets)
+    padded_low = np.full(buckets * size, np.inf)
+    padded_high = np.full(buckets * size, -np.inf)
+    padded_low[:length] = y
+    padded_high[:length] = y
+
+    offsets = np.arange(buckets) * size
+    low = offsets + np.argmin(padded_low.reshape(buckets, size), axis=1)
+    high = offsets + np.argmax(padded_high.reshape(buckets, size), axis=1)
+    indices = np.unique(np.concatenate([low, high]))
+    return indices[indices < length]
+
+
+def avg_buckets(y, threshold):
+    """
+    Trung bình của threshold nhóm liên tiếp.
+    Trả về (chỉ số điểm đầu của mỗi nhóm, giá trị trung bình của nhóm).
+    """
+    y = np.asarray(y, dtype=np.float64)
+    length = len(y)
+    if threshold >= length:
+        return np.arange(length), y
+
+    edges = bucket_edges(length, threshold)
+    starts = edges[:-1]
+    return starts, np.add.reduceat(y, starts) / np.diff(edges)
+
+
+def downsample(values, threshold, method='lttb'):
+    """
+    Giảm mảng values (theo thứ tự thời gian, NaN = không có dữ liệu) xuống tối đa
+    threshold điểm. Các điểm không có giá trị bị bỏ qua. Trả về (chỉ số trong values
+    của các điểm được giữ, giá trị của chúng - trung bình nhóm với avg), hoặc None nếu
+    không cần giảm.
+    """
+    if method not in DOWNSAMPLING_METHODS:
+        raise ValueError(f"Unknown downsampling method: {method}")
+    values = np.asarray(values, dtype=np.float64)
+    length = len(values)
+    if threshold is None or threshold <= 0 or length <= threshold:
+        return None
+
+    valid = ~np.isnan(values)
+    if np.count_nonzero(valid) <= threshold:
+        # Không đủ dữ liệu thực, lấy mẫu đều theo vị trí
+        indices = np.unique(bucket_edges(length - 1, threshold - 1)) if threshold > 1 else np.array([0])
+        return indices, values[indices]
+
+    positions = np.flatnonzero(valid)
+    valid_values = values[valid]
+    if method == 'lttb':
+        # Dữ liệu được lấy mẫu gần đều nên dùng vị trí làm trục x
+        indices = lttb_indices(np.arange(len(valid_values)), valid_values, threshold)
+    elif method == 'minmax':
+        indices = minmax_indices(valid_values, threshold)
+    else:
+        starts, means = avg_buckets(valid_values, threshold)
+        return positions[starts], np.array([round(mean, 2) for mean in means.tolist()])
+    return positions[indices], valid_values[indices]
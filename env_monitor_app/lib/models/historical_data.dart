@@ -41,6 +41,16 @@ class HistoricalDataPoint {
     );
   }
   
+  // Một điểm từ dữ liệu dạng cột (ts là epoch mili giây)
+  factory HistoricalDataPoint.fromEpoch(int ts, num value) {
+    final time = DateTime.fromMillisecondsSinceEpoch(ts);
+    return HistoricalDataPoint(
+      value: value.toDouble(),
+      timestamp: '${time.hour.toString().padLeft(2, '0')}:${time.minute.toString().padLeft(2, '0')}',
+      status: 'normal',
+    );
+  }
+  
   Map<String, dynamic> toJson() {
     return {
       'value': value,
@@ -63,4 +73,32 @@ HistoricalData parseHistoricalData(Map<String, dynamic> json) {
   });
   
   return HistoricalData(data: data);
-}
\ No newline at end of file
+}
+
+// Phân tích một chuỗi dạng cột {"ts": [...], "v": [...]} (format=columnar),
+// bỏ qua các điểm không có giá trị (null)
+List<HistoricalDataPoint> parseColumnarSeries(Map<String, dynamic> json) {
+  final ts = json['ts'] as List;
+  final values = json['v'] as List;
+  final points = <HistoricalDataPoint>[];
+  for (var i = 0; i < ts.length; i++) {
+    final value = values[i];
+    if (value != null) {
+      points.add(HistoricalDataPoint.fromEpoch((ts[i] as num).toInt(), value as num));
+    }
+  }
+  return points;
+}
+
+// Hàm phân tích dữ liệu lịch sử dạng cột từ API
+HistoricalData parseColumnarHistoricalData(Map<String, dynamic> json) {
+  final Map<String, List<HistoricalDataPoint>> data = {};
+  
+  json.forEach((key, value) {
+    if (value is Map<String, dynamic>) {
+      data[key] = parseColumnarSeries(value);
+    }
+  });
+  
+  return HistoricalData(data: data);
+}
@@ -29,14 +29,14 @@ class ApiService {
     }
   }
 
-  /// Lấy dữ liệu lịch sử từ server
+  /// Lấy dữ liệu lịch sử từ server (dạng cột: {"ts": [...], "v": [...]} cho mỗi thông số)
   Future<HistoricalData> getHistoricalData({int hours = 1}) async {
     final response = await http.get(
-      Uri.parse('$baseUrl/api/historical${hours > 1 ? "?hours=$hours" : ""}')
+      Uri.parse('$baseUrl/api/historical?hours=$hours&format=columnar')
     );
     
     if (response.statusCode == 200) {
-      return parseHistoricalData(jsonDecode(response.body));
+      return parseColumnarHistoricalData(jsonDecode(response.body));
     } else {
       throw Exception('Failed to load historical data');
     }
@@ -48,14 +48,11 @@ class ApiService {
     int hours = 1,
   }) async {
     final response = await http.get(
-      Uri.parse('$baseUrl/api/historical/$paramName${hours > 1 ? "?hours=$hours" : ""}')
+      Uri.parse('$baseUrl/api/historical/$paramName?hours=$hours&format=columnar')
     );
     
     if (response.statusCode == 200) {
-      final data = jsonDecode(response.body) as List;
-      return data
-          .map((item) => HistoricalDataPoint.fromJson(item as Map<String, dynamic>))
-          .toList();
+      return parseColumnarSeries(jsonDecode(response.body) as Map<String, dynamic>);
     } else {
       throw Exception('Failed to load parameter historical data');
     }
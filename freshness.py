@@ -0,0 +1,122 @@
+"""
+Đo độ trễ của dữ liệu trên toàn bộ đường đi: thời điểm đo của cảm biến (ts) →
+tải xong từ ThingsBoard (HTTP hoặc MQTT) → ghi vào cache → gửi qua Socket.IO →
+client xác nhận đã hiển thị.
+
+Mỗi mẫu dữ liệu được nhận diện bằng ts của cảm biến (last_data_timestamp). Thời
+điểm qua từng giai đoạn được ghi lại lần đầu tiên mẫu đó đi qua, nên các lần polling
+lặp lại dữ liệu cũ không làm sai kết quả. Số liệu được xuất qua /metrics:
+    data_freshness_stage_seconds{stage}   độ trễ của từng giai đoạn
+        ingest    ts cảm biến → tải xong (gồm cả thời gian ThingsBoard tiếp nhận)
+        cache     tải xong → ghi cache
+        emit      ghi cache → gửi qua Socket.IO (chờ vòng lặp send_updates)
+        delivery  gửi → nhận xác nhận của client (gồm đường về của xác nhận)
+    data_freshness_age_seconds{point}     tuổi của dữ liệu (tính từ ts cảm biến) tại mỗi điểm
+    data_freshness_slo_breaches_total{point}  số lần tuổi dữ liệu vượt FRESHNESS_SLO
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import metrics
+
+# Mục tiêu thời gian thực: tuổi tối đa của dữ liệu khi tới client (giây)
+FRESHNESS_SLO = float(os.environ.get('FRESHNESS_SLO_SECONDS', 10))
+# Tỷ lệ bản tin client gửi xác nhận (gửi kèm keyframe để client tự lấy mẫu)
+ACK_SAMPLE_RATE = float(os.environ.get('FRESHNESS_ACK_RATE', 0.1))
+# Số mẫu dữ liệu / số bản tin gần nhất được theo dõi
+MAX_TRACKED = 256
+
+_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 60, 120, 300)
+
+_stage_lag = metrics.histogram(
+    'data_freshness_stage_seconds', 'Lag added by each stage between sensor and client', ('stage', 'source'),
+    buckets=_BUCKETS
+)
+_age = metrics.histogram(
+    'data_freshness_age_seconds', 'Age of data since the sensor timestamp at each point', ('point', 'source'),
+    buckets=_BUCKETS
+)
+_slo_breaches = metrics.counter(
+    'data_freshness_slo_breaches_total', 'Data older than the freshness SLO when emitted or acknowledged',
+    ('point',)
+)
+for _point in ('emitted', 'acked'):
+    _slo_breaches.inc(0, point=_point)
+
+# ts cảm biến (ms) -> {'source', 'fetched', 'cached', 'emitted'}
+_samples = OrderedDict()
+# seq của bản tin -> (ts cảm biến, thời điểm gửi, nguồn)
+_emits = OrderedDict()
+_lock = threading.Lock()
+
+
+def _remember(store, key, value):
+    store[key] = value
+    while len(store) > MAX_TRACKED:
+        store.popitem(last=False)
+
+
+def _observe_age(point, sensor_ts, now, source):
+    age = max(0.0, now - sensor_ts / 1000)
+    _age.observe(age, point=point, source=source)
+    if point in ('emitted', 'acked') and age > FRESHNESS_SLO:
+        _slo_breaches.inc(point=point)
+
+
+def record_fetch(sensor_ts, source, fetched_at=None):
+    """Mẫu dữ liệu có ts cảm biến sensor_ts (ms) vừa được tải về từ source ('http', 'mqtt')"""
+    if sensor_ts is None:
+        return
+    now = fetched_at or time.time()
+    with _lock:
+        if sensor_ts in _samples:
+            return
+        _remember(_samples, sensor_ts, {'source': source, 'fetched': now, 'cached': None, 'emitted': None})
+    _stage_lag.observe(max(0.0, now - sensor_ts / 1000), stage='ingest', source=source)
+    _observe_age('fetched', sensor_ts, now, source)
+
+
+def record_cache_write(sensor_ts, cached_at=None):
+    """Mẫu dữ liệu đã được ghi vào cache (hoặc bộ đệm MQTT) và sẵn sàng để gửi"""
+    if sensor_ts is None:
+        return
+    now = cached_at or time.time()
+    with _lock:
+        sample = _samples.get(sensor_ts)
+        if sample is None or sample['cached'] is not None:
+            return
+        sample['cached'] = now
+    _stage_lag.observe(max(0.0, now - sample['fetched']), stage='cache', source=sample['source'])
+    _observe_age('cached', sensor_ts, now, sample['source'])
+
+
+def record_emit(sensor_ts, seq, emitted_at=None):
+    """Bản tin seq chứa dữ liệu có ts cảm biến sensor_ts vừa được gửi qua Socket.IO"""
+    if sensor_ts is None:
+        return
+    now = emitted_at or time.time()
+    with _lock:
+        sample = _samples.get(sensor_ts)
+        source = sample['source'] if sample is not None else 'unknown'
+        _remember(_emits, seq, (sensor_ts, now, source))
+        if sample is None or sample['emitted'] is not None:
+            return
+        sample['emitted'] = now
+    ready = sample['cached'] or sample['fetched']
+    _stage_lag.observe(max(0.0, now - ready), stage='emit', source=source)
+    _observe_age('emitted', sensor_ts, now, source)
+
+
+def record_ack(seq, acked_at=None):
+    """Client xác nhận đã nhận và hiển thị bản tin seq"""
+    now = acked_at or time.time()
+    with _lock:
+        emit = _emits.get(seq)
+    if emit is None:
+        return
+    sensor_ts, emitted_at, source = emit
+    _stage_lag.observe(max(0.0, now - emitted_at), stage='delivery', source=source)
+    _observe_age('acked', sensor_ts, now, source)
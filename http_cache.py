@@ -0,0 +1,173 @@
+"""
+Conditional GET và nén cho các API JSON được client gọi lặp lại (/api/current, /api/historical).
+
+Mỗi phản hồi được gắn với đối tượng dữ liệu trong cache tạo ra nó (cùng một đối tượng
+= cùng một thế hệ cache). Lần đầu gặp một thế hệ mới, nội dung được tạo một lần và
+ETag mạnh được tính từ nội dung đó; các bản nén gzip/brotli được tạo khi có client
+cần lần đầu rồi giữ lại cho tới khi cache được làm mới. Như vậy việc tạo JSON và nén
+chỉ chạy một lần cho mỗi lần làm mới, không phải một lần cho mỗi client.
+
+Client gửi If-None-Match (hoặc If-Modified-Since) khớp với thế hệ hiện tại nhận 304
+không có nội dung. Brotli chỉ được dùng khi đã cài gói brotli.
+"""
+
+import gzip
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import Response, request
+from werkzeug.http import http_date
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # Gói tùy chọn, không có thì chỉ dùng gzip
+    brotli = None
+
+# Phản hồi nhỏ hơn ngưỡng này (byte) không được nén
+MIN_COMPRESS_SIZE = 512
+GZIP_LEVEL = 6
+# Mức nén brotli (11 quá chậm với dữ liệu lịch sử vài MB)
+BROTLI_QUALITY = 5
+# Giới hạn số phản hồi và tổng dung lượng (byte) được giữ lại
+MAX_ENTRIES = 256
+MAX_BYTES = 64 * 1024 * 1024
+
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+_responses = metrics.counter(
+    'http_response_cache_total', 'Cached API responses: served from cache, rendered, or answered with 304',
+    ('result',)
+)
+_compressions = metrics.counter(
+    'http_response_compressions_total', 'Response bodies compressed (once per cache generation)', ('encoding',)
+)
+
+
+class _Entry:
+    __slots__ = ('key', 'source', 'etag', 'modified', 'bodies', 'size')
+
+    def __init__(self, key, source, body):
+        self.key = key
+        self.source = source
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        # Thời điểm theo giây nguyên (độ chính xác của Last-Modified)
+        self.modified = int(time.time())
+        self.bodies = {'identity': body}
+        self.size = len(body)
+
+
+# khóa phản hồi -> _Entry, theo thứ tự dùng gần nhất
+_entries = OrderedDict()
+_total_bytes = 0
+_lock = threading.Lock()
+
+
+def _compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def _store(entry):
+    global _total_bytes
+    with _lock:
+        previous = _entries.pop(entry.key, None)
+        if previous is not None:
+            _total_bytes -= previous.size
+        _entries[entry.key] = entry
+        _total_bytes += entry.size
+        while _entries and (len(_entries) > MAX_ENTRIES or _total_bytes > MAX_BYTES):
+            _, evicted = _entries.popitem(last=False)
+            _total_bytes -= evicted.size
+
+
+def _add_body(entry, encoding, body):
+    global _total_bytes
+    with _lock:
+        if encoding not in entry.bodies:
+            entry.bodies[encoding] = body
+            entry.size += len(body)
+            if _entries.get(entry.key) is entry:
+                _total_bytes += len(body)
+
+
+def _get_entry(key, source, render):
+    """Phản hồi của thế hệ cache source, tạo mới (render) nếu chưa có"""
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            _entries.move_to_end(key)
+    if entry is not None and entry.source is source:
+        _responses.inc(result='hit')
+        return entry
+
+    body = render()
+    new_entry = _Entry(key, source, body)
+    if entry is not None and entry.etag == new_entry.etag:
+        # Dữ liệu mới nhưng nội dung không đổi: giữ ETag, Last-Modified và các bản nén
+        entry.source = source
+        _responses.inc(result='hit')
+        return entry
+    _store(new_entry)
+    _responses.inc(result='render')
+    return new_entry
+
+
+def _etag(entry, encoding):
+    """ETag mạnh của một bản mã hóa (mỗi content-coding là một biểu diễn khác nhau)"""
+    if encoding == 'identity':
+        return f'"{entry.etag}"'
+    return f'"{entry.etag}-{encoding}"'
+
+
+def _not_modified(entry):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        # So sánh yếu theo RFC 9110 (bỏ tiền tố W/); client có thể đang giữ bất kỳ bản mã hóa nào
+        tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+        return '*' in tags or any(_etag(entry, encoding) in tags for encoding in ('identity',) + ENCODINGS)
+    modified_since = request.if_modified_since
+    return modified_since is not None and entry.modified <= modified_since.timestamp()
+
+
+def respond(key, source, render, mimetype='application/json'):
+    """
+    Phản hồi cho dữ liệu source (đối tượng trong cache) theo khóa key (đường dẫn và
+    tham số truy vấn). render() trả về nội dung (bytes) và chỉ được gọi khi source là
+    một thế hệ mới. Trả về 304 nếu client đã có phiên bản này, nếu không trả về nội
+    dung đã nén theo Accept-Encoding.
+    """
+    entry = _get_entry(key, source, render)
+
+    encoding = 'identity'
+    if len(entry.bodies['identity']) >= MIN_COMPRESS_SIZE:
+        encoding = request.accept_encodings.best_match(ENCODINGS, default='identity')
+
+    if _not_modified(entry):
+        _responses.inc(result='not_modified')
+        response = Response(status=304)
+    else:
+        body = entry.bodies.get(encoding)
+        if body is None:
+            body = _compress(entry.bodies['identity'], encoding)
+            _compressions.inc(encoding=encoding)
+            _add_body(entry, encoding, body)
+        response = Response(body, mimetype=mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+
+    response.headers['ETag'] = _etag(entry, encoding)
+    response.headers['Last-Modified'] = http_date(entry.modified)
+    # Trình duyệt luôn hỏi lại server (kèm If-None-Match) thay vì dùng bản cũ
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def request_key():
+    """Khóa phản hồi mặc định: đường dẫn và các tham số truy vấn (không phụ thuộc thứ tự)"""
+    return request.path, tuple(sorted(request.args.items(multi=True)))
@@ -0,0 +1,216 @@
+"""
+Số liệu vận hành theo định dạng văn bản của Prometheus (endpoint /metrics).
+
+Các nơi ghi số liệu (request tới ThingsBoard, cache, vòng lặp gửi dữ liệu, Socket.IO,
+route Flask) chỉ thêm một bản ghi vào hàng đợi dùng chung (deque.append là thao tác
+nguyên tử), không khóa và không gọi mạng. Các bản ghi được cộng dồn vào số liệu khi
+/metrics được đọc, hoặc khi hàng đợi quá dài (nếu không có luồng nào khác đang làm việc đó).
+"""
+
+import time
+import threading
+import logging
+from bisect import bisect_left
+from collections import deque
+
+# Cấu hình logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('metrics')
+
+# Ngưỡng (giây) mặc định của histogram độ trễ
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Số bản ghi chờ tối đa trước khi nơi ghi tự cộng dồn
+DRAIN_THRESHOLD = 10000
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Bản ghi chờ cộng dồn: (metric, giá trị nhãn, giá trị)
+_events = deque()
+_drain_lock = threading.Lock()
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _record(self, labels, value):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        _events.append((self, key, value))
+        if len(_events) > DRAIN_THRESHOLD:
+            _drain(blocking=False)
+
+    def _apply(self, key, value):
+        raise NotImplementedError
+
+    def _samples(self):
+        """Các dòng (hậu tố tên, nhãn, giá trị) của số liệu"""
+        for key, value in self._values.items():
+            yield '', dict(zip(self.labelnames, key)), value
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self._record(labels, amount)
+
+    def _apply(self, key, value):
+        self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        self._record(labels, ('set', value))
+
+    def inc(self, amount=1, **labels):
+        self._record(labels, ('add', amount))
+
+    def dec(self, amount=1, **labels):
+        self._record(labels, ('add', -amount))
+
+    def set_function(self, function):
+        """Giá trị được tính bằng function() khi đọc /metrics (chỉ cho gauge không có nhãn)"""
+        self._function = function
+
+    def _apply(self, key, value):
+        op, amount = value
+        self._values[key] = amount if op == 'set' else self._values.get(key, 0) + amount
+
+    def _samples(self):
+        if self._function is not None:
+            try:
+                yield '', {}, self._function()
+            except Exception as e:
+                logger.error(f"Error reading gauge {self.name}: {e}")
+            return
+        yield from super()._samples()
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        self._record(labels, value)
+
+    def time(self, **labels):
+        """Context manager đo thời gian thực thi của khối lệnh"""
+        return _Timer(self, labels)
+
+    def _apply(self, key, value):
+        state = self._values.get(key)
+        if state is None:
+            # Số lần theo từng bucket (bucket cuối là +Inf), tổng và số lần quan sát
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def _samples(self):
+        for key, (counts, total, count) in self._values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield '_bucket', dict(labels, le=_format_value(bound)), cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, count
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._started, **self._labels)
+
+
+def _get_or_create(cls, name, documentation, labelnames, **kwargs):
+    """Số liệu theo tên (tạo khi cần lần đầu), một module có thể được import lại mà không đăng ký trùng"""
+    metric = _registry.get(name)
+    if metric is None:
+        with _registry_lock:
+            metric = _registry.get(name)
+            if metric is None:
+                metric = _registry[name] = cls(name, documentation, labelnames, **kwargs)
+    if not isinstance(metric, cls):
+        raise ValueError(f"Metric {name} already registered as {metric.type}")
+    return metric
+
+
+def counter(name, documentation, labelnames=()):
+    return _get_or_create(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return _get_or_create(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+def _drain(blocking=True):
+    """Cộng dồn các bản ghi đang chờ vào số liệu"""
+    if not _drain_lock.acquire(blocking=blocking):
+        return
+    try:
+        while True:
+            try:
+                metric, key, value = _events.popleft()
+            except IndexError:
+                break
+            metric._apply(key, value)
+    finally:
+        _drain_lock.release()
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render():
+    """Toàn bộ số liệu theo định dạng văn bản của Prometheus"""
+    _drain()
+    lines = []
+    with _drain_lock:
+        for name, metric in sorted(_registry.items()):
+            lines.append(f"# HELP {name} {_escape(metric.documentation)}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for suffix, labels, value in list(metric._samples()):
+                if value is None:
+                    continue
+                label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f"{name}{suffix}{{{label_text}}} {_format_value(value)}" if label_text
+                             else f"{name}{suffix} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
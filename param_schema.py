@@ -0,0 +1,176 @@
+"""
+Danh mục các tham số môi trường: tên, key trên ThingsBoard, đơn vị, phạm vi và ngưỡng.
+
+Đây là nguồn duy nhất cho các ngưỡng; PARAM_RANGES và PARAM_MAPPING của các module
+khác đều được tạo từ PARAMETERS. Khi import, danh mục được biên dịch thành các mảng
+NumPy theo thứ tự tham số (MIN, MAX, WARNING, DANGER) để classify() xác định trạng
+thái của nhiều giá trị (nhiều tham số, nhiều thời điểm) trong một phép tính.
+
+Dữ liệu lịch sử trong bộ nhớ được giữ dưới dạng Series (hai mảng ts / giá trị), chỉ
+chuyển sang danh sách {"timestamp", "value"} khi trả về cho client (to_json).
+"""
+
+import time
+import random
+from collections import namedtuple
+
+import numpy as np
+
+import downsampling
+
+Parameter = namedtuple('Parameter', 'name tb_key unit min max warning danger')
+
+PARAMETERS = (
+    Parameter('pm10', 'PM10', 'μg/m³', 0, 150, 50, 100),
+    Parameter('pm25', 'PM2.5', 'μg/m³', 0, 75, 25, 50),
+    Parameter('temperature', 'Temperature', '°C', 15, 35, 30, 33),
+    Parameter('humidity', 'Humidity', '%', 20, 90, 70, 85),
+    Parameter('noise', 'Sound', 'dB', 30, 100, 70, 85),
+    Parameter('co', 'CO', 'ppm', 0, 50, 10.1, 17),
+    Parameter('co2', 'CO2', 'ppm', 300, 2000, 1000, 1500),
+    # AQI được tính từ các tham số khác, không có key trên ThingsBoard
+    Parameter('aqi', None, '', 0, 300, 100, 150),
+)
+
+# Mã trạng thái (chỉ số trong STATUS_LABELS)
+NORMAL, WARNING, DANGER, UNKNOWN = range(4)
+STATUS_LABELS = ('normal', 'warning', 'danger', 'unknown')
+
+# Biên dịch danh mục
+NAMES = tuple(p.name for p in PARAMETERS)
+INDEX = {name: i for i, name in enumerate(NAMES)}
+BY_NAME = {p.name: p for p in PARAMETERS}
+MIN = np.array([p.min for p in PARAMETERS], dtype=np.float64)
+MAX = np.array([p.max for p in PARAMETERS], dtype=np.float64)
+WARNING_THRESHOLDS = np.array([p.warning for p in PARAMETERS], dtype=np.float64)
+DANGER_THRESHOLDS = np.array([p.danger for p in PARAMETERS], dtype=np.float64)
+
+# Các tham số đo bởi cảm biến và ánh xạ key ThingsBoard -> tên trong ứng dụng
+SENSOR_PARAMS = tuple(p.name for p in PARAMETERS if p.tb_key is not None)
+PARAM_MAPPING = {p.tb_key: p.name for p in PARAMETERS if p.tb_key is not None}
+
+# Dạng dict (phạm vi, đơn vị, ngưỡng) cho template và các nơi gọi cũ
+PARAM_RANGES = {
+    p.name: {"min": p.min, "max": p.max, "unit": p.unit, "warning": p.warning, "danger": p.danger}
+    for p in PARAMETERS
+}
+
+# Ngưỡng dạng số Python cho status() (nhanh hơn truy cập mảng NumPy với một giá trị)
+_THRESHOLDS = {p.name: (p.warning, p.danger) for p in PARAMETERS}
+
+
+def classify(values, indices=None):
+    """
+    Mã trạng thái của values (mảng, cột cuối tương ứng với indices - mặc định tất cả
+    tham số theo thứ tự PARAMETERS). NaN cho mã UNKNOWN.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    warning = WARNING_THRESHOLDS if indices is None else WARNING_THRESHOLDS[indices]
+    danger = DANGER_THRESHOLDS if indices is None else DANGER_THRESHOLDS[indices]
+    codes = (values >= warning).astype(np.int8)
+    codes += values >= danger
+    codes[np.isnan(values)] = UNKNOWN
+    return codes
+
+
+def status(name, value):
+    """Trạng thái của một giá trị: 'danger', 'warning', 'normal' hoặc 'unknown' nếu không có giá trị"""
+    if value is None:
+        return 'unknown'
+    warning, danger = _THRESHOLDS[name]
+    if value >= danger:
+        return 'danger'
+    if value >= warning:
+        return 'warning'
+    return 'normal'
+
+
+def generate_value(name):
+    """Giá trị ngẫu nhiên trong phạm vi của tham số (dữ liệu giả)"""
+    param = BY_NAME[name]
+    return round(random.uniform(param.min, param.max), 1)
+
+
+def reading_json(name, value, status_label, timestamp, last_update=None):
+    """Một giá trị hiện tại theo định dạng gửi cho client"""
+    reading = {
+        "value": value,
+        "unit": BY_NAME[name].unit,
+        "status": status_label,
+        "timestamp": timestamp
+    }
+    if last_update is not None:
+        reading["last_update"] = last_update
+    return reading
+
+
+def missing_reading_json(name, last_data_ts=None):
+    """
+    Giá trị hiện tại của tham số chưa có dữ liệu. Thời gian là lần cập nhật gần nhất của
+    thiết bị (last_data_ts, mili giây), không phải giờ hiện tại, để dữ liệu không đổi
+    thì bản tin gửi cho client và ETag cũng không đổi
+    """
+    if last_data_ts is None:
+        timestamp = "--"
+    else:
+        timestamp = time.strftime("%H:%M:%S", time.localtime(last_data_ts / 1000))
+    reading = reading_json(name, None, 'unknown', timestamp)
+    reading["message"] = "Không có dữ liệu"
+    return reading
+
+
+class Series:
+    """
+    Chuỗi dữ liệu của một tham số: mảng ts (mili giây, int64) và giá trị (float64,
+    NaN = không có dữ liệu) theo thứ tự thời gian tăng dần.
+    """
+
+    __slots__ = ('ts', 'values')
+
+    def __init__(self, ts, values):
+        self.ts = np.asarray(ts, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.ts)
+
+    @classmethod
+    def from_points(cls, points):
+        """Tạo từ các cặp (ts, value), sắp xếp theo thời gian; value None được giữ dưới dạng NaN"""
+        points = sorted(points, key=lambda point: point[0])
+        ts = np.fromiter((point[0] for point in points), dtype=np.int64, count=len(points))
+        values = np.fromiter((np.nan if point[1] is None else float(point[1]) for point in points),
+                             dtype=np.float64, count=len(points))
+        return cls(ts, values)
+
+    @classmethod
+    def generated(cls, name, end_ts=None, count=60, step_ms=60000, empty=False):
+        """count điểm cách nhau step_ms kết thúc tại end_ts: giá trị ngẫu nhiên trong phạm vi, hoặc rỗng"""
+        end_ts = int(time.time() * 1000) if end_ts is None else end_ts
+        ts = end_ts - step_ms * np.arange(count - 1, -1, -1, dtype=np.int64)
+        if empty:
+            return cls(ts, np.full(count, np.nan))
+        return cls(ts, [generate_value(name) for _ in range(count)])
+
+    def downsample(self, threshold, method='lttb'):
+        """
+        Giảm xuống tối đa threshold điểm (xem downsampling.downsample).
+        Các điểm không có giá trị bị bỏ qua.
+        """
+        result = downsampling.downsample(self.values, threshold, method)
+        if result is None:
+            return self
+        indices, values = result
+        return Series(self.ts[indices], values)
+
+    def to_json(self):
+        """Danh sách {"timestamp": "HH:MM", "value"} gửi cho client (mỗi phút chỉ định dạng một lần)"""
+        if not len(self.ts):
+            return []
+        minutes, inverse = np.unique(self.ts // 60000, return_inverse=True)
+        labels = [time.strftime("%H:%M", time.localtime(minute * 60)) for minute in minutes.tolist()]
+        return [
+            {"timestamp": labels[i], "value": None if value != value else value}
+            for i, value in zip(inverse.tolist(), self.values.tolist())
+        ]
+
@@ -0,0 +1,81 @@
+"""
+Bộ đệm vòng (ring buffer) có kích thước cố định để lưu lịch sử telemetry trong bộ nhớ.
+
+Timestamp (mili giây) được lưu trong mảng int64 và giá trị trong mảng float64.
+Mỗi điểm được ghi hai lần (vị trí i và i + capacity) nên mọi đoạn liên tiếp
+không dài hơn capacity luôn là một lát cắt liền mạch của mảng, cho phép trả về
+view (không sao chép) cho "N điểm cuối" hoặc một khoảng thời gian.
+"""
+
+import os
+import numpy as np
+
+# Số điểm tối đa cho mỗi tham số (mặc định 24 giờ dữ liệu 5 giây/lần)
+DEFAULT_CAPACITY = int(os.environ.get('TELEMETRY_HISTORY_CAPACITY', 24 * 60 * 60 // 5))
+
+
+class TelemetryRingBuffer:
+    """
+    Bộ đệm vòng cho một tham số: thêm điểm O(1), đọc dữ liệu dạng view không sao chép.
+    Các điểm cần được thêm theo thứ tự thời gian tăng dần.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self._ts = np.zeros(2 * capacity, dtype=np.int64)
+        self._values = np.zeros(2 * capacity, dtype=np.float64)
+        self._next = 0  # Vị trí ghi tiếp theo trong [0, capacity)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, ts, value):
+        """Thêm một điểm dữ liệu (ts tính bằng mili giây)"""
+        i = self._next
+        self._ts[i] = self._ts[i + self.capacity] = ts
+        self._values[i] = self._values[i + self.capacity] = value
+        # Chỉ cập nhật vị trí sau khi đã ghi xong dữ liệu
+        self._next = (i + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    def _window(self):
+        """Lát cắt liền mạch chứa toàn bộ dữ liệu, từ cũ đến mới"""
+        count = self._count
+        start = self._next - count
+        if start < 0:
+            start += self.capacity
+        return start, start + count
+
+    def latest(self):
+        """Điểm dữ liệu mới nhất (ts, value), None nếu bộ đệm rỗng"""
+        if self._count == 0:
+            return None
+        i = self._next - 1 + (self.capacity if self._next == 0 else 0)
+        return int(self._ts[i]), float(self._values[i])
+
+    def last(self, n):
+        """View (timestamps, values) của n điểm mới nhất, theo thứ tự thời gian tăng dần"""
+        start, end = self._window()
+        start = max(start, end - max(0, n))
+        return self._ts[start:end], self._values[start:end]
+
+    def between(self, start_ts, end_ts=None):
+        """View (timestamps, values) của các điểm có start_ts <= ts <= end_ts"""
+        start, end = self._window()
+        ts = self._ts[start:end]
+        lo = int(np.searchsorted(ts, start_ts, side='left'))
+        hi = len(ts) if end_ts is None else int(np.searchsorted(ts, end_ts, side='right'))
+        return ts[lo:hi], self._values[start + lo:start + hi]
+
+    def items(self):
+        """View (timestamps, values) của toàn bộ dữ liệu"""
+        start, end = self._window()
+        return self._ts[start:end], self._values[start:end]
@@ -2,72 +2,348 @@ import os
 import time
 import threading
 import logging
-from app import app, socketio
+from flask import request
+from flask_socketio import join_room, leave_room
+from app import app, socketio, get_data_freshness
 import thingsboard_client as tb_jwt
+import thingsboard_mqtt_client as tb_mqtt
 import vn_aqi_calculator as aqi_calc
+import aqi_snapshot
+import param_schema
+import connection_health
+import metrics
+import tracing
+import freshness
 
 # Cấu hình logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('run')
 
+# Gửi toàn bộ dữ liệu (keyframe) ít nhất một lần trong khoảng thời gian này (giây),
+# giữa các keyframe chỉ gửi các tham số đã thay đổi (patch)
+KEYFRAME_INTERVAL = 60
+
+# Trạng thái của lần gửi gần nhất, dùng để tính phần thay đổi
+_broadcast_state = {'seq': 0, 'data': None, 'stale': None, 'keyframe_time': 0}
+_broadcast_lock = threading.Lock()
+
+# Room nhận toàn bộ dữ liệu (trang tổng quan); mỗi tham số có room riêng "param:<tên>"
+ROOM_ALL = 'all'
+# Số client đang đăng ký theo room, chỉ tạo dữ liệu cho các room có người nghe
+_room_members = {}
+_subscriptions = {}
+_subscription_lock = threading.Lock()
+
+# Chu kỳ của vòng lặp send_updates (giây)
+UPDATE_INTERVAL = 5
+
+_connected_clients = metrics.gauge('socketio_connected_clients', 'Socket.IO clients currently connected')
+_emit_duration = metrics.histogram(
+    'socketio_emit_duration_seconds', 'Time spent in socketio.emit per event', ('event',),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+)
+_loop_duration = metrics.histogram('send_updates_duration_seconds', 'Duration of one send_updates iteration')
+# Độ lệch giữa thời điểm bắt đầu thực tế và thời điểm dự kiến (lần trước + UPDATE_INTERVAL)
+_loop_drift = metrics.histogram('send_updates_drift_seconds', 'Delay of send_updates iterations past their schedule')
+
+def _aqi_from_readings(data):
+    """
+    Tính AQI tức thời từ dữ liệu cảm biến hiện tại, dùng khi chương trình tính VN_AQI không chạy
+    """
+    def value_of(param):
+        reading = data.get(param)
+        return reading.get('value') if isinstance(reading, dict) else None
+
+    co_ppm = value_of('co')
+    sensor_data = {
+        "pm25": value_of('pm25'),
+        "pm10": value_of('pm10'),
+        "co_mgm3": aqi_calc.convert_ppm_to_mgm3(co_ppm) if co_ppm is not None else None
+    }
+    aqi_value, iaqi_values = aqi_calc.calculate_vn_aqi(sensor_data)
+    aqi_status = aqi_calc.get_aqi_status(aqi_value) if aqi_value is not None else None
+    return aqi_value, aqi_status, iaqi_values
+
+def _add_aqi(data):
+    """
+    Tạo bản sao dữ liệu cảm biến kèm chỉ số AQI (bỏ CO2) để gửi tới client
+    """
+    # Không sửa trực tiếp dữ liệu trong cache của client ThingsBoard
+    data = dict(data)
+    
+    # Lấy dữ liệu AQI từ bộ nhớ dùng chung của chương trình tính VN_AQI
+    snapshot = aqi_snapshot.read_snapshot()
+    if snapshot is not None:
+        aqi_value, aqi_status = snapshot['aqi'], snapshot['status']
+        iaqi_values = snapshot['iaqi']
+        official_aqi, official_status = snapshot['official_aqi'], snapshot['official_status']
+    else:
+        # Chương trình tính VN_AQI không chạy, tính AQI tức thời từ dữ liệu hiện tại
+        aqi_value, aqi_status, iaqi_values = _aqi_from_readings(data)
+        official_aqi, official_status = None, "unknown"
+    
+    # Xóa CO2 nếu có
+    if 'co2' in data:
+        del data['co2']
+        
+    # Thêm AQI vào dữ liệu. Thời gian lấy theo lúc AQI được tính (hoặc ts của cảm biến)
+    # để dữ liệu không đổi thì bản tin cũng không đổi, không tạo patch ở mỗi lần gửi
+    if snapshot is not None:
+        computed_at = snapshot['timestamp']
+    elif data.get('last_data_timestamp') is not None:
+        computed_at = data['last_data_timestamp'] / 1000
+    else:
+        computed_at = None
+    timestamp = time.strftime("%H:%M:%S", time.localtime(computed_at))
+    
+    logger.debug(f"AQI value: {aqi_value}, status: {aqi_status}")
+    
+    if aqi_value is not None:
+        data['aqi'] = {
+            "value": aqi_value,
+            "unit": "",
+            "status": aqi_status if aqi_status else "unknown",
+            "timestamp": timestamp,
+            "iaqi": iaqi_values,
+            "official_value": official_aqi,
+            "official_status": official_status
+        }
+    else:
+        data['aqi'] = {
+            "value": None,
+            "unit": "",
+            "status": "unknown",
+            "timestamp": timestamp,
+            "message": "Không có dữ liệu",
+            "iaqi": iaqi_values,
+            "official_value": official_aqi,
+            "official_status": official_status
+        }
+    
+    return data
+
+def _keyframe_message():
+    return {
+        'type': 'keyframe',
+        'seq': _broadcast_state['seq'],
+        'data': _broadcast_state['data'],
+        'timestamp': time.time(),
+        'stale': _broadcast_state['stale'],
+        # Tỷ lệ bản tin client gửi lại freshness_ack (đo độ trễ tới client)
+        'ack_rate': freshness.ACK_SAMPLE_RATE
+    }
+
+def _param_room(param):
+    return f"param:{param}"
+
+def _parameter_message(param, reading, seq, timestamp, stale):
+    return {
+        'parameter': param,
+        'reading': reading,
+        'seq': seq,
+        'timestamp': timestamp,
+        'stale': stale
+    }
+
+def _rooms_with_members():
+    with _subscription_lock:
+        return {room for room, members in _room_members.items() if members}
+
+def broadcast_readings(data, stale):
+    """
+    Gửi dữ liệu tới các client đã đăng ký: room ROOM_ALL nhận keyframe (toàn bộ dữ liệu)
+    theo chu kỳ KEYFRAME_INTERVAL, còn lại chỉ nhận các tham số có giá trị, trạng thái
+    hoặc thời gian thay đổi; room của từng tham số chỉ nhận tham số đó khi nó thay đổi.
+    Mỗi lần gửi có số thứ tự (seq) tăng dần để client phát hiện bị mất patch.
+    """
+    with _broadcast_lock:
+        previous = _broadcast_state['data']
+        stale_changed = stale != _broadcast_state['stale']
+        now = time.time()
+
+        if previous is None or now - _broadcast_state['keyframe_time'] >= KEYFRAME_INTERVAL:
+            _broadcast_state['seq'] += 1
+            _broadcast_state['data'] = data
+            _broadcast_state['stale'] = stale
+            _broadcast_state['keyframe_time'] = now
+            message = _keyframe_message()
+            changed = data
+        else:
+            changed = {key: value for key, value in data.items() if previous.get(key) != value}
+            removed = [key for key in previous if key not in data]
+            if not changed and not removed and not stale_changed:
+                return
+            _broadcast_state['seq'] += 1
+            _broadcast_state['data'] = data
+            _broadcast_state['stale'] = stale
+            message = {
+                'type': 'patch',
+                'seq': _broadcast_state['seq'],
+                'data': changed,
+                'removed': removed,
+                'timestamp': now,
+                'stale': stale
+            }
+        seq = _broadcast_state['seq']
+
+    rooms = _rooms_with_members()
+    if rooms:
+        freshness.record_emit(data.get('last_data_timestamp'), seq, now)
+    if ROOM_ALL in rooms:
+        with tracing.span('emit', event='data_update'), _emit_duration.time(event='data_update'):
+            socketio.emit('data_update', message, to=ROOM_ALL)
+
+    # Mỗi room chỉ được tạo và mã hóa dữ liệu một lần, rồi gửi cho các client trong room
+    for param, reading in (data if stale_changed else changed).items():
+        room = _param_room(param)
+        if room in rooms:
+            with tracing.span('emit', event='parameter_update', room=room), \
+                    _emit_duration.time(event='parameter_update'):
+                socketio.emit('parameter_update', _parameter_message(param, reading, seq, now, stale), to=room)
+
+def _join(sid, room):
+    join_room(room)
+    with _subscription_lock:
+        _room_members.setdefault(room, set()).add(sid)
+        _subscriptions.setdefault(sid, set()).add(room)
+
+def _discard_member(room, sid):
+    # Xóa room không còn client nào để _room_members không lớn dần theo thời gian
+    members = _room_members.get(room)
+    if members is not None:
+        members.discard(sid)
+        if not members:
+            del _room_members[room]
+
+def _leave(sid, room):
+    leave_room(room)
+    with _subscription_lock:
+        _discard_member(room, sid)
+        _subscriptions.get(sid, set()).discard(room)
+
+@socketio.on('subscribe')
+def on_subscribe(message):
+    """
+    Đăng ký nhận dữ liệu: {'parameters': ['pm25', ...]} cho từng tham số,
+    hoặc {'parameters': ['all']} cho toàn bộ dữ liệu (trang tổng quan).
+    Dữ liệu hiện tại được gửi ngay cho client vừa đăng ký.
+    """
+    params = (message or {}).get('parameters') or []
+    sid = request.sid
+
+    with _broadcast_lock:
+        current = _broadcast_state['data']
+        keyframe = _keyframe_message() if current is not None else None
+        seq, stale = _broadcast_state['seq'], _broadcast_state['stale']
+
+    for param in params:
+        if param != ROOM_ALL and param not in param_schema.NAMES:
+            logger.debug(f"Ignoring subscription to unknown parameter: {param!r}")
+            continue
+        if param == ROOM_ALL:
+            _join(sid, ROOM_ALL)
+            if keyframe is not None:
+                socketio.emit('data_update', keyframe, to=sid)
+        else:
+            _join(sid, _param_room(param))
+            if current is not None and param in current:
+                socketio.emit('parameter_update',
+                              _parameter_message(param, current[param], seq, time.time(), stale), to=sid)
+
+@socketio.on('unsubscribe')
+def on_unsubscribe(message):
+    """Hủy đăng ký: {'parameters': ['pm25', ...]}"""
+    sid = request.sid
+    for param in (message or {}).get('parameters') or []:
+        if param != ROOM_ALL and param not in param_schema.NAMES:
+            continue
+        _leave(sid, ROOM_ALL if param == ROOM_ALL else _param_room(param))
+
+@socketio.on('connect')
+def on_connect(auth=None):
+    _connected_clients.inc()
+
+@socketio.on('disconnect')
+def on_disconnect(reason=None):
+    _connected_clients.dec()
+    sid = request.sid
+    with _subscription_lock:
+        for room in _subscriptions.pop(sid, set()):
+            _discard_member(room, sid)
+
+@socketio.on('request_keyframe')
+def on_request_keyframe():
+    """Client mới kết nối hoặc bị mất patch yêu cầu gửi lại toàn bộ dữ liệu"""
+    with _broadcast_lock:
+        if _broadcast_state['data'] is None:
+            return
+        message = _keyframe_message()
+    socketio.emit('data_update', message, to=request.sid)
+
+@socketio.on('freshness_ack')
+def on_freshness_ack(message):
+    """Client xác nhận đã hiển thị bản tin {'seq': ...} (chỉ một phần bản tin, theo ack_rate)"""
+    seq = (message or {}).get('seq')
+    if isinstance(seq, int):
+        freshness.record_ack(seq)
+
+def on_mqtt_telemetry(readings):
+    """
+    Đẩy dữ liệu telemetry nhận qua MQTT tới client ngay lập tức,
+    không phải chờ chu kỳ 5 giây của send_updates
+    """
+    broadcast_readings(_add_aqi(readings), False)
+
 # Hàm gửi dữ liệu cập nhật qua SocketIO
 def send_updates():
     """
     Gửi cập nhật dữ liệu theo thời gian thực qua SocketIO
     """
     print("Bắt đầu luồng cập nhật dữ liệu thời gian thực...")
+    last_tb_status = None
+    scheduled = time.monotonic()
     
     while True:
+        started = time.monotonic()
+        _loop_drift.observe(max(0.0, started - scheduled))
         try:
-            # Lấy dữ liệu hiện tại từ JWT client
-            data = tb_jwt.get_current_readings()
-            
-            # Lấy dữ liệu AQI từ tính toán VN_AQI
-            aqi_value, aqi_status = aqi_calc.get_current_aqi()
-            
-            # Xóa CO2 nếu có
-            if 'co2' in data:
-                del data['co2']
+            with tracing.trace('send_updates'):
+                # Ưu tiên dữ liệu MQTT, chỉ gọi JWT client (HTTP) khi không có kết nối MQTT
+                with tracing.span('get_mqtt_readings'):
+                    data = tb_mqtt.get_mqtt_readings()
+                if data is None:
+                    with tracing.span('get_current_readings'):
+                        data = tb_jwt.get_current_readings()
                 
-            # Thêm AQI vào dữ liệu
-            timestamp = time.strftime("%H:%M:%S")
-            
-            # Debug để xem giá trị AQI
-            print(f"DEBUG: AQI Value: {aqi_value}, Status: {aqi_status}")
-            
-            if aqi_value is not None:
-                data['aqi'] = {
-                    "value": aqi_value,
-                    "unit": "",
-                    "status": aqi_status if aqi_status else "unknown",
-                    "timestamp": timestamp
-                }
-            else:
-                data['aqi'] = {
-                    "value": None,
-                    "unit": "",
-                    "status": "unknown",
-                    "timestamp": timestamp,
-                    "message": "Không có dữ liệu"
-                }
+                # Gửi phần dữ liệu thay đổi qua SocketIO, kèm cờ đánh dấu dữ liệu đã quá cũ
+                with tracing.span('add_aqi'):
+                    data = _add_aqi(data)
+                with tracing.span('freshness'):
+                    stale = get_data_freshness('current')['stale']
+                with tracing.span('broadcast_readings'):
+                    broadcast_readings(data, stale)
             
-            # Gửi dữ liệu qua SocketIO
-            socketio.emit('data_update', {'data': data, 'timestamp': time.time()})
-            
-            # Kiểm tra trạng thái kết nối ThingsBoard
-            tb_status = tb_jwt.test_connection()   
-            socketio.emit('thingsboard_status', {'connected': tb_status})
-            
-            # Đợi 5 giây trước khi cập nhật tiếp
-            time.sleep(5)
+            # Trạng thái kết nối ThingsBoard lấy từ kết quả các request thực tế (không gọi mạng),
+            # chỉ gửi khi trạng thái thay đổi
+            tb_status = connection_health.is_connected()
+            if tb_status != last_tb_status:
+                socketio.emit('thingsboard_status', {'connected': tb_status, 'health': connection_health.get_health()})
+                last_tb_status = tb_status
         except Exception as e:
             logger.error(f"Lỗi khi gửi cập nhật: {str(e)}")
-            time.sleep(5)
+        
+        _loop_duration.observe(time.monotonic() - started)
+        # Đợi 5 giây trước khi cập nhật tiếp
+        scheduled = time.monotonic() + UPDATE_INTERVAL
+        time.sleep(UPDATE_INTERVAL)
 
 if __name__ == "__main__":
     # Đảm bảo chạy trên cổng 5000
     port = int(os.environ.get("PORT", 5000))
     
+    # Đẩy dữ liệu MQTT tới client ngay khi nhận được
+    tb_mqtt.add_telemetry_listener(on_mqtt_telemetry)
+    
     # Bắt đầu luồng cập nhật dữ liệu
     update_thread = threading.Thread(target=send_updates)
     update_thread.daemon = True
@@ -0,0 +1,147 @@
+"""
+Các định dạng trả về dữ liệu lịch sử ({tham số: Series}) cho client.
+
+    json      [{"timestamp": "HH:MM", "value": x}, ...] cho mỗi tham số (mặc định)
+    columnar  {"ts": [epoch ms, ...], "v": [x, ...]} cho mỗi tham số, null = không có dữ liệu
+    msgpack   như columnar nhưng mã hóa MessagePack (cần cài gói msgpack)
+    binary    mảng float64 little-endian, đọc trực tiếp bằng Float64Array / Float64List
+
+Định dạng được chọn bằng ?format= hoặc header Accept (xem negotiate).
+
+Bố cục của định dạng binary (mọi số nguyên là little-endian, các mảng bắt đầu ở
+vị trí chia hết cho 8):
+    4 byte   b'ATS1'
+    uint32   số chuỗi
+    với mỗi chuỗi:
+        uint32   số điểm n
+        uint16   độ dài tên (byte), tên UTF-8, thêm byte 0 cho đủ bội số của 8
+        float64[n]  ts (epoch ms)
+        float64[n]  giá trị (NaN = không có dữ liệu)
+"""
+
+import struct
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:  # Gói tùy chọn, chỉ cần cho format=msgpack
+    msgpack = None
+
+FORMATS = ('json', 'columnar', 'msgpack', 'binary')
+
+BINARY_MAGIC = b'ATS1'
+
+# Kiểu MIME trong header Accept tương ứng với từng định dạng
+MIMETYPES = {
+    'json': 'application/json',
+    'columnar': 'application/vnd.airtracking.columnar+json',
+    'msgpack': 'application/msgpack',
+    'binary': 'application/octet-stream'
+}
+_ACCEPT_ALIASES = {'application/x-msgpack': 'msgpack'}
+
+
+def available(fmt):
+    """Định dạng có dùng được trong môi trường hiện tại không"""
+    return fmt != 'msgpack' or msgpack is not None
+
+
+def negotiate(format_arg, accept_mimetypes):
+    """
+    Định dạng trả về: theo ?format= nếu có, nếu không theo header Accept
+    (werkzeug MIMEAccept), mặc định 'json'. Trả về None nếu ?format= không hợp lệ.
+    Theo header Accept chỉ chọn các định dạng dùng được (available), nếu không có
+    thì chọn định dạng được chấp nhận tiếp theo.
+    """
+    if format_arg is not None:
+        return format_arg if format_arg in FORMATS else None
+    candidates = [mimetype for fmt, mimetype in MIMETYPES.items() if available(fmt)]
+    candidates += [alias for alias, fmt in _ACCEPT_ALIASES.items() if available(fmt)]
+    best = accept_mimetypes.best_match(candidates, default=MIMETYPES['json'])
+    if best in _ACCEPT_ALIASES:
+        return _ACCEPT_ALIASES[best]
+    return next(fmt for fmt, mimetype in MIMETYPES.items() if mimetype == best)
+
+
+def content_type(fmt):
+    """Kiểu MIME của phản hồi (columnar được trả về như JSON thông thường)"""
+    return MIMETYPES['json'] if fmt == 'columnar' else MIMETYPES[fmt]
+
+
+def _columnar(series):
+    return {
+        "ts": series.ts.tolist(),
+        "v": [None if value != value else value for value in series.values.tolist()]
+    }
+
+
+def to_columnar(history):
+    """{tham số: {"ts": [...], "v": [...]}}"""
+    return {param: _columnar(series) for param, series in history.items()}
+
+
+def to_binary(history):
+    """Mã hóa {tham số: Series} theo bố cục binary ở đầu module"""
+    parts = [BINARY_MAGIC, struct.pack('<I', len(history))]
+    for param, series in history.items():
+        name = param.encode('utf-8')
+        header = struct.pack('<IH', len(series), len(name)) + name
+        parts.append(header + b'\0' * (-len(header) % 8))
+        parts.append(series.ts.astype('<f8').tobytes())
+        parts.append(series.values.astype('<f8').tobytes())
+    return b''.join(parts)
+
+
+def from_binary(data):
+    """Giải mã định dạng binary thành {tham số: (ts, giá trị)} (mảng NumPy)"""
+    if data[:4] != BINARY_MAGIC:
+        raise ValueError("Not an ATS1 payload")
+    (count,) = struct.unpack_from('<I', data, 4)
+    offset = 8
+    result = {}
+    for _ in range(count):
+        length, name_length = struct.unpack_from('<IH', data, offset)
+        name = data[offset + 6:offset + 6 + name_length].decode('utf-8')
+        offset += 6 + name_length
+        offset += -offset % 8
+        ts = np.frombuffer(data, dtype='<f8', count=length, offset=offset)
+        values = np.frombuffer(data, dtype='<f8', count=length, offset=offset + 8 * length)
+        result[name] = (ts.astype(np.int64), values)
+        offset += 16 * length
+    return result
+
+
+def _msgpack(data):
+    if msgpack is None:
+        raise ValueError("msgpack is not installed")
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def encode(history, fmt):
+    """
+    Mã hóa {tham số: Series} theo fmt. Trả về (dữ liệu, mimetype): dữ liệu là đối
+    tượng JSON (truyền cho jsonify) với json/columnar, hoặc bytes với msgpack/binary.
+    """
+    if fmt == 'json':
+        return {param: series.to_json() for param, series in history.items()}, MIMETYPES['json']
+    if fmt == 'columnar':
+        return to_columnar(history), content_type(fmt)
+    if fmt == 'msgpack':
+        return _msgpack(to_columnar(history)), MIMETYPES['msgpack']
+    if fmt == 'binary':
+        return to_binary(history), MIMETYPES['binary']
+    raise ValueError(f"Unknown format: {fmt}")
+
+
+def encode_series(param, series, fmt):
+    """Như encode cho một tham số: json/columnar/msgpack chứa trực tiếp dữ liệu của chuỗi"""
+    if fmt == 'json':
+        return series.to_json(), MIMETYPES['json']
+    if fmt == 'columnar':
+        return _columnar(series), content_type(fmt)
+    if fmt == 'msgpack':
+        return _msgpack(_columnar(series)), MIMETYPES['msgpack']
+    if fmt == 'binary':
+        return to_binary({param: series}), MIMETYPES['binary']
+    raise ValueError(f"Unknown format: {fmt}")
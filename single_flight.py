@@ -0,0 +1,66 @@
+"""
+Gộp các lời gọi trùng nhau (single-flight): với mỗi khóa chỉ có một lời gọi
+tới nguồn dữ liệu được thực hiện tại một thời điểm, các lời gọi đồng thời khác
+chờ và dùng chung kết quả của lời gọi đó.
+
+Dùng các primitive của threading nên hoạt động cả với thread thường và với
+greenlet của eventlet (sau khi eventlet.monkey_patch()).
+"""
+
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Gọi fn(*args, **kwargs) nếu chưa có lời gọi nào cho key đang chạy,
+        ngược lại chờ lời gọi đang chạy và trả về (hoặc ném lại lỗi của) nó
+        """
+        with self._lock:
+            stats = self._stats.setdefault(key, {'upstream': 0, 'coalesced': 0})
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                stats['upstream'] += 1
+            else:
+                stats['coalesced'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+    def get_stats(self):
+        """Số lời gọi thực tế (upstream) và số lời gọi được gộp (coalesced) theo khóa"""
+        with self._lock:
+            return {str(key): dict(stats) for key, stats in self._stats.items()}
@@ -0,0 +1,332 @@
+"""
+Kiểm tra tải Socket.IO: một tiến trình run.py (eventlet) phục vụ được bao nhiêu client
+trang tổng quan trước khi data_update bị trễ.
+
+Với mỗi kích thước payload và mỗi số client N, công cụ khởi động một tiến trình server
+dùng đúng đường gửi dữ liệu của run.py (broadcast_readings, room, patch/keyframe) với dữ
+liệu giả lập có kích thước cố định, mở N client Socket.IO (websocket) đăng ký room "all"
+và đo trong một khoảng thời gian:
+    - độ trễ từ lúc server tạo bản tin đến lúc client nhận (p50/p95/p99/max),
+    - số bản tin bị mất (khoảng trống trong seq) và số client không kết nối được,
+    - CPU của tiến trình server cho mỗi lần cập nhật (tick).
+Báo cáo (in ra và ghi JSON) cho biết số client tối đa của một tiến trình thỏa mãn
+ngưỡng độ trễ/mất bản tin, theo từng kích thước payload.
+
+Cách dùng:
+    python socketio_load.py                                     # mặc định 10..500 client, 0 và 100 tham số phụ
+    python socketio_load.py --clients 50,200,1000 --extra-params 0,50,500 --tick 1 --duration 20
+    python socketio_load.py --slo-ms 250 --max-drop 0.01 --output socketio_load_report.json
+
+Server và client chạy trên cùng máy (đồng hồ chung); dùng --client-procs để chia client
+ra nhiều tiến trình khi bản thân client trở thành nút thắt. Số client lớn có thể cần
+tăng giới hạn file descriptor (ulimit -n).
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import subprocess
+import multiprocessing
+from datetime import datetime
+
+import numpy as np
+
+# Ngưỡng mặc định để coi một số client là phục vụ được
+SLO_MS = 250
+MAX_DROP_RATIO = 0.01
+# Thời gian chờ các client kết nối trước khi bắt đầu đo (giây)
+CONNECT_TIMEOUT = 30
+
+
+def _cpu_seconds(pid):
+    """Tổng thời gian CPU (user + system) của tiến trình, None nếu không đọc được (chỉ Linux)"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Server: run.py với dữ liệu giả lập
+# ---------------------------------------------------------------------------
+
+def _synthetic_readings(tick, extra_params):
+    """Dữ liệu giống format_current_data, mọi giá trị thay đổi sau mỗi tick (patch lớn nhất)"""
+    now_ms = int(time.time() * 1000)
+    stamp = time.strftime("%H:%M:%S")
+    base = {'pm25': 30, 'pm10': 60, 'co': 8, 'co2': 600, 'temperature': 27, 'humidity': 65, 'noise': 55}
+    params = list(base) + [f'extra_{i}' for i in range(extra_params)]
+    readings = {
+        param: {
+            "value": round(base.get(param, 50) + (tick * 7 + i) % 10 * 0.1, 2),
+            "unit": "",
+            "status": "good",
+            "timestamp": stamp,
+            "last_update": now_ms
+        }
+        for i, param in enumerate(params)
+    }
+    readings['device_status'] = 'online'
+    readings['last_data_timestamp'] = now_ms
+    return readings
+
+
+def serve(port, tick_interval, extra_params):
+    """Chạy server Socket.IO của run.py, gửi dữ liệu giả lập mỗi tick_interval giây"""
+    os.environ.setdefault('THINGSBOARD_MQTT_AUTOCONNECT', '0')
+    os.environ.setdefault('TELEMETRY_DB_PATH', ':memory:')
+    import threading
+    import run
+
+    def drive():
+        tick = 0
+        while True:
+            tick += 1
+            run.broadcast_readings(run._add_aqi(_synthetic_readings(tick, extra_params)), False)
+            time.sleep(tick_interval)
+
+    threading.Thread(target=drive, daemon=True).start()
+    run.socketio.run(run.app, host='127.0.0.1', port=port, debug=False, use_reloader=False, log_output=False)
+
+
+# ---------------------------------------------------------------------------
+# Client: N kết nối Socket.IO trong một tiến trình (asyncio)
+# ---------------------------------------------------------------------------
+
+async def _client_session(url, start_at, end_at, stats):
+    import socketio
+
+    sio = socketio.AsyncClient(reconnection=False)
+    state = {'seq': None}
+
+    async def on_data_update(message):
+        received = time.time()
+        seq = message.get('seq')
+        if state['seq'] is not None and seq is not None and seq > state['seq'] + 1 and received >= start_at:
+            stats['dropped'] += seq - state['seq'] - 1
+        if seq is not None:
+            state['seq'] = seq
+        if start_at <= received <= end_at and message.get('timestamp') is not None:
+            stats['latencies'].append(received - message['timestamp'])
+            stats['received'] += 1
+            stats['seqs'].add(seq)
+            if stats['message_bytes'] is None:
+                stats['message_bytes'] = len(json.dumps(message))
+
+    sio.on('data_update', on_data_update)
+    try:
+        await asyncio.wait_for(sio.connect(url, transports=['websocket']), max(1, start_at - time.time()))
+        await sio.emit('subscribe', {'parameters': ['all']})
+        stats['connected'] += 1
+    except Exception:
+        stats['connect_errors'] += 1
+        return
+    try:
+        await asyncio.sleep(max(0, end_at - time.time()))
+        if not sio.connected:
+            stats['disconnects'] += 1
+    finally:
+        await sio.disconnect()
+
+
+def _run_clients(url, count, start_at, end_at):
+    """Tiến trình con: mở count client, trả về thống kê sau end_at"""
+    stats = {'latencies': [], 'received': 0, 'dropped': 0, 'seqs': set(), 'connected': 0,
+             'connect_errors': 0, 'disconnects': 0, 'message_bytes': None}
+
+    async def main():
+        await asyncio.gather(*[_client_session(url, start_at, end_at, stats) for _ in range(count)])
+
+    asyncio.run(main())
+    return stats
+
+
+# ---------------------------------------------------------------------------
+# Điều phối: mỗi (payload, N) một server mới
+# ---------------------------------------------------------------------------
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def measure_level(clients, extra_params, args):
+    """Đo một mức tải: khởi động server, kết nối clients client, thu thập thống kê"""
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), 'serve', '--port', str(port),
+         '--tick', str(args.tick), '--extra-params', str(extra_params)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        if not _wait_for_port(port):
+            raise RuntimeError(f"Server did not start on port {port}")
+
+        url = f'http://127.0.0.1:{port}'
+        start_at = time.time() + args.connect_timeout
+        end_at = start_at + args.duration
+        procs = max(1, min(args.client_procs, clients))
+        shares = [clients // procs + (1 if i < clients % procs else 0) for i in range(procs)]
+
+        with multiprocessing.Pool(procs) as pool:
+            pending = pool.starmap_async(_run_clients, [(url, share, start_at, end_at) for share in shares])
+            time.sleep(max(0, start_at - time.time()))
+            cpu_start = _cpu_seconds(server.pid)
+            time.sleep(max(0, end_at - time.time()))
+            cpu_end = _cpu_seconds(server.pid)
+            results = pending.get(timeout=args.connect_timeout + args.duration + 60)
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+    latencies = np.array([v for r in results for v in r['latencies']]) * 1000
+    seqs = set().union(*(r['seqs'] for r in results))
+    connected = sum(r['connected'] for r in results)
+    received = sum(r['received'] for r in results)
+    dropped = sum(r['dropped'] for r in results)
+    ticks = len(seqs)
+    cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+
+    return {
+        'clients': clients,
+        'extra_params': extra_params,
+        'connected': connected,
+        'connect_errors': sum(r['connect_errors'] for r in results),
+        'disconnects': sum(r['disconnects'] for r in results),
+        'message_bytes': next((r['message_bytes'] for r in results if r['message_bytes']), None),
+        'ticks': ticks,
+        'received': received,
+        'dropped': dropped,
+        'drop_ratio': round(dropped / (received + dropped), 4) if received + dropped else None,
+        'latency_ms': {
+            'p50': round(float(np.percentile(latencies, 50)), 2),
+            'p95': round(float(np.percentile(latencies, 95)), 2),
+            'p99': round(float(np.percentile(latencies, 99)), 2),
+            'max': round(float(latencies.max()), 2)
+        } if len(latencies) else None,
+        'server_cpu_percent': round(cpu / args.duration * 100, 1) if cpu is not None else None,
+        'server_cpu_ms_per_tick': round(cpu / ticks * 1000, 2) if cpu is not None and ticks else None
+    }
+
+
+def within_slo(result, slo_ms, max_drop):
+    """Mức tải đạt yêu cầu: mọi client kết nối được, nhận đủ bản tin, p95 dưới ngưỡng"""
+    return (
+        result['connect_errors'] == 0 and result['disconnects'] == 0
+        and result['latency_ms'] is not None and result['latency_ms']['p95'] <= slo_ms
+        and (result['drop_ratio'] or 0) <= max_drop
+    )
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Socket.IO fan-out load test for run.py')
+    subparsers = parser.add_subparsers(dest='command')
+
+    serve_parser = subparsers.add_parser('serve', help='run the server under test (used internally)')
+    serve_parser.add_argument('--port', type=int, default=5055)
+    serve_parser.add_argument('--tick', type=float, default=1.0)
+    serve_parser.add_argument('--extra-params', type=int, default=0)
+
+    parser.add_argument('--clients', type=_int_list, default=[10, 50, 100, 250, 500],
+                        help='comma-separated client counts to test')
+    parser.add_argument('--extra-params', type=_int_list, default=[0, 100],
+                        help='comma-separated numbers of extra parameters per update (payload size)')
+    parser.add_argument('--tick', type=float, default=1.0, help='seconds between server updates')
+    parser.add_argument('--duration', type=float, default=15.0, help='measurement seconds per level')
+    parser.add_argument('--connect-timeout', type=float, default=CONNECT_TIMEOUT,
+                        help='seconds allowed for clients to connect before measuring')
+    parser.add_argument('--client-procs', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help='processes used to run the clients')
+    parser.add_argument('--slo-ms', type=float, default=SLO_MS, help='p95 latency limit (ms)')
+    parser.add_argument('--max-drop', type=float, default=MAX_DROP_RATIO, help='allowed dropped update ratio')
+    parser.add_argument('--stop-on-breach', action='store_true',
+                        help='skip larger client counts once a level misses the limits')
+    parser.add_argument('--output', default='socketio_load_report.json', help='JSON report file')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.port, args.tick, args.extra_params)
+        return
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'tick': args.tick,
+            'duration': args.duration,
+            'client_procs': args.client_procs,
+            'slo_ms': args.slo_ms,
+            'max_drop': args.max_drop
+        },
+        'payloads': []
+    }
+
+    for extra_params in args.extra_params:
+        levels = []
+        for clients in sorted(args.clients):
+            result = measure_level(clients, extra_params, args)
+            result['within_slo'] = within_slo(result, args.slo_ms, args.max_drop)
+            levels.append(result)
+            latency = result['latency_ms'] or {}
+            print(f"extra={extra_params:<5d} clients={clients:<6d} bytes={result['message_bytes'] or 0:<7d} "
+                  f"p50={latency.get('p50', float('nan')):>8.1f}ms p95={latency.get('p95', float('nan')):>8.1f}ms "
+                  f"p99={latency.get('p99', float('nan')):>8.1f}ms dropped={result['dropped']:<5d} "
+                  f"errors={result['connect_errors']:<4d} cpu/tick={result['server_cpu_ms_per_tick']}ms "
+                  f"cpu={result['server_cpu_percent']}% {'OK' if result['within_slo'] else 'BREACH'}")
+            if args.stop_on_breach and not result['within_slo']:
+                break
+
+        # Số client lớn nhất mà nó và mọi mức nhỏ hơn đều đạt yêu cầu
+        ceiling = 0
+        for level in levels:
+            if not level['within_slo']:
+                break
+            ceiling = level['clients']
+        report['payloads'].append({
+            'extra_params': extra_params,
+            'message_bytes': next((level['message_bytes'] for level in levels if level['message_bytes']), None),
+            'client_ceiling': ceiling,
+            'levels': levels
+        })
+
+    print()
+    print(f"Client ceiling per process (p95 <= {args.slo_ms:g} ms, drop <= {args.max_drop:.1%}):")
+    for payload in report['payloads']:
+        print(f"  extra_params={payload['extra_params']:<5d} message ~{payload['message_bytes'] or 0} bytes: "
+              f"{payload['client_ceiling']} clients")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
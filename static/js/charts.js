@@ -63,6 +63,21 @@ function formatTimeForDisplay(timestamp) {
     return timestamp;
 }
 
+/**
+ * Tạo nhãn trục thời gian từ dữ liệu lịch sử dạng cột (format=columnar)
+ * @param {number[]} timestamps - Mảng epoch mili giây
+ * @returns {string[]} - "HH:MM", thêm ngày/tháng khi dữ liệu dài hơn một ngày
+ */
+function formatEpochLabels(timestamps) {
+    const spansDays = timestamps.length > 1 &&
+        timestamps[timestamps.length - 1] - timestamps[0] > 24 * 60 * 60 * 1000;
+    return timestamps.map(ts => {
+        const date = new Date(ts);
+        const time = `${String(date.getHours()).padStart(2, '0')}:${String(date.getMinutes()).padStart(2, '0')}`;
+        return spansDays ? `${date.getDate()}/${date.getMonth() + 1} ${time}` : time;
+    });
+}
+
 /**
  * Tạo các tùy chọn chuẩn cho biểu đồ
  * @param {string} title - Tiêu đề biểu đồ
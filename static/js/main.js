@@ -1,8 +1,32 @@
 document.addEventListener('DOMContentLoaded', function() {
-    // Thêm hàm cập nhật dữ liệu để có thể sử dụng từ Socket.IO
-    window.updateDataDisplay = function(data) {
-        renderDataCards(data);
+    // Dữ liệu hiện tại dựng từ keyframe và các patch nhận qua Socket.IO
+    let liveData = null;
+    let liveSeq = null;
+
+    // Thêm hàm cập nhật dữ liệu để có thể sử dụng từ Socket.IO.
+    // Nhận dữ liệu đầy đủ (từ /api/current) hoặc tin nhắn keyframe/patch có số thứ tự (seq).
+    // Trả về false nếu cần yêu cầu keyframe (chưa có dữ liệu gốc hoặc bị mất patch).
+    window.updateDataDisplay = function(update) {
+        if (update.seq === undefined) {
+            renderDataCards(update);
+            updateLastUpdated();
+            return true;
+        }
+
+        if (update.type === 'keyframe') {
+            liveData = Object.assign({}, update.data);
+        } else {
+            if (liveData === null || update.seq !== liveSeq + 1) {
+                return false;
+            }
+            Object.assign(liveData, update.data);
+            (update.removed || []).forEach(key => delete liveData[key]);
+        }
+        liveSeq = update.seq;
+
+        renderDataCards(liveData);
         updateLastUpdated();
+        return true;
     };
     // Kiểm tra trạng thái kết nối
     function updateOnlineStatus() {
@@ -318,12 +342,13 @@ document.addEventListener('DOMContentLoaded', function() {
     }
 
     function updateMainChart(parameter) {
-        fetch('/api/historical')
+        // Dạng cột: {ts: [...], v: [...]} cho mỗi tham số
+        fetch('/api/historical?points=500&format=columnar')
             .then(response => response.json())
             .then(data => {
                 const paramData = data[parameter];
-                const labels = paramData.map(point => point.timestamp);
-                const values = paramData.map(point => point.value);
+                const labels = formatEpochLabels(paramData.ts);
+                const values = paramData.v;
 
                 // Get the parameter unit from the current data
                 return fetch('/api/current')
@@ -0,0 +1,199 @@
+"""
+Kho lưu trữ telemetry cục bộ (SQLite, chế độ WAL).
+
+Mọi giá trị đọc được từ ThingsBoard (REST hoặc MQTT) được ghi vào bảng
+telemetry với khóa chính (device_id, key, ts), nên truy vấn theo khoảng thời gian
+cho một tham số chỉ là một lần quét chỉ mục. Bảng coverage ghi lại các khoảng thời
+gian đã được tải đầy đủ từ ThingsBoard, để chỉ phải tải bù những khoảng còn thiếu.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+import logging
+
+# Cấu hình logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('telemetry_store')
+
+DB_PATH = os.environ.get(
+    'TELEMETRY_DB_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telemetry.db')
+)
+
+# Thời gian lưu trữ dữ liệu (ngày)
+RETENTION_DAYS = int(os.environ.get('TELEMETRY_RETENTION_DAYS', 180))
+# Chu kỳ xóa dữ liệu quá hạn (giây)
+PRUNE_INTERVAL = 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS telemetry (
+    device_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (device_id, key, ts)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS series (
+    device_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (device_id, key)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS coverage (
+    device_id TEXT NOT NULL,
+    start_ts INTEGER NOT NULL,
+    end_ts INTEGER NOT NULL,
+    PRIMARY KEY (device_id, start_ts)
+) WITHOUT ROWID;
+"""
+
+_connection = None
+# SQLite connection được dùng chung, mọi truy cập đi qua khóa này
+_lock = threading.Lock()
+_last_prune = 0
+
+
+def _get_connection():
+    global _connection
+    if _connection is None:
+        connection = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(_SCHEMA)
+        _connection = connection
+        logger.info(f"Opened telemetry store at {DB_PATH}")
+    return _connection
+
+
+def _insert_rows(rows):
+    if not rows:
+        return 0
+    with _lock:
+        connection = _get_connection()
+        connection.execute("BEGIN")
+        connection.executemany(
+            "INSERT OR REPLACE INTO telemetry (device_id, key, ts, value) VALUES (?, ?, ?, ?)", rows
+        )
+        connection.executemany(
+            "INSERT OR IGNORE INTO series (device_id, key) VALUES (?, ?)",
+            {(row[0], row[1]) for row in rows}
+        )
+        connection.execute("COMMIT")
+    return len(rows)
+
+
+def insert_points(device_id, key, points):
+    """Ghi các điểm (ts, value) của một tham số, ghi đè nếu trùng timestamp"""
+    return _insert_rows([(device_id, key, int(ts), float(value)) for ts, value in points])
+
+
+def insert_telemetry(device_id, data):
+    """
+    Ghi dữ liệu theo định dạng của ThingsBoard API: {key: [{'ts': ..., 'value': ...}, ...]}.
+    Bỏ qua các giá trị không phải số.
+    """
+    rows = []
+    for key, items in data.items():
+        for item in items or []:
+            try:
+                rows.append((device_id, key, int(item['ts']), float(item['value'])))
+            except (KeyError, TypeError, ValueError):
+                continue
+    return _insert_rows(rows)
+
+
+def query_range(device_id, start_ts, end_ts, keys=None):
+    """
+    Đọc dữ liệu trong khoảng [start_ts, end_ts] (mili giây).
+    Trả về {key: [(ts, value), ...]} theo thứ tự thời gian tăng dần.
+    """
+    with _lock:
+        connection = _get_connection()
+        if keys is None:
+            keys = [row[0] for row in connection.execute(
+                "SELECT key FROM series WHERE device_id = ?", (device_id,)
+            )]
+        result = {}
+        for key in keys:
+            rows = connection.execute(
+                "SELECT ts, value FROM telemetry WHERE device_id = ? AND key = ? AND ts BETWEEN ? AND ? ORDER BY ts",
+                (device_id, key, start_ts, end_ts)
+            ).fetchall()
+            if rows:
+                result[key] = rows
+    return result
+
+
+def mark_covered(device_id, start_ts, end_ts):
+    """Ghi nhận khoảng [start_ts, end_ts] đã được tải đầy đủ từ ThingsBoard (gộp với các khoảng kề nhau)"""
+    with _lock:
+        connection = _get_connection()
+        connection.execute("BEGIN")
+        overlapping = connection.execute(
+            "SELECT start_ts, end_ts FROM coverage WHERE device_id = ? AND start_ts <= ? AND end_ts >= ?",
+            (device_id, end_ts + 1, start_ts - 1)
+        ).fetchall()
+        for range_start, range_end in overlapping:
+            start_ts = min(start_ts, range_start)
+            end_ts = max(end_ts, range_end)
+        connection.execute(
+            "DELETE FROM coverage WHERE device_id = ? AND start_ts <= ? AND end_ts >= ?",
+            (device_id, end_ts + 1, start_ts - 1)
+        )
+        connection.execute(
+            "INSERT INTO coverage (device_id, start_ts, end_ts) VALUES (?, ?, ?)",
+            (device_id, start_ts, end_ts)
+        )
+        connection.execute("COMMIT")
+    _maybe_prune()
+
+
+def missing_ranges(device_id, start_ts, end_ts):
+    """Các khoảng con của [start_ts, end_ts] chưa được tải từ ThingsBoard"""
+    with _lock:
+        covered = _get_connection().execute(
+            "SELECT start_ts, end_ts FROM coverage WHERE device_id = ? AND start_ts <= ? AND end_ts >= ? ORDER BY start_ts",
+            (device_id, end_ts, start_ts)
+        ).fetchall()
+
+    gaps = []
+    cursor = start_ts
+    for range_start, range_end in covered:
+        if range_start > cursor:
+            gaps.append((cursor, range_start - 1))
+        cursor = max(cursor, range_end + 1)
+    if cursor <= end_ts:
+        gaps.append((cursor, end_ts))
+    return gaps
+
+
+def prune(older_than_ts):
+    """Xóa dữ liệu và thông tin coverage cũ hơn older_than_ts (mili giây)"""
+    with _lock:
+        connection = _get_connection()
+        connection.execute("BEGIN")
+        deleted = 0
+        # Xóa theo từng chuỗi để dùng được khóa chính (device_id, key, ts)
+        for device_id, key in connection.execute("SELECT device_id, key FROM series").fetchall():
+            deleted += connection.execute(
+                "DELETE FROM telemetry WHERE device_id = ? AND key = ? AND ts < ?",
+                (device_id, key, older_than_ts)
+            ).rowcount
+        connection.execute("DELETE FROM coverage WHERE end_ts < ?", (older_than_ts,))
+        connection.execute("UPDATE coverage SET start_ts = ? WHERE start_ts < ?", (older_than_ts, older_than_ts))
+        connection.execute("COMMIT")
+    if deleted:
+        logger.info(f"Pruned {deleted} telemetry points older than {older_than_ts}")
+    return deleted
+
+
+def _maybe_prune():
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = now
+    prune(int((now - RETENTION_DAYS * 86400) * 1000))
@@ -0,0 +1,237 @@
+"""
+Client ThingsBoard dùng asyncio (aiohttp).
+
+Có cùng các hàm chính như thingsboard_client (get_current_readings,
+get_historical_data, test_connection) nhưng các request chạy đồng thời trên
+một event loop: giá trị mới nhất và lịch sử của từng tham số (lọc theo key)
+được tải song song thay vì lần lượt, không cần một thread cho mỗi request.
+
+SyncThingsBoardClient cho phép gọi từ code đồng bộ (Flask/eventlet): event loop
+chạy trong một thread nền và aiohttp session được dùng chung giữa các lần gọi.
+"""
+
+import time
+import asyncio
+import threading
+import logging
+
+import aiohttp
+
+import connection_health
+import telemetry_store
+import thingsboard_transport as tb_transport
+from thingsboard_client import (
+    THINGSBOARD_CONFIG, PARAM_MAPPING, DEFAULT_DEVICE_ID, HISTORY_FETCH_LIMIT, LATE_ARRIVAL_MS,
+    format_current_data, format_historical_data
+)
+
+# Cấu hình logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('thingsboard_async_client')
+
+
+class ThingsBoardError(Exception):
+    """Lỗi khi gọi ThingsBoard (HTTP lỗi hoặc không kết nối được)"""
+
+
+class AsyncThingsBoardClient:
+    def __init__(self, url=None, jwt_token=None, device_id=None,
+                 timeout=tb_transport.REQUEST_TIMEOUT, max_connections=tb_transport.POOL_MAXSIZE):
+        self.url = url or THINGSBOARD_CONFIG['url']
+        self.jwt_token = jwt_token or THINGSBOARD_CONFIG['jwt_token']
+        self.device_id = device_id or DEFAULT_DEVICE_ID
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._session = None
+        self._health = connection_health.get_monitor(tb_transport.HEALTH_MONITOR)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _get_session(self):
+        # Session (và connection pool) gắn với event loop đang chạy, tạo khi cần lần đầu
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={
+                    'X-Authorization': self.jwt_token,
+                    'Content-Type': 'application/json'
+                }
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _get_json(self, path, params=None):
+        started = time.monotonic()
+        try:
+            async with self._get_session().get(f"{self.url}{path}", params=params) as response:
+                if response.status != 200:
+                    text = await response.text()
+                    logger.error(f"HTTP error {response.status}: {text}")
+                    raise ThingsBoardError(f"HTTP error {response.status}")
+                data = await response.json(content_type=None)
+        except ThingsBoardError as e:
+            self._health.record_failure(e, time.monotonic() - started)
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._health.record_failure(e, time.monotonic() - started)
+            raise ThingsBoardError(str(e)) from e
+
+        self._health.record_success(time.monotonic() - started)
+        return data
+
+    async def fetch_latest(self, device_id=None):
+        """Giá trị mới nhất của tất cả tham số, theo định dạng của ThingsBoard API"""
+        device_id = device_id or self.device_id
+        return await self._get_json(f"/api/plugins/telemetry/DEVICE/{device_id}/values/timeseries")
+
+    async def _fetch_key_history(self, path, key, start_ts, end_ts):
+        """
+        Lịch sử của một key trong khoảng [start_ts, end_ts]. Nếu kết quả bị cắt bởi
+        limit, tiếp tục tải phần cũ hơn còn lại (như thingsboard_client._backfill_history).
+        """
+        items = []
+        while start_ts <= end_ts:
+            result = await self._get_json(path, {
+                'keys': key, 'startTs': start_ts, 'endTs': end_ts, 'limit': HISTORY_FETCH_LIMIT
+            })
+            page = result.get(key) or []
+            items.extend(page)
+            if len(page) < HISTORY_FETCH_LIMIT:
+                break
+            end_ts = min(item['ts'] for item in page) - 1
+        return {key: items} if items else {}
+
+    async def fetch_history(self, start_ts, end_ts, keys=None, device_id=None):
+        """
+        Lịch sử trong khoảng [start_ts, end_ts] (mili giây): mỗi tham số một chuỗi request,
+        các tham số được tải đồng thời. Trả về {key: [{'ts': ..., 'value': ...}, ...]}.
+        """
+        device_id = device_id or self.device_id
+        keys = list(keys or PARAM_MAPPING)
+        path = f"/api/plugins/telemetry/DEVICE/{device_id}/values/timeseries"
+
+        results = await asyncio.gather(*[
+            self._fetch_key_history(path, key, start_ts, end_ts)
+            for key in keys
+        ])
+
+        data = {}
+        for result in results:
+            data.update(result)
+        return data
+
+    async def get_current_readings(self, device_id=None):
+        """Dữ liệu hiện tại theo định dạng của ứng dụng"""
+        device_id = device_id or self.device_id
+        data = await self.fetch_latest(device_id)
+        _store(device_id, data)
+        return format_current_data(data)
+
+    async def get_historical_data(self, hours=1, device_id=None):
+        """Dữ liệu lịch sử hours giờ gần nhất dạng {tham số: Series}"""
+        device_id = device_id or self.device_id
+        end_ts = int(time.time() * 1000)
+        start_ts = end_ts - hours * 60 * 60 * 1000
+        data = await self.fetch_history(start_ts, end_ts, device_id=device_id)
+        _store(device_id, data)
+        # fetch_history đã tải hết các trang; phần cuối khoảng vẫn có thể nhận điểm đến trễ
+        if start_ts <= end_ts - LATE_ARRIVAL_MS:
+            telemetry_store.mark_covered(device_id, start_ts, end_ts - LATE_ARRIVAL_MS)
+        return format_historical_data(data)
+
+    async def get_current_and_historical(self, hours=1, device_id=None):
+        """Tải đồng thời dữ liệu hiện tại và lịch sử, trả về (current, historical)"""
+        return tuple(await asyncio.gather(
+            self.get_current_readings(device_id),
+            self.get_historical_data(hours, device_id)
+        ))
+
+    async def test_connection(self):
+        """Kiểm tra kết nối với ThingsBoard"""
+        try:
+            await self.fetch_latest()
+            return True
+        except ThingsBoardError as e:
+            logger.error(f"ThingsBoard connection test error: {str(e)}")
+            return False
+
+
+def _store(device_id, data):
+    try:
+        telemetry_store.insert_telemetry(device_id, data)
+    except Exception as e:
+        logger.error(f"Error writing data to local telemetry store: {str(e)}")
+
+
+# Event loop nền dùng chung cho mọi SyncThingsBoardClient. Khi dùng eventlet, các greenlet
+# chạy trên cùng một thread hệ điều hành nên chỉ có thể có một event loop đang chạy.
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop():
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, daemon=True, name='tb-async-loop').start()
+                _loop = loop
+    return _loop
+
+
+class SyncThingsBoardClient:
+    """
+    Gọi AsyncThingsBoardClient từ code đồng bộ. Coroutine được gửi vào event loop nền
+    (một greenlet khi dùng eventlet.monkey_patch, nên vẫn cùng hub với Flask-SocketIO)
+    và lời gọi chờ kết quả, nên nhiều thread/greenlet dùng chung một aiohttp session
+    và connection pool.
+    """
+
+    def __init__(self, **client_kwargs):
+        self._client = AsyncThingsBoardClient(**client_kwargs)
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+    def get_current_readings(self, device_id=None):
+        return self._run(self._client.get_current_readings(device_id))
+
+    def get_historical_data(self, hours=1, device_id=None):
+        return self._run(self._client.get_historical_data(hours, device_id))
+
+    def get_current_and_historical(self, hours=1, device_id=None):
+        return self._run(self._client.get_current_and_historical(hours, device_id))
+
+    def test_connection(self):
+        return self._run(self._client.test_connection())
+
+    def close(self):
+        """Đóng aiohttp session của client"""
+        if _loop is not None:
+            self._run(self._client.close())
+
+
+# Client dùng chung cho các hàm cấp module
+_sync_client = SyncThingsBoardClient()
+
+
+def get_current_readings(device_id=None):
+    return _sync_client.get_current_readings(device_id)
+
+
+def get_historical_data(hours=1, device_id=None):
+    return _sync_client.get_historical_data(hours, device_id)
+
+
+def test_connection():
+    return _sync_client.test_connection()
@@ -1,7 +1,22 @@
 import requests
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
+import threading
+import numpy as np
+from bisect import bisect_left
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import thingsboard_transport as tb_transport
+from single_flight import SingleFlight
+import telemetry_store
+import connection_health
+import device_registry
+import metrics
+import tracing
+import freshness
+import param_schema
+from param_schema import PARAM_MAPPING, Series
 
 # Cấu hình logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -11,252 +26,602 @@ logger = logging.getLogger('thingsboard_client')
 import os
 
 THINGSBOARD_CONFIG = {
-    'url': 'https://demo.thingsboard.io',
+    'url': os.environ.get('THINGSBOARD_URL', 'https://demo.thingsboard.io'),
     'dashboard_id': '0c0e97d0-bd24-11ef-af67-a38a7671daf5',
     'access_token': os.environ.get('THINGSBOARD_ACCESS_TOKEN', ''),
     'device_id': '66ae3560-bd24-11ef-af67-a38a7671daf5',
     'jwt_token': 'Bearer eyJhbGciOiJIUzUxMiJ9.eyJzdWIiOiIyMDEzOTAwMkBzdHVkZW50LmhjbXV0ZS5lZHUudm4iLCJ1c2VySWQiOiI2MzdlMjA5MC1iZDIzLTExZWYtYWY2Ny1hMzhhNzY3MWRhZjUiLCJzY29wZXMiOlsiVEVOQU5UX0FETUlOIl0sInNlc3Npb25JZCI6ImU2NDI4YTdiLTVmNWYtNGY5Yi1hOThkLWZlMDJmMjFiNjMxNCIsImV4cCI6MTc0NzA0ODEwOCwiaXNzIjoidGhpbmdzYm9hcmQuaW8iLCJpYXQiOjE3NDUyNDgxMDgsImZpcnN0TmFtZSI6IlVFVCIsImxhc3ROYW1lIjoiVUVUIiwiZW5hYmxlZCI6dHJ1ZSwicHJpdmFjeVBvbGljeUFjY2VwdGVkIjp0cnVlLCJpc1B1YmxpYyI6ZmFsc2UsInRlbmFudElkIjoiNjE4YzYyYjAtYmQyMy0xMWVmLWFmNjctYTM4YTc2NzFkYWY1IiwiY3VzdG9tZXJJZCI6IjEzODE0MDAwLTFkZDItMTFiMi04MDgwLTgwODA4MDgwODA4MCJ9.EEEHbpy53WcvvxjDLwUV_xQaBXSNJgvINru2GEwjxAaGPToJtRP53mL7uYbYfNKvoRcCvZaKOVLImLT9ikmReg'
 }
 
-# Cache để lưu trữ dữ liệu lịch sử và tránh gọi API quá nhiều
-_data_cache = {
-    'current': {'data': None, 'timestamp': 0},
-    'historical': {'data': None, 'timestamp': 0}
-}
+# Số điểm tối đa cho mỗi tham số trong một lần tải dữ liệu lịch sử
+# (ThingsBoard mặc định chỉ trả về 100 điểm nếu không chỉ định limit)
+HISTORY_FETCH_LIMIT = 50000
+
+# Thiết bị mặc định khi nơi gọi không chỉ định device_id
+DEFAULT_DEVICE_ID = THINGSBOARD_CONFIG['device_id']
+device_registry.register_device(DEFAULT_DEVICE_ID, 'Trạm mặc định')
+
+
+def _new_device_cache():
+    return {
+        'current': {'data': None, 'timestamp': 0, 'last_access': 0},
+        'historical': {'data': None, 'timestamp': 0, 'last_access': 0, 'hours': 1}
+    }
+
+
+# Cache theo từng thiết bị để lưu trữ dữ liệu và tránh gọi API quá nhiều
+_device_caches = {DEFAULT_DEVICE_ID: _new_device_cache()}
+_device_caches_lock = threading.Lock()
+# Cache của thiết bị mặc định
+_data_cache = _device_caches[DEFAULT_DEVICE_ID]
 
 # Thời gian hết hạn cache (4 giây)
 CACHE_EXPIRY = 4
 
+# Làm mới cache ở nền trước khi hết hạn (giây tính từ lần cập nhật cache)
+REFRESH_AHEAD = 3
+# Chu kỳ kiểm tra của luồng làm mới nền
+REFRESH_CHECK_INTERVAL = 1
+# Ngừng làm mới nền nếu không có ai đọc dữ liệu trong khoảng thời gian này
+REFRESH_IDLE_TIMEOUT = 60
+# Dữ liệu cũ hơn thời gian này (giây) được đánh dấu là cũ (stale)
+MAX_STALENESS = int(os.environ.get('THINGSBOARD_MAX_STALENESS', 60))
+
+# Chuỗi dữ liệu lịch sử đã gộp trong bộ nhớ, theo (thiết bị, số giờ của cửa sổ thời gian)
+_history_windows = {}
+_history_lock = threading.Lock()
+# Số cửa sổ lịch sử tối đa được giữ trong bộ nhớ
+MAX_HISTORY_WINDOWS = int(os.environ.get('THINGSBOARD_MAX_HISTORY_WINDOWS', 16))
+# Độ trễ tối đa (mili giây) giữa timestamp của thiết bị và lúc điểm tới ThingsBoard.
+# Khoảng này ở cuối mỗi lần tải không được đánh dấu là đã tải đủ (lần sau tải lại từ
+# ThingsBoard), và cửa sổ trong bộ nhớ đọc lại khoảng này từ kho cục bộ
+LATE_ARRIVAL_MS = 60 * 1000
+
+# Gộp các lần làm mới cache đồng thời thành một request tới ThingsBoard
+_single_flight = SingleFlight()
+
+# Số request tới ThingsBoard chạy song song tối đa khi làm mới nhiều thiết bị
+FETCH_WORKERS = int(os.environ.get('THINGSBOARD_FETCH_WORKERS', 8))
+_fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix='tb-fetch')
+# Các lần làm mới đã được đưa vào pool nhưng chưa chạy xong
+_queued_refreshes = set()
+_queued_lock = threading.Lock()
+# Sau mỗi lần gọi ThingsBoard thất bại liên tiếp cho một key, chờ gấp đôi thời gian trước
+# khi gọi lại (bắt đầu từ REFRESH_BACKOFF_BASE, tối đa REFRESH_BACKOFF_MAX giây); trong thời
+# gian chờ các hàm _fetch_* trả về dữ liệu thay thế mà không gọi ThingsBoard
+REFRESH_BACKOFF_BASE = 2
+REFRESH_BACKOFF_MAX = 60
+# key -> (số lần thất bại liên tiếp, thời điểm monotonic được thử lại)
+_refresh_backoff = {}
+
+
+# Kết quả đọc cache: hit (còn hạn), stale (hết hạn, trả dữ liệu cũ và làm mới ở nền),
+# miss (chưa có dữ liệu, phải chờ ThingsBoard)
+_cache_requests = metrics.counter(
+    'thingsboard_cache_requests_total', 'Reads of the ThingsBoard data cache by result', ('cache', 'result')
+)
+# Số lần phải dùng dữ liệu thay thế khi ThingsBoard lỗi: cache cũ hoặc dữ liệu giả lập
+_fallbacks = metrics.counter(
+    'data_fallback_total', 'Responses served from fallback data because upstream failed', ('kind', 'source')
+)
+
+
+def _get_device_cache(device_id):
+    cache = _device_caches.get(device_id)
+    if cache is None:
+        with _device_caches_lock:
+            cache = _device_caches.setdefault(device_id, _new_device_cache())
+    return cache
+
+
+def _flight_key(device_id, kind):
+    """Khóa single-flight của một loại dữ liệu; thiết bị mặc định giữ khóa cũ"""
+    return kind if device_id == DEFAULT_DEVICE_ID else f"{device_id}/{kind}"
+
+
+def _backing_off(key):
+    """key có đang trong thời gian chờ sau lần gọi ThingsBoard thất bại không"""
+    with _queued_lock:
+        backoff = _refresh_backoff.get(key)
+    return backoff is not None and time.monotonic() < backoff[1]
+
+
+def _record_upstream_result(key, error=None):
+    """Ghi nhận kết quả gọi ThingsBoard cho key: thành công xóa thời gian chờ, lỗi tăng gấp đôi"""
+    with _queued_lock:
+        if error is None:
+            _refresh_backoff.pop(key, None)
+            return
+        failures = _refresh_backoff.get(key, (0, 0))[0] + 1
+        delay = min(REFRESH_BACKOFF_MAX, REFRESH_BACKOFF_BASE * 2 ** (failures - 1))
+        _refresh_backoff[key] = (failures, time.monotonic() + delay)
+    logger.warning(f"Upstream fetch of {key} failed ({failures} in a row), retrying in {delay}s: {str(error)}")
+
+
+def get_request_stats():
+    """
+    Số request thực tế tới ThingsBoard và số lời gọi được gộp cho mỗi loại dữ liệu
+    """
+    return _single_flight.get_stats()
+
 
 def _generate_fallback_readings():
     """
     Tạo dữ liệu giả khi không thể kết nối với ThingsBoard
     """
-    import random
     timestamp = datetime.now().strftime("%H:%M:%S")
     readings = {}
 
-    # Dữ liệu phạm vi cho các tham số
-    param_ranges = {
-        "pm10": {"min": 0, "max": 150, "unit": "μg/m³", "warning": 50, "danger": 100},
-        "pm25": {"min": 0, "max": 75, "unit": "μg/m³", "warning": 25, "danger": 50},
-        "temperature": {"min": 15, "max": 35, "unit": "°C", "warning": 30, "danger": 33},
-        "humidity": {"min": 20, "max": 90, "unit": "%", "warning": 70, "danger": 85},
-        "noise": {"min": 30, "max": 100, "unit": "dB", "warning": 70, "danger": 85},
-        "co": {"min": 0, "max": 50, "unit": "ppm", "warning": 25, "danger": 40},
-        "co2": {"min": 300, "max": 2000, "unit": "ppm", "warning": 1000, "danger": 1500}
-    }
+    for param in param_schema.SENSOR_PARAMS:
+        value = param_schema.generate_value(param)
+        readings[param] = param_schema.reading_json(param, value, param_schema.status(param, value), timestamp)
+
+    return readings
 
-    for param, param_info in param_ranges.items():
-        value = round(random.uniform(param_info["min"], param_info["max"]), 1)
+def get_current_readings(device_id=None):
+    """
+    Lấy dữ liệu hiện tại của thiết bị từ ThingsBoard, sử dụng cache nếu có thể.
+    Khi cache đã hết hạn, trả về ngay dữ liệu trong cache và làm mới ở nền.
+    """
+    device_id = device_id or DEFAULT_DEVICE_ID
+    _ensure_background_refresher()
+    cache = _get_device_cache(device_id)['current']
+    current_time = time.time()
+    cache['last_access'] = current_time
 
-        # Xác định trạng thái
-        if value >= param_info["danger"]:
-            status = "danger"
-        elif value >= param_info["warning"]:
-            status = "warning"
+    key = _flight_key(device_id, 'current')
+    if cache['data'] is not None:
+        if (current_time - cache['timestamp']) < CACHE_EXPIRY:
+            logger.info("Returning cached current data")
+            _cache_requests.inc(cache='current', result='hit')
         else:
-            status = "normal"
+            logger.info("Returning expired cached current data, refreshing in background")
+            _cache_requests.inc(cache='current', result='stale')
+            _refresh_async(key, _fetch_current_readings, device_id)
+        return cache['data']
+
+    # Chưa có cache, phải chờ request đầu tiên (các lời gọi đồng thời dùng chung một request)
+    _cache_requests.inc(cache='current', result='miss')
+    return _single_flight.do(key, _fetch_current_readings, device_id)
 
-        readings[param] = {
-            "value": value,
-            "unit": param_info["unit"],
-            "status": status,
-            "timestamp": timestamp
-        }
 
+def get_fleet_readings(device_ids=None):
+    """
+    Lấy dữ liệu hiện tại của nhiều thiết bị (mặc định tất cả thiết bị đã đăng ký).
+    Các thiết bị chưa có cache được tải song song qua pool, nên thời gian chờ
+    xấp xỉ thời gian của thiết bị chậm nhất. Trả về {device_id: readings}.
+    """
+    if device_ids is None:
+        device_ids = [device['id'] for device in device_registry.get_devices()]
+
+    futures = {device_id: _fetch_pool.submit(get_current_readings, device_id) for device_id in device_ids}
+    readings = {}
+    for device_id, future in futures.items():
+        try:
+            readings[device_id] = future.result()
+        except Exception as e:
+            logger.error(f"Error fetching current data for device {device_id}: {str(e)}")
     return readings
 
-def get_current_readings():
+
+def _fetch_current_readings(device_id=None):
     """
-    Lấy dữ liệu hiện tại từ ThingsBoard, sử dụng cache nếu có thể
+    Gọi ThingsBoard lấy dữ liệu hiện tại của thiết bị và cập nhật cache
     """
-    # Kiểm tra xem cache có còn hiệu lực không
-    current_time = time.time()
-    if _data_cache['current']['data'] is not None and \
-       (current_time - _data_cache['current']['timestamp']) < CACHE_EXPIRY:
-        logger.info("Returning cached current data")
-        return _data_cache['current']['data']
+    device_id = device_id or DEFAULT_DEVICE_ID
+    cache = _get_device_cache(device_id)['current']
+    key = _flight_key(device_id, 'current')
+    if _backing_off(key):
+        return _current_fallback(cache)
 
-    # Không có cache hợp lệ, gọi API
+    current_time = time.time()
     try:
         # Sử dụng JWT token trong header thay vì token trong URL
-        url = f"{THINGSBOARD_CONFIG['url']}/api/plugins/telemetry/DEVICE/{THINGSBOARD_CONFIG['device_id']}/values/timeseries"
+        url = f"{THINGSBOARD_CONFIG['url']}/api/plugins/telemetry/DEVICE/{device_id}/values/timeseries"
         headers = {
             'X-Authorization': THINGSBOARD_CONFIG['jwt_token'],
             'Content-Type': 'application/json'
         }
 
         logger.info(f"Requesting current data with JWT from URL: {url}")
-        response = requests.get(url, headers=headers)
+        with tracing.span('upstream_get') as span:
+            response = tb_transport.get(url, headers=headers)
+            span.set(status=response.status_code)
 
         # Kiểm tra lỗi HTTP
         if response.status_code != 200:
             logger.error(f"HTTP error {response.status_code}: {response.text}")
             raise requests.exceptions.RequestException(f"HTTP error {response.status_code}")
 
-        data = response.json()
+        with tracing.span('response_json'):
+            data = response.json()
+        fetched_at = time.time()
         logger.info(f"Received current data from ThingsBoard: {data}")
 
+        # Lưu giá trị mới nhất vào kho cục bộ
+        try:
+            with tracing.span('telemetry_store_insert'):
+                telemetry_store.insert_telemetry(device_id, data)
+        except Exception as e:
+            logger.error(f"Error writing current data to local telemetry store: {str(e)}")
+
         # Chuyển đổi dữ liệu sang định dạng của ứng dụng
-        formatted_data = format_current_data(data)
+        with tracing.span('format_current_data'):
+            formatted_data = format_current_data(data)
+        sensor_ts = formatted_data.get('last_data_timestamp')
+        freshness.record_fetch(sensor_ts, 'http', fetched_at)
 
         # Cập nhật cache
-        _data_cache['current']['data'] = formatted_data
-        _data_cache['current']['timestamp'] = current_time
+        cache['data'] = formatted_data
+        cache['timestamp'] = current_time
+        freshness.record_cache_write(sensor_ts)
+        _record_upstream_result(key)
 
         return formatted_data
     except Exception as e:
         logger.error(f"Error fetching current data from ThingsBoard: {str(e)}")
-        # Nếu có lỗi và có cache cũ, trả về cache đó
-        if _data_cache['current']['data'] is not None:
-            logger.info("Returning stale cached data due to API error")
-            return _data_cache['current']['data']
+        _record_upstream_result(key, e)
+        return _current_fallback(cache)
+
+
+def _current_fallback(cache):
+    """Dữ liệu thay thế khi không gọi được ThingsBoard: cache cũ nếu có, nếu không là dữ liệu giả"""
+    # Nếu có lỗi và có cache cũ, trả về cache đó
+    if cache['data'] is not None:
+        logger.info("Returning stale cached data due to API error")
+        _fallbacks.inc(kind='current', source='stale_cache')
+        return cache['data']
+
+    # Nếu không có cache, tạo dữ liệu giả
+    readings = _generate_fallback_readings()
+    _fallbacks.inc(kind='current', source='generated')
+
+    logger.info("Generated fallback data due to API error")
+    return readings
+
+
+def get_historical_data(hours=1, device_id=None):
+    """
+    Lấy dữ liệu lịch sử của thiết bị từ ThingsBoard, sử dụng cache nếu có thể.
+    Khi cache đã hết hạn, trả về ngay dữ liệu trong cache và làm mới ở nền.
+    """
+    device_id = device_id or DEFAULT_DEVICE_ID
+    _ensure_background_refresher()
+    cache = _get_device_cache(device_id)['historical']
+    current_time = time.time()
+    cache['last_access'] = current_time
 
-        # Nếu không có cache, tạo dữ liệu giả
-        readings = _generate_fallback_readings()
+    key = _flight_key(device_id, f'historical_{hours}h')
+    if cache['data'] is not None and cache['hours'] == hours:
+        if (current_time - cache['timestamp']) < CACHE_EXPIRY:
+            logger.info("Returning cached historical data")
+            _cache_requests.inc(cache='historical', result='hit')
+        else:
+            logger.info("Returning expired cached historical data, refreshing in background")
+            _cache_requests.inc(cache='historical', result='stale')
+            _refresh_async(key, _fetch_historical_data, hours, device_id)
+        return cache['data']
 
-        logger.info("Generated fallback data due to API error")
-        return readings
+    # Chưa có cache, phải chờ request đầu tiên (các lời gọi đồng thời dùng chung một request)
+    _cache_requests.inc(cache='historical', result='miss')
+    return _single_flight.do(key, _fetch_historical_data, hours, device_id)
 
 
-def get_historical_data(hours=1):
+def _fetch_historical_data(hours, device_id=None):
     """
-    Lấy dữ liệu lịch sử từ ThingsBoard, sử dụng cache nếu có thể
+    Lấy dữ liệu lịch sử từ kho cục bộ, chỉ gọi ThingsBoard để tải bù
+    những khoảng thời gian còn thiếu, sau đó cập nhật cache
     """
-    # Kiểm tra xem cache có còn hiệu lực không
     current_time = time.time()
-    if _data_cache['historical']['data'] is not None and \
-       (current_time - _data_cache['historical']['timestamp']) < CACHE_EXPIRY:
-        logger.info("Returning cached historical data")
-        return _data_cache['historical']['data']
+    device_id = device_id or DEFAULT_DEVICE_ID
+    cache = _get_device_cache(device_id)['historical']
+    end_ts = int(current_time * 1000)  # Thời gian hiện tại tính bằng mili giây
+    start_ts = end_ts - (hours * 60 * 60 * 1000)  # hours giờ trước
+
+    # Trong thời gian chờ sau lần thất bại trước, chỉ đọc từ kho cục bộ
+    key = _flight_key(device_id, f'historical_{hours}h')
+    upstream_ok = not _backing_off(key)
+    if upstream_ok:
+        try:
+            for gap_start, gap_end in telemetry_store.missing_ranges(device_id, start_ts, end_ts):
+                with tracing.span('backfill_history', start_ts=gap_start, end_ts=gap_end):
+                    _backfill_history(device_id, gap_start, gap_end)
+            _record_upstream_result(key)
+        except Exception as e:
+            logger.error(f"Error fetching historical data from ThingsBoard: {str(e)}")
+            _record_upstream_result(key, e)
+            upstream_ok = False
 
-    # Không có cache hợp lệ, gọi API
     try:
-        end_ts = int(time.time() * 1000)  # Thời gian hiện tại tính bằng mili giây
-        start_ts = end_ts - (hours * 60 * 60 * 1000)  # hours giờ trước
+        if upstream_ok:
+            with tracing.span('update_history_window'):
+                formatted_data = _update_history_window(device_id, hours, start_ts, end_ts)
+        else:
+            stored = telemetry_store.query_range(device_id, start_ts, end_ts, keys=list(PARAM_MAPPING))
+            formatted_data = _fill_missing_history({
+                PARAM_MAPPING[key]: Series.from_points(rows) for key, rows in stored.items()
+            }) if stored else None
+    except Exception as e:
+        logger.error(f"Error reading local telemetry store: {str(e)}")
+        formatted_data = None
+        upstream_ok = False
+
+    if formatted_data is not None:
+        # Chỉ cập nhật cache khi đã đồng bộ được với ThingsBoard
+        if upstream_ok:
+            cache['data'] = formatted_data
+            cache['timestamp'] = current_time
+            cache['hours'] = hours
+        else:
+            _fallbacks.inc(kind='historical', source='local_store')
 
-        # Sử dụng JWT token trong header thay vì token trong URL
-        url = f"{THINGSBOARD_CONFIG['url']}/api/plugins/telemetry/DEVICE/{THINGSBOARD_CONFIG['device_id']}/values/timeseries?startTs={start_ts}&endTs={end_ts}"
-        headers = {
-            'X-Authorization': THINGSBOARD_CONFIG['jwt_token'],
-            'Content-Type': 'application/json'
-        }
+        return formatted_data
+
+    # Nếu có lỗi và có cache cũ, trả về cache đó
+    if cache['data'] is not None and cache['hours'] == hours:
+        logger.info("Returning stale cached historical data due to API error")
+        _fallbacks.inc(kind='historical', source='stale_cache')
+        return cache['data']
+
+    # Nếu không có cache, tạo dữ liệu giả (tương tự như code cũ)
+    data = {param: Series.generated(param) for param in param_schema.NAMES}
+
+    logger.info("Generated fallback historical data due to API error")
+    _fallbacks.inc(kind='historical', source='generated')
+    return data
+
+
+class _HistoryWindow:
+    """
+    Chuỗi lịch sử của từng tham số trong khoảng [start_ts, end_ts], lưu trong mảng
+    array('q') / array('d') (16 byte mỗi điểm). Mỗi lần làm mới chỉ thêm các điểm mới
+    và loại bỏ các điểm đã ra khỏi cửa sổ.
+    """
+
+    def __init__(self, device_id, start_ts):
+        self.device_id = device_id
+        self.start_ts = start_ts
+        self.end_ts = start_ts - 1
+        self.last_access = 0
+        self._ts = {}
+        self._values = {}
+
+    def merge(self, rows_by_key, end_ts):
+        """Gộp các điểm {key: [(ts, value), ...]} (theo thứ tự thời gian) vào chuỗi"""
+        for key, rows in rows_by_key.items():
+            ts_list = self._ts.setdefault(key, array('q'))
+            values = self._values.setdefault(key, array('d'))
+            for ts, value in rows:
+                if ts < self.start_ts:
+                    continue
+                if not ts_list or ts > ts_list[-1]:
+                    ts_list.append(ts)
+                    values.append(float(value))
+                    continue
+                # Điểm đến trễ: chèn vào đúng vị trí nếu chưa có
+                i = bisect_left(ts_list, ts)
+                if ts_list[i] != ts:
+                    ts_list.insert(i, ts)
+                    values.insert(i, float(value))
+        self.end_ts = max(self.end_ts, end_ts)
+
+    def evict(self, start_ts):
+        """Loại bỏ các điểm cũ hơn start_ts"""
+        for key, ts_list in self._ts.items():
+            count = bisect_left(ts_list, start_ts)
+            if count:
+                del ts_list[:count]
+                del self._values[key][:count]
+        self.start_ts = max(self.start_ts, start_ts)
+
+    def series(self):
+        """Bản sao dữ liệu dạng {tham số: Series}"""
+        history = {}
+        for tb_param, app_param in PARAM_MAPPING.items():
+            if self._ts.get(tb_param):
+                # np.array sao chép dữ liệu nên cửa sổ vẫn có thể được cập nhật tiếp
+                history[app_param] = Series(np.array(self._ts[tb_param]), np.array(self._values[tb_param]))
+        return _fill_missing_history(history)
+
+
+def _update_history_window(device_id, hours, start_ts, end_ts):
+    """
+    Cập nhật cửa sổ lịch sử trong bộ nhớ: lần đầu đọc toàn bộ khoảng từ kho cục bộ,
+    các lần sau chỉ đọc phần mới kể từ lần trước
+    """
+    keys = list(PARAM_MAPPING)
+    with _history_lock:
+        window = _history_windows.get((device_id, hours))
+        if window is None or window.start_ts > start_ts:
+            window = _HistoryWindow(device_id, start_ts)
+            window.last_access = time.time()
+            window.merge(telemetry_store.query_range(device_id, start_ts, end_ts, keys=keys), end_ts)
+            _history_windows[(device_id, hours)] = window
+            logger.info(f"Loaded {hours}h historical window from local store")
+
+            # Giới hạn số cửa sổ giữ trong bộ nhớ
+            while len(_history_windows) > MAX_HISTORY_WINDOWS:
+                oldest = min(_history_windows, key=lambda k: _history_windows[k].last_access)
+                del _history_windows[oldest]
+        else:
+            delta_start = max(window.start_ts, window.end_ts + 1 - LATE_ARRIVAL_MS)
+            window.merge(telemetry_store.query_range(device_id, delta_start, end_ts, keys=keys), end_ts)
+            window.evict(start_ts)
+            window.last_access = time.time()
+
+        return window.series()
+
+
+def _backfill_history(device_id, start_ts, end_ts):
+    """
+    Tải dữ liệu lịch sử trong khoảng [start_ts, end_ts] từ ThingsBoard vào kho cục bộ.
+    Nếu kết quả bị cắt bởi limit, tiếp tục tải phần cũ hơn còn lại.
+    LATE_ARRIVAL_MS cuối khoảng không được đánh dấu là đã tải để các điểm đến
+    ThingsBoard trễ được tải lại ở lần sau.
+    """
+    covered_end = end_ts - LATE_ARRIVAL_MS
+    # Sử dụng JWT token trong header thay vì token trong URL
+    headers = {
+        'X-Authorization': THINGSBOARD_CONFIG['jwt_token'],
+        'Content-Type': 'application/json'
+    }
+
+    while start_ts <= end_ts:
+        url = f"{THINGSBOARD_CONFIG['url']}/api/plugins/telemetry/DEVICE/{device_id}/values/timeseries?startTs={start_ts}&endTs={end_ts}&limit={HISTORY_FETCH_LIMIT}"
 
         logger.info(f"Requesting historical data with JWT from URL: {url}")
-        response = requests.get(url, headers=headers)
+        with tracing.span('upstream_get') as span:
+            response = tb_transport.get(url, headers=headers)
+            span.set(status=response.status_code)
 
         # Kiểm tra lỗi HTTP
         if response.status_code != 200:
             logger.error(f"HTTP error {response.status_code}: {response.text}")
             raise requests.exceptions.RequestException(f"HTTP error {response.status_code}")
 
-        data = response.json()
+        with tracing.span('response_json'):
+            data = response.json()
         logger.info(f"Received historical data from ThingsBoard with {len(data.keys())} parameters")
+        with tracing.span('telemetry_store_insert'):
+            telemetry_store.insert_telemetry(device_id, data)
 
-        # Chuyển đổi dữ liệu sang định dạng của ứng dụng
-        formatted_data = format_historical_data(data)
+        # ThingsBoard trả về các điểm mới nhất trước; nếu bị cắt, phần cũ hơn chưa được tải
+        truncated_from = None
+        for items in data.values():
+            if items and len(items) >= HISTORY_FETCH_LIMIT:
+                oldest = min(item['ts'] for item in items)
+                truncated_from = oldest if truncated_from is None else max(truncated_from, oldest)
 
-        # Cập nhật cache
-        _data_cache['historical']['data'] = formatted_data
-        _data_cache['historical']['timestamp'] = current_time
+        range_start = start_ts if truncated_from is None else truncated_from
+        if range_start <= min(end_ts, covered_end):
+            telemetry_store.mark_covered(device_id, range_start, min(end_ts, covered_end))
+        if truncated_from is None:
+            return
+        end_ts = truncated_from - 1
 
-        return formatted_data
-    except Exception as e:
-        logger.error(f"Error fetching historical data from ThingsBoard: {str(e)}")
-        # Nếu có lỗi và có cache cũ, trả về cache đó
-        if _data_cache['historical']['data'] is not None:
-            logger.info("Returning stale cached historical data due to API error")
-            return _data_cache['historical']['data']
-
-        # Nếu không có cache, tạo dữ liệu giả (tương tự như code cũ)
-        from app import PARAM_RANGES, generate_reading
-
-        now = datetime.now()
-        data = {}
-
-        for param in PARAM_RANGES:
-            param_data = []
-            for i in range(60):  # 60 data points (1 per minute for the last hour)
-                time_point = now - timedelta(minutes=i)
-                value = generate_reading(PARAM_RANGES[param])
-                param_data.append({
-                    "timestamp": time_point.strftime("%H:%M"),
-                    "value": value
-                })
-            # Reverse to have chronological order
-            data[param] = list(reversed(param_data))
-
-        logger.info("Generated fallback historical data due to API error")
-        return data
-
-
-def _get_status(value, param_info):
-    """Hàm nội bộ để xác định trạng thái dựa trên ngưỡng"""
-    if value >= param_info["danger"]:
-        return "danger"
-    elif value >= param_info["warning"]:
-        return "warning"
-    return "normal"
 
-def format_current_data(data):
+def _refresh_async(key, fn, *args):
     """
-    Chuyển đổi dữ liệu hiện tại từ ThingsBoard sang định dạng của ứng dụng
+    Làm mới cache ở nền qua pool (giới hạn FETCH_WORKERS request song song),
+    nếu chưa có lần làm mới nào cho key đang chờ hoặc đang chạy và key không
+    đang trong thời gian chờ sau lần gọi ThingsBoard thất bại
+    """
+    if _backing_off(key):
+        return
+    with _queued_lock:
+        if key in _queued_refreshes or _single_flight.in_flight(key):
+            return
+        _queued_refreshes.add(key)
+
+    def run():
+        try:
+            with tracing.trace('refresh', key=key):
+                _single_flight.do(key, fn, *args)
+        except Exception as e:
+            logger.error(f"Background refresh of {key} failed: {str(e)}")
+        finally:
+            with _queued_lock:
+                _queued_refreshes.discard(key)
+
+    _fetch_pool.submit(run)
+
+
+def _background_refresh_loop():
+    """
+    Giữ cache luôn mới: làm mới trước khi hết hạn cho những loại dữ liệu
+    vẫn đang được đọc gần đây
     """
-    # Sử dụng các phạm vi cục bộ thay vì import PARAM_RANGES từ app
-    param_ranges = {
-        "pm10": {"min": 0, "max": 150, "unit": "μg/m³", "warning": 50, "danger": 100},
-        "pm25": {"min": 0, "max": 75, "unit": "μg/m³", "warning": 25, "danger": 50},
-        "temperature": {"min": 15, "max": 35, "unit": "°C", "warning": 30, "danger": 33},
-        "humidity": {"min": 20, "max": 90, "unit": "%", "warning": 70, "danger": 85},
-        "noise": {"min": 30, "max": 100, "unit": "dB", "warning": 70, "danger": 85},
-        "co": {"min": 0, "max": 50, "unit": "ppm", "warning": 10.1, "danger": 17}, # Updated CO thresholds
-        "co2": {"min": 300, "max": 2000, "unit": "ppm", "warning": 1000, "danger": 1500}
+    while True:
+        try:
+            current_time = time.time()
+
+            # Các thiết bị được làm mới song song qua pool
+            for device_id, device_cache in list(_device_caches.items()):
+                cache = device_cache['current']
+                if current_time - cache['last_access'] < REFRESH_IDLE_TIMEOUT and \
+                   current_time - cache['timestamp'] >= REFRESH_AHEAD:
+                    _refresh_async(_flight_key(device_id, 'current'), _fetch_current_readings, device_id)
+
+                cache = device_cache['historical']
+                if current_time - cache['last_access'] < REFRESH_IDLE_TIMEOUT and \
+                   current_time - cache['timestamp'] >= REFRESH_AHEAD:
+                    hours = cache['hours']
+                    _refresh_async(_flight_key(device_id, f'historical_{hours}h'),
+                                   _fetch_historical_data, hours, device_id)
+        except Exception as e:
+            logger.error(f"Error in background refresher: {str(e)}")
+
+        time.sleep(REFRESH_CHECK_INTERVAL)
+
+
+_refresher_thread = None
+_refresher_lock = threading.Lock()
+
+
+def _ensure_background_refresher():
+    """Khởi động luồng làm mới nền (một lần cho mỗi process)"""
+    global _refresher_thread
+    if _refresher_thread is not None:
+        return
+    with _refresher_lock:
+        if _refresher_thread is None:
+            _refresher_thread = threading.Thread(target=_background_refresh_loop, daemon=True)
+            _refresher_thread.start()
+            logger.info("Started background cache refresher")
+
+
+def get_cache_status(kind='current', device_id=None):
+    """
+    Tình trạng cache của thiết bị: tuổi dữ liệu (giây), có bị cũ quá MAX_STALENESS không,
+    và có đang làm mới hay không
+    """
+    device_id = device_id or DEFAULT_DEVICE_ID
+    cache = _get_device_cache(device_id)[kind]
+    if cache['data'] is None:
+        return {'age': None, 'stale': True, 'refreshing': False}
+
+    age = time.time() - cache['timestamp']
+    key = _flight_key(device_id, 'current' if kind == 'current' else f"historical_{cache['hours']}h")
+    return {
+        'age': round(age, 3),
+        'stale': age > MAX_STALENESS,
+        'refreshing': _single_flight.in_flight(key)
     }
 
-    # Lấy thời gian hiện tại
-    current_time = datetime.now().strftime("%H:%M:%S")
+
+def format_current_data(data):
+    """
+    Chuyển đổi dữ liệu hiện tại từ ThingsBoard sang định dạng của ứng dụng
+    """
     readings = {}
     device_status = "online"
     last_data_update = None
 
-    # Ánh xạ giữa tên tham số ThingsBoard và ứng dụng
-    param_mapping = {
-        'Temperature': 'temperature',
-        'Humidity': 'humidity',
-        'PM10': 'pm10',
-        'PM2.5': 'pm25',
-        'CO': 'co',
-        'CO2': 'co2',
-        'Sound': 'noise'
-    }
-
-    # Chuyển đổi dữ liệu
-    for tb_param, app_param in param_mapping.items():
+    # Chuyển đổi dữ liệu: (tham số, giá trị, ts) của các tham số có dữ liệu
+    latest = []
+    for tb_param, app_param in PARAM_MAPPING.items():
         if tb_param in data and data[tb_param] and len(data[tb_param]) > 0:
             try:
                 ts = data[tb_param][0]['ts']
+                latest.append((app_param, float(data[tb_param][0]['value']), ts))
                 # Lưu lại timestamp mới nhất
                 if last_data_update is None or ts > last_data_update:
                     last_data_update = ts
-
-                value = float(data[tb_param][0]['value'])
-                param_info = param_ranges[app_param]
-                status = _get_status(value, param_info)
-
-                # Chuyển đổi timestamp của ThingsBoard sang định dạng giờ:phút:giây
-                tb_timestamp = datetime.fromtimestamp(ts / 1000).strftime("%H:%M:%S")
-
-                readings[app_param] = {
-                    "value": value,
-                    "unit": param_info["unit"],
-                    "status": status,
-                    "timestamp": tb_timestamp,
-                    "last_update": ts
-                }
             except (KeyError, ValueError, IndexError) as e:
                 logger.error(f"Error processing {tb_param} data: {str(e)}")
 
+    # Xác định trạng thái của tất cả tham số trong một phép tính
+    codes = param_schema.classify(
+        [value for _, value, _ in latest], [param_schema.INDEX[param] for param, _, _ in latest]
+    ).tolist()
+    for (app_param, value, ts), code in zip(latest, codes):
+        # Chuyển đổi timestamp của ThingsBoard sang định dạng giờ:phút:giây
+        with tracing.span('strftime'):
+            tb_timestamp = datetime.fromtimestamp(ts / 1000).strftime("%H:%M:%S")
+        readings[app_param] = param_schema.reading_json(
+            app_param, value, param_schema.STATUS_LABELS[code], tb_timestamp, ts
+        )
+
     # Kiểm tra xem thiết bị có hoạt động không dựa trên thời gian dữ liệu mới nhất
     if last_data_update:
         # Tính thời gian trễ (phút) giữa thời gian hiện tại và thời gian cập nhật dữ liệu gần nhất
@@ -273,15 +638,9 @@ def format_current_data(data):
         device_status = "unknown"
 
     # Thêm các tham số còn thiếu với thông báo không có dữ liệu
-    for param, param_info in param_ranges.items():
+    for param in param_schema.SENSOR_PARAMS:
         if param not in readings:
-            readings[param] = {
-                "value": None,
-                "unit": param_info["unit"],
-                "status": "unknown",
-                "timestamp": current_time,
-                "message": "Không có dữ liệu"
-            }
+            readings[param] = param_schema.missing_reading_json(param, last_data_update)
 
     # Thêm trạng thái thiết bị vào kết quả
     readings['device_status'] = device_status
@@ -292,71 +651,29 @@ def format_current_data(data):
 
 def format_historical_data(data):
     """
-    Chuyển đổi dữ liệu lịch sử từ ThingsBoard sang định dạng của ứng dụng
-    """
-    # Sử dụng các phạm vi cục bộ thay vì import từ app
-    param_ranges = {
-        "pm10": {"min": 0, "max": 150, "unit": "μg/m³", "warning": 50, "danger": 100},
-        "pm25": {"min": 0, "max": 75, "unit": "μg/m³", "warning": 25, "danger": 50},
-        "temperature": {"min": 15, "max": 35, "unit": "°C", "warning": 30, "danger": 33},
-        "humidity": {"min": 20, "max": 90, "unit": "%", "warning": 70, "danger": 85},
-        "noise": {"min": 30, "max": 100, "unit": "dB", "warning": 70, "danger": 85},
-        "co": {"min": 0, "max": 50, "unit": "ppm", "warning": 25, "danger": 40},
-        "co2": {"min": 300, "max": 2000, "unit": "ppm", "warning": 1000, "danger": 1500}
-    }
-
-    formatted_data = {}
-
-    # Ánh xạ giữa tên tham số ThingsBoard và ứng dụng
-    param_mapping = {
-        'Temperature': 'temperature',
-        'Humidity': 'humidity',
-        'PM10': 'pm10',
-        'PM2.5': 'pm25',
-        'CO': 'co',
-        'CO2': 'co2',
-        'Sound': 'noise'
-    }
+    Chuyển đổi dữ liệu lịch sử từ ThingsBoard sang {tham số: Series} của ứng dụng
+    (chuyển sang JSON bằng param_schema.history_json khi trả về cho client)
+    """
+    history = {}
 
     # Chuyển đổi dữ liệu lịch sử
-    for tb_param, app_param in param_mapping.items():
+    for tb_param, app_param in PARAM_MAPPING.items():
         if tb_param in data and data[tb_param]:
             try:
-                param_data = []
-                for item in data[tb_param]:
-                    timestamp = datetime.fromtimestamp(item['ts'] / 1000).strftime("%H:%M")
-                    value = float(item['value'])
-
-                    param_data.append({
-                        "timestamp": timestamp,
-                        "value": value
-                    })
-
-                # Sắp xếp theo thời gian tăng dần
-                param_data.sort(key=lambda x: x['timestamp'])
-                formatted_data[app_param] = param_data
-            except (KeyError, ValueError) as e:
+                history[app_param] = Series.from_points((item['ts'], item['value']) for item in data[tb_param])
+            except (KeyError, ValueError, TypeError) as e:
                 logger.error(f"Error processing historical {tb_param} data: {str(e)}")
 
-    # Tạo dữ liệu giả cho các tham số còn thiếu
-    import random
-
-    now = datetime.now()
+    return _fill_missing_history(history)
 
-    for param, param_info in param_ranges.items():
-        if param not in formatted_data:
-            param_data = []
-            for i in range(60):  # 60 data points (1 per minute for the last hour)
-                time_point = now - timedelta(minutes=i)
-                value = round(random.uniform(param_info["min"], param_info["max"]), 1)
-                param_data.append({
-                    "timestamp": time_point.strftime("%H:%M"),
-                    "value": value
-                })
-            # Reverse to have chronological order
-            formatted_data[param] = list(reversed(param_data))
 
-    return formatted_data
+def _fill_missing_history(history):
+    """Tạo dữ liệu giả cho các tham số còn thiếu"""
+    end_ts = int(time.time() * 1000)
+    for param in param_schema.SENSOR_PARAMS:
+        if param not in history:
+            history[param] = Series.generated(param, end_ts)
+    return history
 
 
 def test_connection():
@@ -372,7 +689,7 @@ def test_connection():
         }
 
         logger.info(f"Testing connection to ThingsBoard with JWT token")
-        response = requests.get(url, headers=headers)
+        response = tb_transport.get(url, headers=headers)
 
         if response.status_code != 200:
             logger.error(f"ThingsBoard connection test failed: HTTP {response.status_code}, Response: {response.text}")
@@ -387,4 +704,8 @@ def test_connection():
         return True
     except Exception as e:
         logger.error(f"ThingsBoard connection test error: {str(e)}")
-        return False
\ No newline at end of file
+        return False
+
+
+# Khi không có request thực tế nào trong một thời gian, kiểm tra kết nối bằng test_connection
+connection_health.set_probe(tb_transport.HEALTH_MONITOR, test_connection)
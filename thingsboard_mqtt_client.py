@@ -2,26 +2,39 @@ import paho.mqtt.client as mqtt
 import json
 import time
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime
 import os
 import ssl
-import requests
+import thingsboard_transport as tb_transport
 import threading
+from ring_buffer import TelemetryRingBuffer
+import telemetry_store
+import connection_health
+import freshness
+import param_schema
+from param_schema import PARAM_MAPPING, Series
 
 # Cấu hình logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('thingsboard_mqtt_client')
 
 # Cấu hình ThingsBoard
+# Host, cổng và địa chỉ HTTP có thể đổi qua biến môi trường (ví dụ trỏ tới thingsboard_stub.py)
 THINGSBOARD_CONFIG = {
-    'host': 'demo.thingsboard.io',
-    'mqtt_port': 1883,  # MQTT non-secure port
-    'mqtt_ssl_port': 8883,  # MQTT secure port
+    'host': os.environ.get('THINGSBOARD_HOST', 'demo.thingsboard.io'),
+    'mqtt_port': int(os.environ.get('THINGSBOARD_MQTT_PORT', 1883)),  # MQTT non-secure port
+    'mqtt_ssl_port': int(os.environ.get('THINGSBOARD_MQTT_SSL_PORT', 8883)),  # MQTT secure port
+    'mqtt_tls': os.environ.get('THINGSBOARD_MQTT_TLS', '1') != '0',  # Thử kết nối TLS trước
     'http_port': 443,  # HTTPS port for REST API
     'device_id': '66ae3560-bd24-11ef-af67-a38a7671daf5',
     'access_token': os.environ.get('THINGSBOARD_ACCESS_TOKEN', 'DATN'),
     'dashboard_id': '0c0e97d0-bd24-11ef-af67-a38a7671daf5'
 }
+THINGSBOARD_CONFIG['http_url'] = os.environ.get('THINGSBOARD_HTTP_URL', f"https://{THINGSBOARD_CONFIG['host']}")
+
+# Trạng thái kết nối broker được ghi nhận trong connection_health;
+# mất kết nối broker là trạng thái rõ ràng nên chuyển ngay sang down
+_health = connection_health.get_monitor('thingsboard_mqtt', failure_threshold=1)
 
 # Cache để lưu trữ dữ liệu và tránh gọi MQTT quá nhiều
 _data_cache = {
@@ -34,41 +47,49 @@ mqtt_client = None
 mqtt_connected = False
 mqtt_lock = threading.Lock()
 
-# Phạm vi cục bộ cho các tham số
-PARAM_RANGES = {
-    "pm10": {"min": 0, "max": 150, "unit": "μg/m³", "warning": 50, "danger": 100},
-    "pm25": {"min": 0, "max": 75, "unit": "μg/m³", "warning": 25, "danger": 50},
-    "temperature": {"min": 15, "max": 35, "unit": "°C", "warning": 30, "danger": 33},
-    "humidity": {"min": 20, "max": 90, "unit": "%", "warning": 70, "danger": 85},
-    "noise": {"min": 30, "max": 100, "unit": "dB", "warning": 70, "danger": 85},
-    "co": {"min": 0, "max": 50, "unit": "ppm", "warning": 25, "danger": 40},
-    "co2": {"min": 300, "max": 2000, "unit": "ppm", "warning": 1000, "danger": 1500}
-}
-
-# Ánh xạ giữa tên tham số ThingsBoard và ứng dụng
-PARAM_MAPPING = {
-    'Temperature': 'temperature',
-    'Humidity': 'humidity',
-    'PM10': 'pm10',
-    'PM2.5': 'pm25',
-    'CO': 'co',
-    'CO2': 'co2',
-    'Sound': 'noise'
-}
-
 # Lưu trữ dữ liệu nhận được từ MQTT
 mqtt_data_store = {
     'telemetry': {},
     'attributes': {},
     'connected': False,
+    'broker_connected': False,  # Chỉ đúng khi đang kết nối tới MQTT broker (không tính HTTP API)
     'last_received': 0
 }
 
+# Các hàm nhận dữ liệu telemetry mới ngay khi có message MQTT (ví dụ: phát qua SocketIO)
+_telemetry_listeners = []
+
+def add_telemetry_listener(callback):
+    """
+    Đăng ký hàm callback(readings) được gọi mỗi khi nhận telemetry qua MQTT,
+    với readings đã được chuyển sang định dạng của ứng dụng
+    """
+    if callback not in _telemetry_listeners:
+        _telemetry_listeners.append(callback)
+
+def remove_telemetry_listener(callback):
+    """Hủy đăng ký callback telemetry"""
+    if callback in _telemetry_listeners:
+        _telemetry_listeners.remove(callback)
+
+def _notify_telemetry_listeners():
+    """Chuyển dữ liệu MQTT mới nhất tới các listener"""
+    if not _telemetry_listeners:
+        return
+    readings = format_current_data(_latest_telemetry())
+    for callback in list(_telemetry_listeners):
+        try:
+            callback(readings)
+        except Exception as e:
+            logger.error(f"Error in telemetry listener: {e}")
+
 # Callback khi kết nối thành công đến MQTT broker
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         logger.info("Connected to ThingsBoard MQTT broker")
         mqtt_data_store['connected'] = True
+        mqtt_data_store['broker_connected'] = True
+        _health.record_success()
         
         # Đăng ký các topic cần thiết
         client.subscribe(f"v1/devices/me/attributes")  # Nhận các thuộc tính thiết bị
@@ -81,11 +102,15 @@ def on_connect(client, userdata, flags, rc):
     else:
         logger.error(f"Failed to connect to ThingsBoard MQTT broker, return code: {rc}")
         mqtt_data_store['connected'] = False
+        mqtt_data_store['broker_connected'] = False
+        _health.record_failure(f"MQTT connect return code {rc}")
 
 # Callback khi mất kết nối
 def on_disconnect(client, userdata, rc):
     logger.warning(f"Disconnected from ThingsBoard MQTT broker with code: {rc}")
     mqtt_data_store['connected'] = False
+    mqtt_data_store['broker_connected'] = False
+    _health.record_failure(f"MQTT disconnected with code {rc}")
 
 # Callback khi nhận được message
 def on_message(client, userdata, msg):
@@ -96,21 +121,47 @@ def on_message(client, userdata, msg):
         
         # Cập nhật thời gian nhận dữ liệu gần nhất
         mqtt_data_store['last_received'] = time.time()
+        _health.record_success()
         
         # Xử lý dữ liệu telemetry
         if topic == "v1/devices/me/telemetry":
+            received_at = mqtt_data_store['last_received']
+            # Thiết bị có thể gửi kèm thời điểm đo: {"ts": ..., "values": {...}}
+            device_ts = isinstance(payload.get('values'), dict) and 'ts' in payload
+            if device_ts:
+                ts = int(payload['ts'])
+                payload = payload['values']
+            else:
+                ts = int(received_at * 1000)  # milliseconds
+            freshness.record_fetch(ts, 'mqtt', received_at)
+            stored_points = {}
             for param, value in payload.items():
-                if param not in mqtt_data_store['telemetry']:
-                    mqtt_data_store['telemetry'][param] = []
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    logger.debug(f"Skipping non-numeric telemetry {param}: {value}")
+                    continue
                 
-                # Thêm timestamp vào dữ liệu
-                data_point = {
-                    "ts": int(time.time() * 1000),  # milliseconds
-                    "value": value
-                }
+                if param not in mqtt_data_store['telemetry']:
+                    mqtt_data_store['telemetry'][param] = TelemetryRingBuffer()
                 
-                # Giữ tối đa 100 điểm dữ liệu cho mỗi tham số
-                mqtt_data_store['telemetry'][param] = [data_point] + mqtt_data_store['telemetry'][param][:99]
+                # Bộ đệm vòng giữ số điểm cố định cho mỗi tham số, không cấp phát lại khi thêm
+                mqtt_data_store['telemetry'][param].append(ts, value)
+                stored_points[param] = [{'ts': ts, 'value': value}]
+            freshness.record_cache_write(ts)
+            
+            # Lưu vào kho cục bộ. Chỉ lưu điểm có thời điểm đo của thiết bị: ThingsBoard lưu
+            # điểm đó với cùng ts nên lần tải bù sau ghi đè lên đúng điểm này. Điểm theo giờ
+            # nhận lệch vài ms so với ts của ThingsBoard và sẽ bị lưu hai lần, nên được bỏ qua
+            # (lịch sử của khoảng đó được tải từ ThingsBoard)
+            if device_ts:
+                try:
+                    telemetry_store.insert_telemetry(THINGSBOARD_CONFIG['device_id'], stored_points)
+                except Exception as e:
+                    logger.error(f"Error writing MQTT telemetry to local store: {e}")
+            
+            # Đẩy dữ liệu mới ngay tới các listener thay vì chờ chu kỳ polling
+            _notify_telemetry_listeners()
         
         # Xử lý dữ liệu attributes
         elif topic.startswith("v1/devices/me/attributes"):
@@ -153,6 +204,8 @@ def start_mqtt_connection():
             
             # Thiết lập TLS/SSL
             try:
+                if not THINGSBOARD_CONFIG['mqtt_tls']:
+                    raise RuntimeError("TLS disabled by configuration")
                 mqtt_client.tls_set(cert_reqs=ssl.CERT_REQUIRED)
                 
                 # Thử kết nối với TLS
@@ -206,7 +259,7 @@ def initialize_mqtt_client():
     try:
         # Lấy token từ biến môi trường hoặc dùng giá trị mặc định
         token = THINGSBOARD_CONFIG['access_token']
-        url = f"https://{THINGSBOARD_CONFIG['host']}/api/v1/{token}/telemetry"
+        url = f"{THINGSBOARD_CONFIG['http_url']}/api/v1/{token}/telemetry"
         
         logger.info(f"Testing device HTTP API connection to ThingsBoard: {url}")
         
@@ -216,15 +269,15 @@ def initialize_mqtt_client():
             "timestamp": int(time.time() * 1000)
         }
         
-        response = requests.post(url, json=ping_data)
+        response = tb_transport.post(url, json=ping_data)
         
         if response.status_code == 200:
             mqtt_data_store['connected'] = True
             logger.info("Successfully connected to ThingsBoard device HTTP API")
             
             # Lấy dữ liệu hiện tại
-            current_url = f"https://{THINGSBOARD_CONFIG['host']}/api/v1/{token}/attributes"
-            attr_response = requests.get(current_url)
+            current_url = f"{THINGSBOARD_CONFIG['http_url']}/api/v1/{token}/attributes"
+            attr_response = tb_transport.get(current_url)
             
             if attr_response.status_code == 200:
                 data = attr_response.json()
@@ -257,6 +310,7 @@ def stop_mqtt_client():
                 mqtt_client.disconnect()
                 mqtt_connected = False
                 mqtt_data_store['connected'] = False
+                mqtt_data_store['broker_connected'] = False
                 logger.info("MQTT client stopped successfully")
             except Exception as e:
                 logger.error(f"Error stopping MQTT client: {e}")
@@ -265,20 +319,38 @@ def stop_mqtt_client():
         else:
             logger.info("No active MQTT client to stop")
 
-def _get_status(value, param_info):
-    """Hàm nội bộ để xác định trạng thái dựa trên ngưỡng"""
-    if value is None:
-        return "unknown"
-    if value >= param_info["danger"]:
-        return "danger"
-    elif value >= param_info["warning"]:
-        return "warning"
-    return "normal"
+def _latest_telemetry():
+    """Điểm telemetry mới nhất của mỗi tham số theo định dạng của ThingsBoard API"""
+    telemetry = {}
+    for param, buffer in mqtt_data_store['telemetry'].items():
+        latest = buffer.latest()
+        if latest is not None:
+            telemetry[param] = [{'ts': latest[0], 'value': latest[1]}]
+    return telemetry
+
+def is_broker_connected():
+    """Kiểm tra kết nối tới MQTT broker có đang hoạt động không"""
+    return mqtt_client is not None and mqtt_data_store['broker_connected']
+
+def get_mqtt_readings():
+    """
+    Lấy dữ liệu hiện tại từ telemetry nhận qua MQTT.
+    Trả về None nếu không kết nối broker hoặc chưa nhận được telemetry nào.
+    """
+    if not is_broker_connected() or not mqtt_data_store['telemetry']:
+        return None
+    return format_current_data(_latest_telemetry())
 
 def get_current_readings():
     """
-    Lấy dữ liệu hiện tại từ ThingsBoard HTTP API thông qua token thiết bị
+    Lấy dữ liệu hiện tại, ưu tiên telemetry nhận qua MQTT.
+    Chỉ dùng ThingsBoard HTTP API thông qua token thiết bị khi không có kết nối MQTT.
     """
+    # Dữ liệu MQTT luôn mới nhất, không cần gọi HTTP
+    readings = get_mqtt_readings()
+    if readings is not None:
+        return readings
+    
     # Kiểm tra xem cache có còn hiệu lực không (4 giây)
     current_time = time.time()
     if _data_cache['current']['data'] is not None and (current_time - _data_cache['current']['timestamp']) < 4:
@@ -288,7 +360,7 @@ def get_current_readings():
     try:
         # Sử dụng token trực tiếp
         token = "DATN"
-        url = f"https://{THINGSBOARD_CONFIG['host']}/api/v1/{token}/telemetry"
+        url = f"{THINGSBOARD_CONFIG['http_url']}/api/v1/{token}/telemetry"
         
         logger.info(f"Requesting current data from ThingsBoard device API: {url}")
         
@@ -302,12 +374,12 @@ def get_current_readings():
         }
         
         # Gửi ping để cập nhật dữ liệu mới nhất
-        ping_response = requests.post(url, json=ping_data)
+        ping_response = tb_transport.post(url, json=ping_data)
         
         if ping_response.status_code == 200:
             # Lấy dữ liệu hiện tại
-            latest_url = f"https://{THINGSBOARD_CONFIG['host']}/api/v1/{token}/attributes"
-            response = requests.get(latest_url)
+            latest_url = f"{THINGSBOARD_CONFIG['http_url']}/api/v1/{token}/attributes"
+            response = tb_transport.get(latest_url)
             
             if response.status_code == 200:
                 # Đánh dấu đã kết nối thành công
@@ -365,17 +437,10 @@ def get_current_readings():
             return _data_cache['current']['data']
     
     # Nếu không lấy được dữ liệu và không có cache, tạo dữ liệu trống
-    current_time = datetime.now().strftime("%H:%M:%S")
     readings = {}
     
-    for param, param_info in PARAM_RANGES.items():
-        readings[param] = {
-            "value": None,
-            "unit": param_info["unit"],
-            "status": "unknown",
-            "timestamp": current_time,
-            "message": "Không có dữ liệu"
-        }
+    for param in param_schema.SENSOR_PARAMS:
+        readings[param] = param_schema.missing_reading_json(param)
     
     # Thêm trạng thái thiết bị
     readings['device_status'] = "unknown"
@@ -401,10 +466,10 @@ def get_historical_data(hours=1):
         end_ts = int(current_time * 1000)  # Thời gian hiện tại tính bằng mili giây
         start_ts = end_ts - (hours * 60 * 60 * 1000)  # hours giờ trước
         
-        url = f"https://{THINGSBOARD_CONFIG['host']}/api/v1/{token}/telemetry?startTs={start_ts}&endTs={end_ts}"
+        url = f"{THINGSBOARD_CONFIG['http_url']}/api/v1/{token}/telemetry?startTs={start_ts}&endTs={end_ts}"
         
         logger.info(f"Requesting historical data from ThingsBoard device API: {url}")
-        response = requests.get(url)
+        response = tb_transport.get(url)
         
         if response.status_code == 200:
             # Đánh dấu đã kết nối thành công
@@ -454,58 +519,40 @@ def get_historical_data(hours=1):
             return _data_cache['historical']['data']
     
     # Nếu không lấy được dữ liệu và không có cache, tạo dữ liệu với các điểm dữ liệu trống
-    now = datetime.now()
-    formatted_data = {}
-    
-    for param in PARAM_RANGES:
-        param_data = []
-        for i in range(60):  # 60 data points (1 per minute for the last hour)
-            time_point = now - timedelta(minutes=i)
-            param_data.append({
-                "timestamp": time_point.strftime("%H:%M"),
-                "value": None
-            })
-        # Đảo ngược để có thứ tự thời gian tăng dần
-        formatted_data[param] = list(reversed(param_data))
-    
-    return formatted_data
+    return {param: Series.generated(param, empty=True) for param in param_schema.SENSOR_PARAMS}
 
 def format_current_data(data):
     """
     Chuyển đổi dữ liệu hiện tại từ ThingsBoard MQTT sang định dạng của ứng dụng
     """
-    # Lấy thời gian hiện tại
-    current_time = datetime.now().strftime("%H:%M:%S")
     readings = {}
     device_status = "online"
     last_data_update = None
     
-    # Chuyển đổi dữ liệu
+    # Chuyển đổi dữ liệu: (tham số, giá trị, ts) của các tham số có dữ liệu
+    latest = []
     for tb_param, app_param in PARAM_MAPPING.items():
         if tb_param in data and data[tb_param] and len(data[tb_param]) > 0:
             try:
                 ts = data[tb_param][0]['ts']
+                latest.append((app_param, float(data[tb_param][0]['value']), ts))
                 # Lưu lại timestamp mới nhất
                 if last_data_update is None or ts > last_data_update:
                     last_data_update = ts
-                
-                value = float(data[tb_param][0]['value'])
-                param_info = PARAM_RANGES[app_param]
-                status = _get_status(value, param_info)
-                
-                # Chuyển đổi timestamp của ThingsBoard sang định dạng giờ:phút:giây
-                tb_timestamp = datetime.fromtimestamp(ts / 1000).strftime("%H:%M:%S")
-                
-                readings[app_param] = {
-                    "value": value,
-                    "unit": param_info["unit"],
-                    "status": status,
-                    "timestamp": tb_timestamp,
-                    "last_update": ts
-                }
             except (KeyError, ValueError, IndexError) as e:
                 logger.error(f"Error processing {tb_param} data: {str(e)}")
     
+    # Xác định trạng thái của tất cả tham số trong một phép tính
+    codes = param_schema.classify(
+        [value for _, value, _ in latest], [param_schema.INDEX[param] for param, _, _ in latest]
+    ).tolist()
+    for (app_param, value, ts), code in zip(latest, codes):
+        # Chuyển đổi timestamp của ThingsBoard sang định dạng giờ:phút:giây
+        tb_timestamp = datetime.fromtimestamp(ts / 1000).strftime("%H:%M:%S")
+        readings[app_param] = param_schema.reading_json(
+            app_param, value, param_schema.STATUS_LABELS[code], tb_timestamp, ts
+        )
+    
     # Kiểm tra xem thiết bị có hoạt động không dựa trên thời gian dữ liệu mới nhất
     if last_data_update:
         # Tính thời gian trễ (phút) giữa thời gian hiện tại và thời gian cập nhật dữ liệu gần nhất
@@ -522,15 +569,9 @@ def format_current_data(data):
         device_status = "unknown"
     
     # Thêm các tham số còn thiếu với thông báo không có dữ liệu
-    for param, param_info in PARAM_RANGES.items():
+    for param in param_schema.SENSOR_PARAMS:
         if param not in readings:
-            readings[param] = {
-                "value": None,
-                "unit": param_info["unit"],
-                "status": "unknown",
-                "timestamp": current_time,
-                "message": "Không có dữ liệu"
-            }
+            readings[param] = param_schema.missing_reading_json(param, last_data_update)
             
     # Thêm trạng thái thiết bị vào kết quả
     readings['device_status'] = device_status
@@ -540,46 +581,25 @@ def format_current_data(data):
 
 def format_historical_data(data):
     """
-    Chuyển đổi dữ liệu lịch sử từ ThingsBoard MQTT sang định dạng của ứng dụng
+    Chuyển đổi dữ liệu lịch sử từ ThingsBoard MQTT sang {tham số: Series} của ứng dụng
     """
-    formatted_data = {}
+    history = {}
     
     # Chuyển đổi dữ liệu lịch sử
     for tb_param, app_param in PARAM_MAPPING.items():
         if tb_param in data and data[tb_param]:
             try:
-                param_data = []
-                for item in data[tb_param]:
-                    timestamp = datetime.fromtimestamp(item['ts'] / 1000).strftime("%H:%M")
-                    value = float(item['value'])
-                    
-                    param_data.append({
-                        "timestamp": timestamp,
-                        "value": value
-                    })
-                
-                # Sắp xếp theo thời gian tăng dần
-                param_data.sort(key=lambda x: x['timestamp'])
-                formatted_data[app_param] = param_data
-            except (KeyError, ValueError) as e:
+                history[app_param] = Series.from_points((item['ts'], item['value']) for item in data[tb_param])
+            except (KeyError, ValueError, TypeError) as e:
                 logger.error(f"Error processing historical {tb_param} data: {str(e)}")
     
     # Thêm các tham số còn thiếu với dữ liệu trống
-    now = datetime.now()
-    
-    for param in PARAM_RANGES:
-        if param not in formatted_data:
-            param_data = []
-            for i in range(60):  # 60 data points (1 per minute for the last hour)
-                time_point = now - timedelta(minutes=i)
-                param_data.append({
-                    "timestamp": time_point.strftime("%H:%M"),
-                    "value": None
-                })
-            # Đảo ngược để có thứ tự thời gian tăng dần
-            formatted_data[param] = list(reversed(param_data))
+    end_ts = int(time.time() * 1000)
+    for param in param_schema.SENSOR_PARAMS:
+        if param not in history:
+            history[param] = Series.generated(param, end_ts, empty=True)
     
-    return formatted_data
+    return history
 
 def test_connection():
     """
@@ -590,10 +610,10 @@ def test_connection():
         token = "DATN"
         
         # Kiểm tra kết nối bằng cách truy cập API thiết bị
-        url = f"https://{THINGSBOARD_CONFIG['host']}/api/v1/{token}/attributes"
+        url = f"{THINGSBOARD_CONFIG['http_url']}/api/v1/{token}/attributes"
         
         logger.info(f"Testing device API connection to ThingsBoard: {url}")
-        response = requests.get(url)
+        response = tb_transport.get(url)
         
         if response.status_code == 200:
             logger.info("ThingsBoard device API connection successful")
@@ -609,5 +629,7 @@ def test_connection():
         mqtt_data_store['connected'] = False
         return False
 
-# Khởi tạo kết nối HTTP API khi module được import
-initialize_mqtt_client()
\ No newline at end of file
+# Khởi tạo kết nối khi module được import
+# (đặt THINGSBOARD_MQTT_AUTOCONNECT=0 để chỉ dùng các hàm xử lý dữ liệu, ví dụ khi benchmark)
+if os.environ.get('THINGSBOARD_MQTT_AUTOCONNECT', '1') != '0':
+    initialize_mqtt_client()
\ No newline at end of file
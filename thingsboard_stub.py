@@ -0,0 +1,289 @@
+"""
+Máy chủ ThingsBoard giả lập để chạy thử và benchmark toàn bộ hệ thống (run.py + app.py)
+với điều kiện upstream được kiểm soát.
+
+Các endpoint được hỗ trợ (giống các endpoint mà client đang dùng):
+    GET  /api/plugins/telemetry/DEVICE/{id}/values/timeseries          giá trị mới nhất
+    GET  /api/plugins/telemetry/DEVICE/{id}/values/timeseries?startTs=..&endTs=..[&keys=..&limit=..]
+    GET  /api/v1/{token}/telemetry?startTs=..&endTs=..                  lịch sử dạng [{ts, values}]
+    POST /api/v1/{token}/telemetry                                      ghi nhận ping/telemetry
+    GET  /api/v1/{token}/attributes                                     {"client": {...}, "shared": {}}
+    GET/POST /stub/config                                               xem/đổi cấu hình khi đang chạy
+
+Giá trị được sinh xác định theo (thiết bị, key, thời điểm) nên các lần chạy có thể so sánh
+với nhau. Độ trễ, tỷ lệ lỗi và kích thước payload (số key phụ, mật độ điểm) có thể cấu hình.
+
+Cách dùng:
+    python thingsboard_stub.py --port 9090 --latency 50 --jitter 20 --error-rate 0.05
+    THINGSBOARD_URL=http://127.0.0.1:9090 THINGSBOARD_HTTP_URL=http://127.0.0.1:9090 \\
+        THINGSBOARD_HOST=127.0.0.1 THINGSBOARD_MQTT_TLS=0 python run.py
+
+Chế độ MQTT (cần một broker MQTT cục bộ, ví dụ mosquitto):
+    python thingsboard_stub.py --mqtt-publish 127.0.0.1:1883 --publish-interval 1
+"""
+
+import os
+import json
+import math
+import time
+import zlib
+import random
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Cấu hình logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('thingsboard_stub')
+
+# Các key của thiết bị thật: (giá trị trung bình, biên độ dao động)
+STUB_KEYS = {
+    'Temperature': (27, 5),
+    'Humidity': (65, 15),
+    'PM10': (60, 40),
+    'PM2.5': (30, 20),
+    'CO': (8, 6),
+    'CO2': (600, 250),
+    'Sound': (55, 15)
+}
+
+# Giới hạn mặc định của ThingsBoard khi không chỉ định limit
+DEFAULT_LIMIT = 100
+
+# Cấu hình hiện tại, có thể đổi qua CLI hoặc /stub/config
+STUB_CONFIG = {
+    'latency_ms': 0,        # Độ trễ thêm vào mỗi response
+    'jitter_ms': 0,         # Độ lệch ngẫu nhiên (±) của độ trễ
+    'error_rate': 0.0,      # Tỷ lệ request trả về lỗi (0..1)
+    'error_status': 503,    # Mã HTTP khi trả lỗi
+    'extra_keys': 0,        # Số key phụ thêm vào mỗi thiết bị (tăng kích thước payload)
+    'interval_ms': 5000     # Khoảng cách giữa các điểm dữ liệu lịch sử
+}
+
+_stats = {'requests': 0, 'errors': 0, 'bytes_sent': 0}
+_stats_lock = threading.Lock()
+
+
+def stub_keys():
+    """Danh sách key của thiết bị giả lập (key thật trước, key phụ sau)"""
+    return list(STUB_KEYS) + [f'extra_{i}' for i in range(STUB_CONFIG['extra_keys'])]
+
+
+def stub_value(device_id, key, ts):
+    """Giá trị xác định của key tại thời điểm ts (mili giây): dao động theo ngày cộng nhiễu"""
+    mean, amplitude = STUB_KEYS.get(key, (50, 25))
+    seed = zlib.crc32(f'{device_id}/{key}'.encode())
+    phase = (seed % 1000) / 1000 * 2 * math.pi
+    daily = math.sin(ts / 86_400_000 * 2 * math.pi + phase)
+    noise = ((zlib.crc32(f'{seed}/{ts}'.encode()) % 2001) - 1000) / 1000
+    return round(max(0.0, mean + amplitude * (0.8 * daily + 0.2 * noise)), 2)
+
+
+def latest_values(device_id, keys=None, now_ms=None):
+    """Giá trị mới nhất theo định dạng ThingsBoard: {key: [{'ts': ..., 'value': '...'}]}"""
+    interval = STUB_CONFIG['interval_ms']
+    ts = (now_ms or int(time.time() * 1000)) // interval * interval
+    return {key: [{'ts': ts, 'value': str(stub_value(device_id, key, ts))}] for key in keys or stub_keys()}
+
+
+def history_values(device_id, start_ts, end_ts, keys=None, limit=DEFAULT_LIMIT):
+    """Lịch sử trong [start_ts, end_ts], mỗi key tối đa limit điểm, mới nhất trước (như ThingsBoard)"""
+    interval = STUB_CONFIG['interval_ms']
+    last = end_ts // interval * interval
+    first = max(start_ts, last - (limit - 1) * interval)
+    timestamps = range(last, first - 1, -interval)
+    return {
+        key: [{'ts': ts, 'value': str(stub_value(device_id, key, ts))} for ts in timestamps]
+        for key in keys or stub_keys()
+    }
+
+
+def _int_arg(query, name, default=None):
+    values = query.get(name)
+    return int(values[0]) if values else default
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # Không ghi log cho từng request (làm sai lệch kết quả benchmark)
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with _stats_lock:
+            _stats['bytes_sent'] += len(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        try:
+            return json.loads(raw) if raw else None
+        except ValueError:
+            return None
+
+    def _simulate_conditions(self):
+        """Áp dụng độ trễ và lỗi theo cấu hình, trả về True nếu đã gửi response lỗi"""
+        latency = STUB_CONFIG['latency_ms'] + random.uniform(-1, 1) * STUB_CONFIG['jitter_ms']
+        if latency > 0:
+            time.sleep(latency / 1000)
+        with _stats_lock:
+            _stats['requests'] += 1
+            failed = random.random() < STUB_CONFIG['error_rate']
+            if failed:
+                _stats['errors'] += 1
+        if failed:
+            self._send_json(STUB_CONFIG['error_status'], {'status': STUB_CONFIG['error_status'],
+                                                          'message': 'Simulated upstream error'})
+        return failed
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        query = parse_qs(url.query)
+
+        if url.path == '/stub/config':
+            with _stats_lock:
+                stats = dict(_stats)
+            return self._send_json(200, {'config': STUB_CONFIG, 'stats': stats})
+        if self._simulate_conditions():
+            return
+
+        # /api/plugins/telemetry/DEVICE/{id}/values/timeseries
+        if len(parts) == 7 and parts[:4] == ['api', 'plugins', 'telemetry', 'DEVICE'] \
+                and parts[5:] == ['values', 'timeseries']:
+            device_id = parts[4]
+            keys = [k for k in query.get('keys', [''])[0].split(',') if k] or None
+            start_ts = _int_arg(query, 'startTs')
+            if start_ts is None:
+                return self._send_json(200, latest_values(device_id, keys))
+            end_ts = _int_arg(query, 'endTs', int(time.time() * 1000))
+            limit = _int_arg(query, 'limit', DEFAULT_LIMIT)
+            return self._send_json(200, history_values(device_id, start_ts, end_ts, keys, limit))
+
+        # /api/v1/{token}/telemetry|attributes
+        if len(parts) == 4 and parts[:2] == ['api', 'v1']:
+            token, resource = parts[2], parts[3]
+            if resource == 'attributes':
+                latest = latest_values(token)
+                return self._send_json(200, {
+                    'client': {key: float(points[0]['value']) for key, points in latest.items()},
+                    'shared': {}
+                })
+            if resource == 'telemetry':
+                end_ts = _int_arg(query, 'endTs', int(time.time() * 1000))
+                start_ts = _int_arg(query, 'startTs', end_ts)
+                limit = _int_arg(query, 'limit', DEFAULT_LIMIT)
+                # Dạng [{ts, values: {...}}] mà client MQTT đọc khi tải lịch sử qua device API
+                rows = {}
+                for key, points in history_values(token, start_ts, end_ts, limit=limit).items():
+                    for point in points:
+                        rows.setdefault(point['ts'], {})[key] = float(point['value'])
+                return self._send_json(200, [{'ts': ts, 'values': values} for ts, values in rows.items()])
+
+        self._send_json(404, {'status': 404, 'message': f'Unknown endpoint: {url.path}'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        body = self._read_body()
+
+        if url.path == '/stub/config':
+            if not isinstance(body, dict) or not set(body) <= set(STUB_CONFIG):
+                return self._send_json(400, {'status': 400, 'message': f'Allowed keys: {sorted(STUB_CONFIG)}'})
+            STUB_CONFIG.update(body)
+            logger.info(f"Stub configuration changed: {STUB_CONFIG}")
+            return self._send_json(200, {'config': STUB_CONFIG})
+        if self._simulate_conditions():
+            return
+
+        if len(parts) == 4 and parts[:2] == ['api', 'v1'] and parts[3] in ('telemetry', 'attributes'):
+            # Telemetry/ping từ thiết bị chỉ được ghi nhận, không lưu lại
+            return self._send_json(200, {})
+
+        self._send_json(404, {'status': 404, 'message': f'Unknown endpoint: {url.path}'})
+
+
+def create_server(host='127.0.0.1', port=9090):
+    """ThreadingHTTPServer phục vụ các endpoint giả lập (chưa chạy serve_forever)"""
+    # Hàng đợi kết nối lớn để không giới hạn số request đồng thời khi benchmark
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer((host, port), StubRequestHandler)
+    server.daemon_threads = True
+    return server
+
+
+def publish_mqtt(broker, token, publish_interval, stop_event=None):
+    """
+    Gửi telemetry của thiết bị giả lập lên broker MQTT theo chu kỳ (như thiết bị thật).
+    Giá trị giống với /api/v1/{token}/attributes của máy chủ HTTP.
+    """
+    import paho.mqtt.client as mqtt
+
+    host, _, port = broker.partition(':')
+    client = mqtt.Client(client_id=f'thingsboard-stub-{token}')
+    client.username_pw_set(token)
+    client.connect(host, int(port or 1883), keepalive=60)
+    client.loop_start()
+    logger.info(f"Publishing telemetry to MQTT broker {host}:{port or 1883} every {publish_interval}s")
+
+    stop_event = stop_event or threading.Event()
+    try:
+        while not stop_event.is_set():
+            now = int(time.time() * 1000)
+            values = {key: float(points[0]['value']) for key, points in latest_values(token, now_ms=now).items()}
+            client.publish('v1/devices/me/telemetry', json.dumps({'ts': now, 'values': values}), qos=1)
+            stop_event.wait(publish_interval)
+    finally:
+        client.loop_stop()
+        client.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local ThingsBoard stub server for testing and benchmarks')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=9090, help='HTTP port')
+    parser.add_argument('--latency', type=float, default=0, help='added latency per request (ms)')
+    parser.add_argument('--jitter', type=float, default=0, help='random latency variation, +/- ms')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that fail (0..1)')
+    parser.add_argument('--error-status', type=int, default=503, help='HTTP status for simulated errors')
+    parser.add_argument('--extra-keys', type=int, default=0, help='extra telemetry keys per device (payload size)')
+    parser.add_argument('--interval', type=int, default=5000, help='spacing of history points (ms)')
+    parser.add_argument('--mqtt-publish', metavar='HOST:PORT', help='also publish telemetry to this MQTT broker')
+    parser.add_argument('--publish-interval', type=float, default=1.0, help='seconds between MQTT publishes')
+    parser.add_argument('--token', default=os.environ.get('THINGSBOARD_ACCESS_TOKEN', 'DATN'),
+                        help='device access token used for MQTT')
+    args = parser.parse_args()
+
+    STUB_CONFIG.update(
+        latency_ms=args.latency, jitter_ms=args.jitter, error_rate=args.error_rate,
+        error_status=args.error_status, extra_keys=args.extra_keys, interval_ms=args.interval
+    )
+
+    server = create_server(args.host, args.port)
+    logger.info(f"ThingsBoard stub listening on http://{args.host}:{args.port} with {STUB_CONFIG}")
+
+    if args.mqtt_publish:
+        threading.Thread(
+            target=publish_mqtt, args=(args.mqtt_publish, args.token, args.publish_interval),
+            daemon=True
+        ).start()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Lớp vận chuyển HTTP dùng chung cho các client ThingsBoard.
+
+Tất cả các lời gọi HTTP tới ThingsBoard đi qua một requests.Session duy nhất
+với connection pool giữ kết nối (keep-alive), nhờ đó mỗi lần polling không phải
+bắt tay TCP/TLS lại từ đầu. Bộ đếm theo từng host cho biết bao nhiêu request
+dùng lại kết nối cũ và bao nhiêu kết nối mới đã được mở.
+"""
+
+import os
+import time
+import threading
+import logging
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import connection_health
+import metrics
+
+# Cấu hình logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('thingsboard_transport')
+
+# Số host được giữ pool và số kết nối tối đa cho mỗi host
+POOL_CONNECTIONS = int(os.environ.get('THINGSBOARD_POOL_CONNECTIONS', 4))
+POOL_MAXSIZE = int(os.environ.get('THINGSBOARD_POOL_SIZE', 10))
+
+# Thời gian chờ mặc định (giây) cho mỗi request nếu nơi gọi không chỉ định
+REQUEST_TIMEOUT = float(os.environ.get('THINGSBOARD_REQUEST_TIMEOUT', 10))
+
+# Tên kênh trong connection_health, được cập nhật từ kết quả của mọi request
+HEALTH_MONITOR = 'thingsboard_http'
+
+# Độ trễ request theo endpoint (đường dẫn đã bỏ id thiết bị/token) và kết quả
+_request_latency = metrics.histogram(
+    'thingsboard_request_duration_seconds', 'Latency of HTTP requests to ThingsBoard',
+    ('endpoint', 'method', 'status')
+)
+
+# Bộ đếm theo host: số request và số kết nối mới
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _count(host, key):
+    with _stats_lock:
+        host_stats = _stats.setdefault(host, {'requests': 0, 'new_connections': 0})
+        host_stats[key] += 1
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _count(f"{self.host}:{self.port}", 'new_connections')
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _count(f"{self.host}:{self.port}", 'new_connections')
+        return super()._new_conn()
+
+
+class _PooledAdapter(HTTPAdapter):
+    """HTTPAdapter đếm số request và số kết nối mới cho từng host"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool
+        }
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        _count(f"{parts.hostname}:{port}", 'requests')
+        return super().send(request, **kwargs)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Session dùng chung (tạo khi cần lần đầu)"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = _PooledAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+                logger.info(f"Created pooled HTTP session (pool size {POOL_MAXSIZE})")
+    return _session
+
+
+def _endpoint(url):
+    """Đường dẫn của request với id thiết bị và access token được thay bằng tên chung"""
+    parts = urlsplit(url).path.split('/')
+    for i in range(1, len(parts)):
+        if parts[i - 1] == 'DEVICE':
+            parts[i] = '{id}'
+        elif parts[i - 1] == 'v1' and i >= 2 and parts[i - 2] == 'api':
+            parts[i] = '{token}'
+    return '/'.join(parts)
+
+
+def request(method, url, **kwargs):
+    """
+    Gửi request qua session dùng chung, áp dụng thời gian chờ mặc định.
+    Kết quả và độ trễ được ghi nhận cho theo dõi tình trạng kết nối.
+    """
+    kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+    monitor = connection_health.get_monitor(HEALTH_MONITOR)
+    started = time.monotonic()
+    try:
+        response = get_session().request(method, url, **kwargs)
+    except Exception as e:
+        latency = time.monotonic() - started
+        monitor.record_failure(e, latency)
+        _request_latency.observe(latency, endpoint=_endpoint(url), method=method, status='error')
+        raise
+
+    latency = time.monotonic() - started
+    if response.status_code >= 400:
+        monitor.record_failure(f"HTTP {response.status_code}", latency)
+    else:
+        monitor.record_success(latency)
+    _request_latency.observe(latency, endpoint=_endpoint(url), method=method, status=response.status_code)
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def get_transport_stats():
+    """
+    Thống kê sử dụng kết nối theo host: số request, số kết nối mới
+    và số request đã dùng lại kết nối có sẵn
+    """
+    with _stats_lock:
+        return {
+            host: {
+                'requests': host_stats['requests'],
+                'new_connections': host_stats['new_connections'],
+                'reused_connections': max(0, host_stats['requests'] - host_stats['new_connections'])
+            }
+            for host, host_stats in _stats.items()
+        }
+
+
+def close_session():
+    """Đóng session dùng chung và các kết nối trong pool"""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
@@ -0,0 +1,221 @@
+"""
+Đo thời gian từng giai đoạn của các đường xử lý chính (trace gồm nhiều span).
+
+Mỗi request API, mỗi lần làm mới cache ở nền và mỗi vòng lặp send_updates là một
+trace; bên trong, các giai đoạn (gọi ThingsBoard, response.json(), chuyển đổi dữ
+liệu, strftime, jsonify, emit) được ghi thành span. Chỉ một tỷ lệ trace được lấy
+mẫu (TRACE_SAMPLE_RATE); các trace đã lấy mẫu được giữ trong một vòng đệm và đọc
+qua /debug/traces. Khi trace không được lấy mẫu, span() chỉ kiểm tra một biến
+thread-local và trả về context manager rỗng dùng chung.
+
+Profiler: profile(seconds) chạy cProfile trên tiến trình đang chạy trong một khoảng
+thời gian. Khi dùng eventlet, mọi greenlet chạy trên cùng một thread nên profile
+bao gồm cả các request và vòng lặp nền trong khoảng thời gian đó.
+"""
+
+import io
+import os
+import marshal
+import time
+import random
+import cProfile
+import pstats
+import threading
+import logging
+from collections import deque
+
+# Cấu hình logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('tracing')
+
+# Tỷ lệ trace được lấy mẫu (0 = tắt, 1 = tất cả)
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.05))
+# Số trace gần nhất được giữ lại
+TRACE_RING_SIZE = int(os.environ.get('TRACE_RING_SIZE', 200))
+# Số span tối đa trong một trace (tránh trace quá lớn khi có vòng lặp)
+MAX_SPANS_PER_TRACE = 500
+# Thời gian profile tối đa cho một lần gọi (giây)
+MAX_PROFILE_SECONDS = 60
+# Các cách sắp xếp kết quả profile được hỗ trợ
+PROFILE_SORT_KEYS = ('cumulative', 'tottime', 'ncalls', 'name', 'filename')
+
+_traces = deque(maxlen=TRACE_RING_SIZE)
+_local = threading.local()
+_profile_lock = threading.Lock()
+
+
+class _NoopSpan:
+    """Context manager rỗng khi không có trace đang được ghi"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class _Trace:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start_wall = time.time()
+        self.start = time.perf_counter()
+        self.spans = []
+        self.depth = 0
+        self.error = None
+
+    def to_dict(self, duration):
+        return {
+            'name': self.name,
+            'start': self.start_wall,
+            'duration_ms': round(duration * 1000, 3),
+            'attrs': self.attrs,
+            'error': self.error,
+            'spans': self.spans
+        }
+
+
+class _Span:
+    def __init__(self, trace, name, attrs):
+        self._trace = trace
+        self._record = {'name': name, 'depth': trace.depth}
+        if attrs:
+            self._record['attrs'] = attrs
+
+    def __enter__(self):
+        trace = self._trace
+        self._started = time.perf_counter()
+        self._record['offset_ms'] = round((self._started - trace.start) * 1000, 3)
+        if len(trace.spans) < MAX_SPANS_PER_TRACE:
+            trace.spans.append(self._record)
+        trace.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._trace.depth -= 1
+        self._record['duration_ms'] = round((time.perf_counter() - self._started) * 1000, 3)
+        if exc_type is not None:
+            self._record['error'] = exc_type.__name__
+        return False
+
+    def set(self, **attrs):
+        self._record.setdefault('attrs', {}).update(attrs)
+
+
+class _TraceScope:
+    """Context manager của một trace gốc (chỉ tạo khi được lấy mẫu)"""
+
+    def __init__(self, name, attrs):
+        self._name = name
+        self._attrs = attrs
+
+    def __enter__(self):
+        self._trace = start_trace(self._name, **self._attrs)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._trace is not None and exc_type is not None:
+            self._trace.error = exc_type.__name__
+        finish_trace(self._trace)
+        return False
+
+    def set(self, **attrs):
+        if self._trace is not None:
+            self._trace.attrs.update(attrs)
+
+
+def start_trace(name, **attrs):
+    """
+    Bắt đầu trace cho thread/greenlet hiện tại nếu được lấy mẫu.
+    Trả về trace (truyền cho finish_trace) hoặc None nếu không lấy mẫu
+    hoặc đã có trace đang chạy (khi đó các span được ghi vào trace đó).
+    """
+    if getattr(_local, 'trace', None) is not None:
+        return None
+    if TRACE_SAMPLE_RATE <= 0 or random.random() >= TRACE_SAMPLE_RATE:
+        return None
+    trace = _local.trace = _Trace(name, attrs)
+    return trace
+
+
+def finish_trace(trace, **attrs):
+    """Kết thúc trace do start_trace tạo và lưu vào vòng đệm"""
+    if trace is None:
+        return
+    _local.trace = None
+    trace.attrs.update(attrs)
+    _traces.append(trace.to_dict(time.perf_counter() - trace.start))
+
+
+def trace(name, **attrs):
+    """Context manager cho một trace gốc, ví dụ: with tracing.trace('send_updates'): ..."""
+    return _TraceScope(name, attrs)
+
+
+def span(name, **attrs):
+    """Context manager cho một giai đoạn trong trace hiện tại (rỗng nếu không có trace)"""
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return _NOOP
+    return _Span(trace, name, attrs)
+
+
+def is_tracing():
+    """Thread/greenlet hiện tại có đang ghi trace không"""
+    return getattr(_local, 'trace', None) is not None
+
+
+def set_sample_rate(rate):
+    global TRACE_SAMPLE_RATE
+    TRACE_SAMPLE_RATE = min(1.0, max(0.0, float(rate)))
+
+
+def get_traces(limit=50, name=None, min_duration_ms=None):
+    """Các trace gần nhất (mới nhất trước), lọc theo tên và thời gian tối thiểu"""
+    result = []
+    for item in reversed(list(_traces)):
+        if name is not None and item['name'] != name:
+            continue
+        if min_duration_ms is not None and item['duration_ms'] < min_duration_ms:
+            continue
+        result.append(item)
+        if len(result) >= limit:
+            break
+    return result
+
+
+def profile(seconds, sort='cumulative', limit=50, raw=False):
+    """
+    Chạy cProfile trên tiến trình trong seconds giây rồi trả về kết quả dạng văn bản
+    (hoặc dữ liệu pstats nhị phân nếu raw=True). Chỉ một profile chạy tại một thời điểm;
+    trả về None nếu đang có profile khác.
+    """
+    seconds = min(max(float(seconds), 0.1), MAX_PROFILE_SECONDS)
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    try:
+        logger.info(f"Profiling live process for {seconds}s")
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            # time.sleep nhường cho các greenlet khác khi dùng eventlet
+            time.sleep(seconds)
+        finally:
+            profiler.disable()
+    finally:
+        _profile_lock.release()
+
+    if raw:
+        profiler.create_stats()
+        return marshal.dumps(profiler.stats)
+
+    output = io.StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    stats.sort_stats(sort).print_stats(limit)
+    return output.getvalue()
@@ -5,19 +5,22 @@
 Chương trình tính chỉ số chất lượng không khí VN_AQI theo thời gian thực
 dựa trên Quyết định 1459/QĐ-TCMT của Việt Nam.
 
-Tính toán AQI cho PM2.5, PM10, và CO từ dữ liệu cảm biến tức thời.
+Tính toán AQI cho PM2.5, PM10, và CO từ dữ liệu cảm biến tức thời, cùng với
+AQI chính thức từ nồng độ trung bình trượt (PM 24h, CO 8h).
 """
 
 import time
 import random
 import math
 from datetime import datetime
+import numpy as np
 from colorama import init, Fore, Style, Back
+import aqi_snapshot
 
 # Khởi tạo colorama
 init(autoreset=True)
 
-# Bảng quy chuẩn VN_AQI cho PM2.5 (μg/m³), dùng cho dữ liệu tức thời thay vì trung bình 24h
+# Bảng quy chuẩn VN_AQI cho PM2.5 (μg/m³), dùng cho cả dữ liệu tức thời và trung bình 24h
 PM25_BREAKPOINTS = [
     {"c_low": 0, "c_high": 12, "i_low": 0, "i_high": 50},
     {"c_low": 12.1, "c_high": 35.4, "i_low": 51, "i_high": 100},
@@ -28,7 +31,7 @@ PM25_BREAKPOINTS = [
     {"c_low": 350.5, "c_high": 500.4, "i_low": 401, "i_high": 500}
 ]
 
-# Bảng quy chuẩn VN_AQI cho PM10 (μg/m³), dùng cho dữ liệu tức thời thay vì trung bình 24h
+# Bảng quy chuẩn VN_AQI cho PM10 (μg/m³), dùng cho cả dữ liệu tức thời và trung bình 24h
 PM10_BREAKPOINTS = [
     {"c_low": 0, "c_high": 54, "i_low": 0, "i_high": 50},
     {"c_low": 55, "c_high": 154, "i_low": 51, "i_high": 100},
@@ -39,7 +42,7 @@ PM10_BREAKPOINTS = [
     {"c_low": 505, "c_high": 604, "i_low": 401, "i_high": 500}
 ]
 
-# Bảng quy chuẩn VN_AQI cho CO (mg/m³), dùng cho dữ liệu tức thời thay vì trung bình 8h
+# Bảng quy chuẩn VN_AQI cho CO (mg/m³), dùng cho cả dữ liệu tức thời và trung bình 8h
 # Lưu ý: Đầu vào của CO được chuyển đổi từ ppm sang mg/m³
 CO_BREAKPOINTS = [
     {"c_low": 0, "c_high": 5, "i_low": 0, "i_high": 50},      # Tốt
@@ -51,6 +54,33 @@ CO_BREAKPOINTS = [
     {"c_low": 120.1, "c_high": 150, "i_low": 401, "i_high": 500} # Nguy hại
 ]
 
+def compile_breakpoints(breakpoints):
+    """
+    Biên dịch bảng điểm ngắt (list các dict) thành các mảng NumPy để tra cứu
+    bằng tìm kiếm nhị phân trong tính toán hàng loạt
+    """
+    c_low = np.array([bp["c_low"] for bp in breakpoints], dtype=np.float64)
+    c_high = np.array([bp["c_high"] for bp in breakpoints], dtype=np.float64)
+    i_low = np.array([bp["i_low"] for bp in breakpoints], dtype=np.float64)
+    i_high = np.array([bp["i_high"] for bp in breakpoints], dtype=np.float64)
+
+    return {
+        "c_low": c_low,
+        "c_high": c_high,
+        "i_low": i_low,
+        # Hệ số góc tính sẵn theo đúng thứ tự phép tính của calculate_iaqi
+        "slope": (i_high - i_low) / (c_high - c_low),
+        # Giá trị kẹp khi nồng độ nằm ngoài bảng (hoặc rơi vào khe giữa hai mức)
+        "max_c": c_high[-1],
+        "max_i": i_high[-1],
+        "min_i": i_low[0]
+    }
+
+# Bảng điểm ngắt đã biên dịch, dùng cho calculate_vn_aqi_batch
+PM25_TABLE = compile_breakpoints(PM25_BREAKPOINTS)
+PM10_TABLE = compile_breakpoints(PM10_BREAKPOINTS)
+CO_TABLE = compile_breakpoints(CO_BREAKPOINTS)
+
 # Màu sắc và mô tả cho các mức AQI (RGB values converted to nearest ANSI colors)
 AQI_LEVELS = [
     {"range": (0, 50), "color": Fore.GREEN, "bg": Back.GREEN, "label": "Tốt", "description": "Chất lượng không khí tốt"},
@@ -68,6 +98,24 @@ def get_aqi_level(aqi):
             return level
     return AQI_LEVELS[-1]  # Mặc định trả về mức nguy hiểm nếu vượt quá phạm vi
 
+def get_aqi_status(aqi):
+    """Chuyển giá trị AQI thành trạng thái theo định dạng của ứng dụng"""
+    if aqi is None:
+        return "unknown"
+    
+    aqi_status = get_aqi_level(aqi)["label"].lower()  # Chuyển thành chữ thường để phù hợp với các trạng thái khác
+    
+    # Chuyển đổi trạng thái cho phù hợp với định dạng ứng dụng
+    if aqi_status in ["tốt"]:
+        return "normal"
+    elif aqi_status in ["trung bình"]:
+        return "warning"
+    elif aqi_status in ["kém"]:
+        return "kém"
+    elif aqi_status in ["xấu", "rất xấu", "nguy hiểm"]:
+        return "danger"
+    return aqi_status
+
 def calculate_iaqi(concentration, breakpoints):
     """Tính IAQI cho một thông số ô nhiễm cụ thể"""
     # Xử lý trường hợp không có dữ liệu
@@ -140,6 +188,174 @@ def calculate_vn_aqi(sensor_data):
     aqi = max(valid_iaqis)
     return aqi, iaqi_values
 
+def _as_concentration_array(values):
+    """Chuyển đầu vào (mảng, list có None, hoặc None) thành mảng float64, None -> NaN"""
+    if values is None:
+        return np.array(np.nan)
+    return np.asarray(values, dtype=np.float64)
+
+def calculate_iaqi_batch(concentrations, table):
+    """
+    Tính IAQI cho cả một mảng nồng độ trong một lần (vector hóa).
+    Kết quả giống hệt calculate_iaqi cho từng phần tử, trong đó None được thay bằng NaN.
+    """
+    c = _as_concentration_array(concentrations)
+
+    # Tìm điểm ngắt có c_low lớn nhất mà vẫn <= nồng độ (tìm kiếm nhị phân)
+    idx = np.searchsorted(table["c_low"], c, side="right") - 1
+    safe_idx = np.clip(idx, 0, len(table["c_low"]) - 1)
+    c_low = table["c_low"][safe_idx]
+    in_range = (idx >= 0) & (c <= table["c_high"][safe_idx])
+
+    # Áp dụng công thức tính IAQI cho các giá trị nằm trong bảng
+    iaqi = np.round(table["slope"][safe_idx] * (c - c_low) + table["i_low"][safe_idx])
+
+    # Ngoài bảng: vượt giới hạn cao nhất -> i_high cuối, còn lại -> i_low đầu
+    clamped = np.where(c > table["max_c"], table["max_i"], table["min_i"])
+    iaqi = np.where(in_range, iaqi, clamped)
+
+    # Không có dữ liệu
+    return np.where(np.isnan(c), np.nan, iaqi)
+
+def calculate_vn_aqi_batch(pm25, pm10, co_mgm3):
+    """
+    Tính chỉ số VN_AQI hàng loạt từ các mảng nồng độ PM2.5, PM10 và CO (mg/m³).
+    Trả về (aqi, iaqi_values) giống calculate_vn_aqi nhưng dưới dạng mảng,
+    NaN ở những vị trí không tính được.
+    """
+    pm25, pm10, co_mgm3 = np.broadcast_arrays(
+        _as_concentration_array(pm25),
+        _as_concentration_array(pm10),
+        _as_concentration_array(co_mgm3)
+    )
+
+    iaqi_values = {
+        "PM2.5": calculate_iaqi_batch(pm25, PM25_TABLE),
+        "PM10": calculate_iaqi_batch(pm10, PM10_TABLE),
+        "CO": calculate_iaqi_batch(co_mgm3, CO_TABLE)
+    }
+
+    # Chỉ số AQI là giá trị lớn nhất của các IAQI (bỏ qua NaN, NaN nếu thiếu tất cả)
+    aqi = np.fmax(np.fmax(iaqi_values["PM2.5"], iaqi_values["PM10"]), iaqi_values["CO"])
+    return aqi, iaqi_values
+
+# Cửa sổ trung bình theo Quyết định 1459/QĐ-TCMT: PM trung bình 24h, CO trung bình 8h
+PM_AVERAGING_WINDOW = 24 * 3600
+CO_AVERAGING_WINDOW = 8 * 3600
+# Mỗi ô (bucket) của cửa sổ trượt là trung bình 1 giờ
+AVERAGING_BUCKET = 3600
+# Tỷ lệ tối thiểu số giờ có dữ liệu trong cửa sổ (18/24h, 6/8h)
+MIN_DATA_COVERAGE = 0.75
+
+class RollingAverage:
+    """
+    Trung bình trượt theo thời gian cho một thông số, chia thành các ô thời gian cố định.
+    Mỗi lần thêm giá trị chỉ cập nhật một ô và tổng chạy nên chi phí là O(1),
+    không cần tính lại toàn bộ cửa sổ. Giá trị trung bình là trung bình của các
+    trung bình 1 giờ (theo cách tính trung bình 24h/8h của quy chuẩn).
+    """
+
+    def __init__(self, window_seconds, bucket_seconds=AVERAGING_BUCKET, min_coverage=MIN_DATA_COVERAGE):
+        self.bucket_seconds = bucket_seconds
+        self.size = max(1, int(window_seconds // bucket_seconds))
+        self.min_coverage = min_coverage
+        self._bucket_ids = [None] * self.size
+        self._sums = [0.0] * self.size
+        self._counts = [0] * self.size
+        self._head = None  # Chỉ số ô mới nhất
+        self._sum_of_means = 0.0  # Tổng các trung bình 1 giờ trong cửa sổ
+        self._filled = 0  # Số ô có dữ liệu
+
+    def _clear_slot(self, slot):
+        if self._counts[slot]:
+            self._sum_of_means -= self._sums[slot] / self._counts[slot]
+            self._filled -= 1
+            if self._filled == 0:
+                self._sum_of_means = 0.0  # Tránh sai số tích lũy khi cửa sổ rỗng
+        self._bucket_ids[slot] = None
+        self._sums[slot] = 0.0
+        self._counts[slot] = 0
+
+    def _advance(self, bucket_id):
+        """Dịch cửa sổ tới bucket_id, loại bỏ các ô đã ra khỏi cửa sổ"""
+        if self._head is None:
+            self._head = bucket_id
+            return
+        if bucket_id <= self._head:
+            return
+        if bucket_id - self._head >= self.size:
+            for slot in range(self.size):
+                self._clear_slot(slot)
+        else:
+            for b in range(self._head + 1, bucket_id + 1):
+                self._clear_slot(b % self.size)
+        self._head = bucket_id
+
+    def add(self, value, ts=None):
+        """Thêm một giá trị đo (ts tính bằng giây), bỏ qua None/NaN"""
+        if value is None or math.isnan(value):
+            return
+        ts = time.time() if ts is None else ts
+        bucket_id = int(ts // self.bucket_seconds)
+        self._advance(bucket_id)
+
+        # Dữ liệu quá cũ, đã nằm ngoài cửa sổ
+        if bucket_id <= self._head - self.size:
+            return
+
+        slot = bucket_id % self.size
+        if self._bucket_ids[slot] != bucket_id:
+            self._clear_slot(slot)
+            self._bucket_ids[slot] = bucket_id
+
+        if self._counts[slot]:
+            self._sum_of_means -= self._sums[slot] / self._counts[slot]
+        else:
+            self._filled += 1
+        self._sums[slot] += value
+        self._counts[slot] += 1
+        self._sum_of_means += self._sums[slot] / self._counts[slot]
+
+    def coverage(self, ts=None):
+        """Tỷ lệ số ô có dữ liệu trong cửa sổ tính đến thời điểm ts"""
+        ts = time.time() if ts is None else ts
+        self._advance(int(ts // self.bucket_seconds))
+        return self._filled / self.size
+
+    def mean(self, ts=None):
+        """Giá trị trung bình của cửa sổ, None nếu không đủ dữ liệu theo quy tắc độ phủ"""
+        if self.coverage(ts) < self.min_coverage or self._filled == 0:
+            return None
+        return self._sum_of_means / self._filled
+
+class AqiAverager:
+    """
+    Tổng hợp các trung bình trượt PM2.5/PM10 (24h) và CO (8h) để tính AQI chính thức
+    """
+
+    def __init__(self, bucket_seconds=AVERAGING_BUCKET, min_coverage=MIN_DATA_COVERAGE):
+        self.averages = {
+            "pm25": RollingAverage(PM_AVERAGING_WINDOW, bucket_seconds, min_coverage),
+            "pm10": RollingAverage(PM_AVERAGING_WINDOW, bucket_seconds, min_coverage),
+            "co_mgm3": RollingAverage(CO_AVERAGING_WINDOW, bucket_seconds, min_coverage)
+        }
+
+    def add_reading(self, sensor_data, ts=None):
+        """Cập nhật các trung bình trượt với một lần đọc cảm biến"""
+        ts = time.time() if ts is None else ts
+        for key, average in self.averages.items():
+            average.add(sensor_data.get(key), ts)
+
+    def averaged_data(self, ts=None):
+        """Nồng độ trung bình của từng thông số (None nếu chưa đủ dữ liệu)"""
+        return {key: average.mean(ts) for key, average in self.averages.items()}
+
+    def calculate_official_aqi(self, ts=None):
+        """Tính VN_AQI chính thức từ nồng độ trung bình 24h/8h"""
+        averaged = self.averaged_data(ts)
+        aqi, iaqi_values = calculate_vn_aqi(averaged)
+        return aqi, iaqi_values, averaged
+
 def display_aqi_info(aqi, iaqi_values, sensor_data):
     """Hiển thị thông tin AQI với màu sắc tương ứng"""
     aqi_level = get_aqi_level(aqi)
@@ -187,36 +403,46 @@ def display_aqi_info(aqi, iaqi_values, sensor_data):
     for level in AQI_LEVELS:
         print(f"  {level['color']}{level['range'][0]}-{level['range'][1]}: {level['label']} - {level['description']}")
 
-# Sử dụng file để lưu trữ giá trị AQI mới nhất
-def save_current_aqi(aqi_value, aqi_status):
-    """Lưu giá trị AQI và trạng thái vào file để chia sẻ giữa các processes"""
+# Sử dụng bộ nhớ dùng chung để chia sẻ giá trị AQI mới nhất
+def save_current_aqi(aqi_value, aqi_status, official_aqi=None, official_status="unknown", iaqi_values=None):
+    """Lưu giá trị AQI và trạng thái vào bộ nhớ dùng chung để chia sẻ giữa các processes"""
     try:
-        with open('current_aqi.txt', 'w') as f:
-            f.write(f"{aqi_value}\n{aqi_status}")
-        print(f"Đã lưu AQI: {aqi_value}, trạng thái: {aqi_status}")
+        aqi_snapshot.publish_snapshot(aqi_value, aqi_status, iaqi_values, official_aqi, official_status)
+        print(f"Đã lưu AQI: {aqi_value}, trạng thái: {aqi_status}, AQI chính thức: {official_aqi}")
     except Exception as e:
         print(f"Lỗi khi lưu AQI: {e}")
 
 def get_current_aqi():
-    """Đọc chỉ số AQI hiện tại và trạng thái từ file"""
+    """Đọc chỉ số AQI hiện tại và trạng thái từ bộ nhớ dùng chung"""
     try:
-        with open('current_aqi.txt', 'r') as f:
-            lines = f.readlines()
-            if len(lines) >= 2:
-                aqi_value = float(lines[0].strip())
-                aqi_status = lines[1].strip()
-                return aqi_value, aqi_status
+        snapshot = aqi_snapshot.read_snapshot()
+        if snapshot is None or snapshot["aqi"] is None:
             return None, None
+        return snapshot["aqi"], snapshot["status"]
     except Exception as e:
         print(f"Lỗi khi đọc AQI: {e}")
         return None, None
 
+def get_official_aqi():
+    """Đọc chỉ số AQI chính thức (trung bình 24h/8h) và trạng thái từ bộ nhớ dùng chung"""
+    try:
+        snapshot = aqi_snapshot.read_snapshot()
+        if snapshot is None or snapshot["official_aqi"] is None:
+            return None, "unknown"
+        return snapshot["official_aqi"], snapshot["official_status"]
+    except Exception as e:
+        print(f"Lỗi khi đọc AQI chính thức: {e}")
+        return None, "unknown"
+
 def main():
     """Hàm chính thực hiện tính toán và hiển thị AQI theo thời gian thực"""
     print(f"{Style.BRIGHT}{Fore.CYAN}Bắt đầu chương trình tính chỉ số chất lượng không khí VN_AQI...")
     print(f"{Style.BRIGHT}{Fore.CYAN}Theo Quyết định 1459/QĐ-TCMT của Việt Nam\n")
     print(f"{Fore.YELLOW}Nhấn Ctrl+C để dừng chương trình\n")
     
+    # Bộ tính trung bình trượt cho AQI chính thức
+    averager = AqiAverager()
+    
     try:
         while True:
             # Mô phỏng đọc dữ liệu cảm biến
@@ -225,31 +451,33 @@ def main():
             # Tính chỉ số AQI
             aqi, iaqi_values = calculate_vn_aqi(sensor_data)
             
+            # Cập nhật trung bình trượt và tính AQI chính thức (trung bình 24h/8h)
+            averager.add_reading(sensor_data)
+            official_aqi, _, averaged = averager.calculate_official_aqi()
+            official_status = get_aqi_status(official_aqi)
+            
             # Xác định trạng thái AQI
             if aqi is not None:
-                aqi_level = get_aqi_level(aqi)
-                aqi_status = aqi_level["label"].lower()  # Chuyển thành chữ thường để phù hợp với các trạng thái khác
+                aqi_status = get_aqi_status(aqi)
                 
-                # Chuyển đổi trạng thái cho phù hợp với định dạng ứng dụng
-                if aqi_status in ["tốt"]:
-                    aqi_status = "normal"
-                elif aqi_status in ["trung bình"]:
-                    aqi_status = "warning"
-                elif aqi_status in ["kém"]:
-                    aqi_status = "kém"
-                elif aqi_status in ["xấu", "rất xấu", "nguy hiểm"]:
-                    aqi_status = "danger"
-                
-                # Lưu giá trị AQI và trạng thái vào file để chia sẻ với EnvMonitor
-                save_current_aqi(aqi, aqi_status)
+                # Lưu giá trị AQI và trạng thái vào bộ nhớ dùng chung để chia sẻ với EnvMonitor
+                save_current_aqi(aqi, aqi_status, official_aqi, official_status, iaqi_values)
                 
                 # Hiển thị thông tin AQI
                 display_aqi_info(aqi, iaqi_values, sensor_data)
             else:
                 # Lưu giá trị AQI không xác định
-                save_current_aqi(None, "unknown")
+                save_current_aqi(None, "unknown", official_aqi, official_status, iaqi_values)
                 print(f"\n{Fore.RED}Không thể tính AQI: Thiếu dữ liệu cảm biến!")
             
+            # Hiển thị AQI chính thức
+            if official_aqi is not None:
+                official_level = get_aqi_level(official_aqi)
+                print(f"\n{Style.BRIGHT}AQI chính thức (PM trung bình 24h, CO trung bình 8h):")
+                print(f"  {official_level['color']}{Style.BRIGHT}{official_aqi} - {official_level['label']}")
+            else:
+                print(f"\n{Fore.YELLOW}AQI chính thức: chưa đủ dữ liệu trung bình 24h/8h")
+            
             # Chờ 5 giây trước khi cập nhật tiếp
             time.sleep(5)
     except KeyboardInterrupt: